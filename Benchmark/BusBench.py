@@ -0,0 +1,127 @@
+"""
+End-to-end benchmarks of polling and firmware upgrade against local slave simulator (VisualModbus.MbSimulator).
+Register map of RTD emulator is read by MbClient and RegMap over pseudo terminal (POSIX only), Modbus TCP and RTU
+over TCP. Simulator adds no latency, so the overhead of the client stack is measured.
+
+Run from repository root: python -m Benchmark.BusBench
+"""
+import json
+import logging
+import os
+import tempfile
+from time import perf_counter
+
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbSimulator import MbSimulator
+from VisualModbus.MbUpgrade import MbUpgrade
+from VisualModbus.RegMap import RegMap
+
+"""
+Register map read by the benchmark
+"""
+REG_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RtdEmulator', 'RtdEmul_Modbus.json')
+
+"""
+Number of measured read cycles (read_in and read_hold) and size of upgraded image in bytes
+"""
+CYCLES = 200
+IMAGE_BYTES = 1 << 14
+
+
+def percentile(values, pct):
+    """
+    Get percentile of values
+    :param values: List of numbers
+    :param pct: Percentile (0 - 100)
+    :return: Value at percentile
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def bench_transport(sim, settings, folder, cycles=CYCLES):
+    """
+    Benchmark read cycles and firmware upgrade over one transport
+    :param sim: MbSimulator serving the transport
+    :param settings: Dictionary of communication settings (ComSettings.json)
+    :param folder: Folder for generated files
+    :param cycles: Number of read cycles
+    :return: Dictionary {name: value}
+    """
+    com = os.path.join(folder, 'BenchCom.json')
+    with open(com, 'w') as f:
+        json.dump(settings, f)
+    mb = MbClient()
+    mb.open(com)
+    regs = RegMap(mb)
+    regs.load(REG_MAP)
+    # Warm up connection and adaptive timeouts
+    regs.read_in()
+    regs.read_hold()
+    sim.reset_stats()
+    latencies = []
+    errors = 0
+    start = perf_counter()
+    for i in range(cycles):
+        cycle = perf_counter()
+        if regs.read_in() is None or regs.read_hold() is None:
+            errors += 1
+        latencies.append(perf_counter() - cycle)
+    elapsed = perf_counter() - start
+    stats = sim.get_stats()
+    ret = {'transactions_per_s': stats['Requests'] / elapsed,
+           'cycle_p50': percentile(latencies, 50),
+           'cycle_p99': percentile(latencies, 99),
+           'requests_per_cycle': stats['Requests'] / cycles,
+           'bytes_per_cycle': (stats['BytesIn'] + stats['BytesOut']) / cycles,
+           'errors': errors}
+    # Firmware upgrade of new image, the device has no application to compare
+    upg = MbUpgrade(os.path.join(folder, 'BenchUpgrade.json'), mb, 1)
+    upg.load_file(os.path.join(folder, 'Bench.bin'))
+    sim.reset_stats()
+    start = perf_counter()
+    ret['errors'] += upg.run_upgrade()
+    elapsed = perf_counter() - start
+    stats = sim.get_stats()
+    ret['upgrade_bytes_per_s'] = upg.length / elapsed
+    ret['upgrade_wire_bytes'] = stats['BytesIn'] + stats['BytesOut']
+    mb.close()
+    return ret
+
+
+def run(cycles=CYCLES):
+    """
+    Run benchmarks over all transports available on the platform
+    :param cycles: Number of read cycles
+    :return: Dictionary {name: value}, names such as 'bus.tcp.cycle_p99'
+    """
+    logging.disable(logging.WARNING)
+    ret = {}
+    with tempfile.TemporaryDirectory() as folder:
+        upgrade = os.path.join(folder, 'BenchUpgrade.json')
+        with open(upgrade, 'w') as f:
+            json.dump({'align': 4, 'page_bytes': 64, 'type_binary': 0, 'mode_operation': 1, 'address': 1000,
+                       'init_delay': 0, 'verify': False}, f)
+        with open(os.path.join(folder, 'Bench.bin'), 'wb') as f:
+            f.write(bytes(i & 0xFF for i in range(IMAGE_BYTES)))
+        sim = MbSimulator()
+        sim.add_slave(REG_MAP, 1, upgrade)
+        transports = {'tcp': {'host': '127.0.0.1', 'port': sim.serve_tcp(0), 'timeout': 1.0},
+                      'rtu-over-tcp': {'method': 'rtu-over-tcp', 'host': '127.0.0.1',
+                                       'port': sim.serve_tcp(0, method='rtu-over-tcp'), 'timeout': 1.0}}
+        if os.name == 'posix':
+            transports['rtu'] = {'comport': sim.serve_pty(), 'baud_rate': 115200, 'parity': 'N', 'stop_bits': 1,
+                                 'timeout': 1.0, 'inter_char_timeout': 30.0, 'silent_interval': 1.0}
+        try:
+            for transport, settings in transports.items():
+                for name, value in bench_transport(sim, settings, folder, cycles).items():
+                    ret['bus.{}.{}'.format(transport, name)] = value
+        finally:
+            sim.stop()
+            logging.disable(logging.NOTSET)
+    return ret
+
+
+if __name__ == "__main__":
+    for name, value in run().items():
+        print(f"{name:<40} {value:12.6g}")
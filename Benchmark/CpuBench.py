@@ -0,0 +1,207 @@
+"""
+Microbenchmarks of register map and upgrade paths without communication. Register maps of given sizes are
+generated, registers are read from and written to a virtual device in memory (VisualModbus.MbSimulator.SimSlave),
+so only planning, decoding, encoding and lookup are measured.
+
+Run from repository root: python -m Benchmark.CpuBench
+"""
+import json
+import os
+import random
+import tempfile
+import timeit
+
+import VisualModbus.Crc32 as Crc32
+from VisualModbus.MbSimulator import SimSlave
+from VisualModbus.MbUpgrade import MbUpgrade
+from VisualModbus.RegMap import RegMap
+
+"""
+Register map sizes (number of registers)
+"""
+SIZES = (100, 1000, 10000)
+
+"""
+Formats of generated registers and their number of words
+"""
+FORMATS = (('INT', 1), ('INT', 2), ('ENUM', 1), ('BIN', 1), ('FLOAT', 1), ('FLOAT32', 2), ('STRING', 8))
+
+"""
+Size of benchmarked firmware image in bytes
+"""
+IMAGE_BYTES = 1 << 20
+
+
+class LocalClient:
+    """
+    Client of virtual device in memory, it has interface of MbClient used by RegMap
+    """
+
+    def __init__(self, device):
+        """
+        Initialize client of device
+        :param device: SimSlave
+        """
+        self.device = device
+        self.s = None
+        self.rr = None
+        self.generation = 1
+        self.requests = 0
+
+    def read(self, request):
+        """
+        Read registers
+        :param request: Request dictionary
+        :return: Array of read register values on success
+        :return: None on read error
+        """
+        self.requests += 1
+        code, values = self.device.read('Input' if request['Type'].lower() == 'input' else 'Holding',
+                                        request['Address'], request['Count'])
+        return values if code == 0 else None
+
+    def write_hold(self, request):
+        """
+        Write holding registers
+        :param request: Request dictionary
+        :return: 0 on success
+        :return: None on fail
+        """
+        self.requests += 1
+        return 0 if self.device.write(request['Address'], request['Values']) == 0 else None
+
+    def retryable(self, slave):
+        """
+        Errors of virtual device are not retried
+        :param slave: Slave address
+        :return: False
+        """
+        return False
+
+    def last_exception(self):
+        """
+        Virtual device does not return modbus exceptions to RegMap
+        :return: None
+        """
+        return None
+
+
+def make_map(count, seed=1):
+    """
+    Create register map with given number of registers of all formats, half of them holding registers
+    :param count: Number of registers
+    :param seed: Seed of random formats
+    :return: List of registers
+    """
+    rnd = random.Random(seed)
+    regs = []
+    address = {'INPUT': 0, 'HOLD': 0}
+    for i in range(count):
+        reg_type = 'HOLD' if i % 2 else 'INPUT'
+        fmt, words = rnd.choice(FORMATS)
+        value = 'abc' if fmt == 'STRING' else 1.5 if fmt.startswith('FLOAT') else rnd.getrandbits(15)
+        regs.append({'Type': reg_type, 'Name': 'G{}_REG_{}'.format(i % 20, i),
+                     'Address': list(range(address[reg_type], address[reg_type] + words)), 'Format': fmt,
+                     'Value': value, 'Access': 'RW' if reg_type == 'HOLD' else 'RO', 'Min': 0, 'Max': 0})
+        address[reg_type] += words
+    return regs
+
+
+def best(func, repeat=5, number=1):
+    """
+    Measure the best time of function call
+    :param func: Function without arguments
+    :param repeat: Number of repetitions
+    :param number: Number of calls in one repetition
+    :return: Time of one call in seconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_map(count, folder):
+    """
+    Benchmark register map of given size
+    :param count: Number of registers
+    :param folder: Folder for generated files
+    :return: Dictionary {name: time in seconds}
+    """
+    file_name = os.path.join(folder, 'Bench{}_Modbus.json'.format(count))
+    with open(file_name, 'w') as f:
+        json.dump(make_map(count), f)
+    mb = LocalClient(SimSlave(file_name))
+    regs = RegMap(mb)
+    ret = {'load': best(lambda: RegMap(mb).load(file_name), repeat=3)}
+    regs.load(file_name)
+    ret['read_in'] = best(regs.read_in)
+    ret['read_hold'] = best(regs.read_hold)
+    # Decode of responses only
+    responses = []
+    for space, ranges in (('Input', regs.input_a), ('Holding', regs.hold_a)):
+        for rng in ranges:
+            req = {'Address': rng[0], 'Count': rng[1] - rng[0] + 1, 'Type': space, 'Slave': 1}
+            responses.append((req, mb.read(req)))
+    ret['from_modbus'] = best(lambda: [regs.from_modbus(req, values) for req, values in responses])
+    # Every tenth holding register is changed in visual, the values alternate between calls
+    names = [reg['Name'] for reg in regs.hold]
+    values = {}
+    for reg in regs.hold:
+        values[reg['Name']] = regs.val_to_str(reg)
+        values[reg['Name'] + '_HEX'] = regs.val_to_hex(reg)
+    changed = dict(values)
+    for name in names[::10]:
+        changed[name] = '7' if values[name] != '7' else '8'
+    states = [values, changed]
+    ret['from_visual'] = best(lambda: [regs.from_visual(states[i % 2], '_HEX') for i in range(2)]) / 2
+    ret['write_hold'] = best(regs.write_hold)
+    ret['lookup'] = best(lambda: [regs.get_by_name(name) for name in names])
+    sample = random.Random(2).sample(names, min(20, len(names)))
+    ret['read_many'] = best(lambda: regs.read_many(sample), number=10)
+    return ret
+
+
+def bench_upgrade(folder):
+    """
+    Benchmark opening of firmware image, creating all its page frames and CRC
+    :param folder: Folder for generated files
+    :return: Dictionary {name: time in seconds}
+    """
+    file_name = os.path.join(folder, 'Bench.bin')
+    with open(file_name, 'wb') as f:
+        f.write(random.Random(3).getrandbits(8 * IMAGE_BYTES).to_bytes(IMAGE_BYTES, 'little'))
+    settings = os.path.join(folder, 'BenchUpgrade.json')
+    with open(settings, 'w') as f:
+        json.dump({'align': 4, 'page_bytes': 64, 'type_binary': 0, 'mode_operation': 1, 'address': 1000,
+                   'init_delay': 0}, f)
+    upg = MbUpgrade(settings, None)
+
+    def frames():
+        upg.load_file(file_name)
+        for request in upg.page_requests():
+            pass
+
+    words = [random.Random(4).getrandbits(32) for i in range(1 << 14)]
+    return {'upgrade.load_file': best(lambda: upg.load_file(file_name)),
+            'upgrade.frames': best(frames, repeat=3),
+            'crc.calculate': best(lambda: Crc32.calculate(words)),
+            'crc.image': best(lambda: Crc32.calc_from_byte(upg.image.data), repeat=3)}
+
+
+def run(sizes=SIZES):
+    """
+    Run all microbenchmarks
+    :param sizes: Register map sizes
+    :return: Dictionary {name: time in seconds}, names such as 'regmap.read_in.1000'
+    """
+    ret = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for count in sizes:
+            for name, t in bench_map(count, folder).items():
+                ret['regmap.{}.{}'.format(name, count)] = t
+        upgrade = bench_upgrade(folder)
+        ret.update(upgrade)
+    return ret
+
+
+if __name__ == "__main__":
+    for name, t in run().items():
+        print(f"{name:<28} {t * 1000:10.3f} ms")
@@ -0,0 +1,122 @@
+"""
+Benchmark of CRC32 calculation, compares the former bitwise implementation with the table and zlib paths of
+VisualModbus.Crc32 and checks that all of them give identical results.
+
+Run from repository root: python -m Benchmark.Crc32Bench
+"""
+import os
+import random
+import timeit
+
+import VisualModbus.Crc32 as Crc32
+
+
+def legacy_calculate(data, crc_val=0xFFFFFFFF):
+    """
+    Former implementation of Crc32.calculate, table is created on every call
+    :param data: Input data as array of integers
+    :param crc_val: Initial value of crc
+    :return: Crc
+    """
+    table = [0] * 256
+
+    for i in range(256):
+        table[i] = Crc32.reflect(i, 8) << 24
+        for j in range(8):
+            table[i] = ((table[i] << 1) ^ (Crc32.polynom if (table[i] & (1 << 31)) != 0 else 0)) & 0xFFFFFFFF
+        table[i] = Crc32.reflect(table[i], 32)
+    data_byte = b''
+
+    for i in data:
+        data_byte += Crc32.reflect(i, 32).to_bytes(4, byteorder='little')
+    for i in range(len(data_byte)):
+        crc_val = (crc_val >> 8) ^ table[((crc_val & 0xff) ^ data_byte[i])] & 0xFFFFFFFF
+
+    return Crc32.reflect(crc_val, 32)
+
+
+def legacy_calc_from_byte(data_buf, crc_val=0xFFFFFFFF):
+    """
+    Former implementation of Crc32.calc_from_byte
+    :param data_buf: Input data in bytearray format
+    :param crc_val: Initial value of crc
+    :return: Crc
+    """
+    crc_data = [0] * (len(data_buf) // 4)
+    for i in range(len(data_buf) // 4):
+        crc_data[i] = int.from_bytes(data_buf[i * 4:i * 4 + 4], byteorder='little', signed=False)
+    return legacy_calculate(crc_data, crc_val=crc_val)
+
+
+def table_calc_from_byte(data_buf, crc_val=0xFFFFFFFF):
+    """
+    CRC calculated by the table path, as without zlib
+    :param data_buf: Input data in bytearray format
+    :param crc_val: Initial value of crc
+    :return: Crc
+    """
+    zlib = Crc32.zlib
+    Crc32.zlib = None
+    try:
+        return Crc32.calc_from_byte(data_buf, crc_val)
+    finally:
+        Crc32.zlib = zlib
+
+
+def check_identical(cases=200):
+    """
+    Compare results of all implementations for random data, initial values and incremental updates
+    :param cases: Number of random cases
+    :return: Number of mismatches
+    """
+    errors = 0
+    for case in range(cases):
+        data = os.urandom(random.randint(0, 600))
+        crc_val = random.choice([0xFFFFFFFF, 0, random.getrandbits(32)])
+        expected = legacy_calc_from_byte(data, crc_val)
+        crc = Crc32.Crc32(crc_val)
+        off = 0
+        while off < len(data):
+            step = random.randint(1, 64)
+            crc.update(memoryview(data)[off:off + step])
+            off += step
+        words = [random.getrandbits(32) for i in range(case % 17)]
+        results = [Crc32.calc_from_byte(data, crc_val), table_calc_from_byte(data, crc_val), crc.digest()]
+        if any(result != expected for result in results) or \
+                Crc32.calculate(words, crc_val) != legacy_calculate(words, crc_val):
+            errors += 1
+    return errors
+
+
+def measure(func, data, repeat=3):
+    """
+    Measure the best time of CRC calculation
+    :param func: Function calculating CRC from bytes
+    :param data: Input data
+    :param repeat: Number of repetitions
+    :return: Time in seconds
+    """
+    return min(timeit.repeat(lambda: func(data), number=1, repeat=repeat))
+
+
+def run(sizes=(1 << 12, 1 << 16, 1 << 20)):
+    """
+    Benchmark all implementations, the legacy one is skipped for large data
+    :param sizes: Data sizes in bytes
+    :return: Dictionary {size: {implementation: time in seconds}}
+    """
+    funcs = {'legacy': legacy_calc_from_byte, 'table': table_calc_from_byte, 'zlib': Crc32.calc_from_byte}
+    ret = {}
+    for size in sizes:
+        data = os.urandom(size)
+        ret[size] = {name: measure(func, data) for name, func in funcs.items()
+                     if name != 'legacy' or size <= 1 << 16}
+    return ret
+
+
+if __name__ == "__main__":
+    mismatches = check_identical()
+    print(f"Identical results: {'yes' if mismatches == 0 else f'no, {mismatches} mismatches'}")
+    for size, times in run().items():
+        print(f"{size:>8} B: " + ", ".join(f"{name} {t * 1000:.2f} ms ({size / t / 1e6:.1f} MB/s)"
+                                           for name, t in times.items()))
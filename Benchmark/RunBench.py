@@ -0,0 +1,111 @@
+"""
+Benchmark suite, runs microbenchmarks (CpuBench) and end-to-end benchmarks (BusBench), writes results as json and
+compares them with stored baseline. Exit code is 1 if any result is worse than its baseline by more than tolerance.
+
+Run from repository root:
+    python -m Benchmark.RunBench --save-baseline        # store baseline of this machine
+    python -m Benchmark.RunBench --output results.json  # compare with the baseline
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+
+from Benchmark import BusBench, CpuBench
+
+"""
+Default baseline file, baselines are specific to the machine they are measured on
+"""
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Baseline.json')
+
+"""
+Direction of results by name suffix, results not listed are times (lower is better). Counts of requests, bytes
+and errors are deterministic and must not grow at all.
+"""
+HIGHER = ('transactions_per_s', 'bytes_per_s')
+EXACT = ('requests_per_cycle', 'bytes_per_cycle', 'wire_bytes', 'errors')
+
+"""
+Tail latencies are noisy, they are compared with double tolerance
+"""
+TAIL = ('_p99',)
+
+
+def run(tiers=('cpu', 'bus')):
+    """
+    Run benchmark tiers
+    :param tiers: Tiers to run ('cpu' - microbenchmarks, 'bus' - end-to-end)
+    :return: Report {'Meta': {...}, 'Results': {name: value}}
+    """
+    results = {}
+    if 'cpu' in tiers:
+        results.update(CpuBench.run())
+    if 'bus' in tiers:
+        results.update(BusBench.run())
+    meta = {'Date': datetime.now().isoformat(timespec='seconds'), 'Python': platform.python_version(),
+            'Platform': platform.platform(), 'Machine': platform.node()}
+    return {'Meta': meta, 'Results': results}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results with baseline
+    :param results: Dictionary {name: value}
+    :param baseline: Dictionary {name: value} of baseline
+    :param tolerance: Allowed relative degradation of times and rates
+    :return: List of tuples (name, baseline value, value, relative change, regression flag)
+    """
+    ret = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        change = (value - base) / base if base else 0.0 if value == base else float('inf')
+        if name.endswith(EXACT):
+            regression = value > base
+        elif name.endswith(HIGHER):
+            regression = change < -tolerance
+        else:
+            regression = change > (2 * tolerance if name.endswith(TAIL) else tolerance)
+        ret.append((name, base, value, change, regression))
+    return ret
+
+
+def main(argv=None):
+    """
+    Run benchmarks from command line
+    :param argv: Command line arguments
+    :return: Exit code, 1 on regression
+    """
+    parser = argparse.ArgumentParser(description='Visual Modbus benchmark suite')
+    parser.add_argument('--tier', choices=('cpu', 'bus', 'all'), default='all', help='benchmarks to run')
+    parser.add_argument('--output', help='json file for results')
+    parser.add_argument('--baseline', default=BASELINE, help='json file of baseline results')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative degradation')
+    args = parser.parse_args(argv)
+
+    report = run(('cpu', 'bus') if args.tier == 'all' else (args.tier,))
+    for name in (args.output, args.baseline if args.save_baseline else None):
+        if name is not None:
+            with open(name, 'w') as f:
+                json.dump(report, f, indent=2)
+    if args.save_baseline or not os.path.exists(args.baseline):
+        for name, value in report['Results'].items():
+            print(f"{name:<40} {value:12.6g}")
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = 0
+    for name, base, value, change, regression in compare(report['Results'], baseline['Results'], args.tolerance):
+        regressions += regression
+        print(f"{name:<40} {base:12.6g} {value:12.6g} {change:+8.1%}{'  REGRESSION' if regression else ''}")
+    print(f"{regressions} regressions against baseline of {baseline['Meta']['Date']} ({baseline['Meta']['Machine']})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,542 @@
+import asyncio
+import io
+import json
+import logging
+from contextvars import ContextVar
+from time import perf_counter
+
+from pymodbus.factory import ClientDecoder
+from pymodbus.register_read_message import ReadHoldingRegistersRequest, ReadInputRegistersRequest
+from pymodbus.register_write_message import WriteMultipleRegistersRequest
+from pymodbus.transaction import ModbusRtuFramer, ModbusSocketFramer
+
+from VisualModbus.MbPlanner import FrameModel
+from VisualModbus.MbRetry import BreakerTable
+from VisualModbus.MbTimeout import TimeoutTable
+from VisualModbus.MbTransport import ConnectionPool, enable_keepalive, get_method, get_name, RTU, TCP
+
+# Persistent TCP connections shared by all asynchronous clients
+_pool = ConnectionPool()
+
+
+class AsyncMbClient:
+    """
+    Class for asynchronous communication with modbus client on asyncio event loop.
+
+    Transactions of one client are serialized, multiple clients (buses) run concurrently on the same loop.
+    Modbus TCP connections are pooled and may pipeline more transactions (distinguished by transaction ID),
+    if "pipeline" in settings is greater than 1. The last response is kept per asyncio task, so concurrent
+    transactions of one client do not overwrite each other's result.
+
+    Frames are built and parsed by pymodbus framers, transport is implemented by asyncio directly, because
+    asynchronous clients of pymodbus 2.x do not run on Python 3.10 and newer.
+    """
+
+    def __init__(self):
+        """
+        Initialize all internal variables
+        """
+        self.errors = 0
+        self.transactions = 0
+        self._rr = ContextVar('rr', default=None)
+        self.comport = None
+        self.s = None
+        self.client = None
+        self.key = None
+        self.conn = None
+        self.generation = 0
+        self.silent_interval = 0
+        self.pipeline = 1
+        self.lock = None
+        self.timeouts = TimeoutTable()
+        self.breakers = BreakerTable()
+        self.log = logging.getLogger()
+
+    @property
+    def rr(self):
+        """
+        Last response of current task
+        :return: Response, None if there is no response
+        """
+        return self._rr.get()
+
+    @rr.setter
+    def rr(self, value):
+        """
+        Keep the last response of current task
+        :param value: Response
+        :return: None
+        """
+        self._rr.set(value)
+
+    async def open(self, settings=None):
+        """
+        Open com port or TCP connection with parameters given in JSON
+        :param settings: Json settings file
+        :return: True if connected, False on error
+        """
+        if settings is not None:
+            self.load_settings(settings)
+        method = get_method(self.s)
+        if method != RTU:
+            ret = await self._open_tcp(method)
+            if ret:
+                self.invalidate()
+            return ret
+        self._release()
+        # Lock must be created within running loop
+        self.lock = asyncio.Lock()
+        self.pipeline = 1
+        self.client = _AsyncClient(self.s, RTU)
+        self.silent_interval = FrameModel.from_settings(self.s).silent_interval * self.s['silent_interval']
+        # Connect to port
+        await self.client.connect()
+        if not self.is_open():
+            return False
+        self.invalidate()
+        self.log.warning('Port {0} opened asynchronously'.format(self.comport))
+        return True
+
+    async def _open_tcp(self, method):
+        """
+        Open pooled TCP connection (Modbus TCP or RTU over TCP), connection is shared with other clients of the same
+        host and port, kept alive and reconnected when lost.
+        :param method: TCP or RTU_OVER_TCP
+        :return: True if connected, False on error
+        """
+        key = (method, self.s['host'], self.s.get('port', 502))
+        if key != self.key:
+            self._release()
+            self.conn = _pool.acquire(key, lambda: _AsyncConnection(self.s, method))
+            self.client = self.conn.client
+            self.lock = self.conn.lock
+            self.pipeline = self.conn.pipeline
+            self.silent_interval = 0
+            self.key = key
+        # Clients sharing the connection must not connect twice
+        async with self.conn.open_lock:
+            if not self.is_open():
+                await self.client.connect()
+                if not self.is_open():
+                    return False
+                enable_keepalive(self.client.protocol.transport.get_extra_info('socket'), self.s.get('keep_alive', 30))
+                self.log.warning('Connection {0} ({1}) opened asynchronously'.format(self.comport, method))
+        return True
+
+    async def reconnect(self):
+        """
+        Connect again with the current settings after the port or connection was lost. Unlike open, values cached
+        by register maps stay valid, the devices are the same.
+        :return: True if connected, False on error
+        """
+        if self.client is None:
+            return await self.open()
+        if self.key is not None:
+            return await self._open_tcp(get_method(self.s))
+        await self.client.connect()
+        return self.is_open()
+
+    def invalidate(self):
+        """
+        Invalidate values cached by register maps of this client, e.g., after devices have restarted. Constant
+        registers are read again by prefetch.
+        :return: None
+        """
+        self.generation += 1
+
+    def _release(self):
+        """
+        Release pooled TCP connection, close it if it is not used by other client
+        :return: None
+        """
+        if self.key is not None:
+            conn = _pool.release(self.key)
+            if conn is not None:
+                conn.client.stop()
+            self.key = None
+            self.conn = None
+            self.client = None
+
+    def load_settings(self, settings):
+        """
+        Read communication settings without opening the port
+        :param settings: Json settings file
+        :return: None
+        """
+        with io.open(settings, 'r', encoding='utf-8-sig') as f:
+            self.s = json.load(f)
+        self.comport = get_name(self.s)
+        self.timeouts.load_settings(FrameModel.from_settings(self.s), self.s)
+        self.breakers.load_settings(self.s)
+
+    def close(self):
+        """
+        Close communication port
+        :return: None
+        """
+        self.log.warning('Port {} is closed now.'.format(self.comport))
+        if self.key is not None:
+            self._release()
+        elif self.client is not None:
+            self.client.stop()
+        self.invalidate()
+
+    def is_open(self):
+        """
+        Is communication port opened
+        :return: True if opened
+        """
+        return self.client is not None and self.client.protocol is not None
+
+    async def read(self, request):
+        """
+        Send read request to slave device, parse response and return register values
+        :param request: Request dictionary, such as {'Address': 50, 'Count': 5, 'Type': "INPUT", 'Slave': 1}
+        :return: Array of read register values on success
+        :return: None on read error
+        """
+        if not self.is_open():
+            self.log.warning('Port {} is not opened. Try to open the port first'.format(self.comport))
+            if self.s is None:
+                return None
+            if await self.reconnect() is False:
+                return None
+        if not self._allow(request):
+            return None
+        if request['Type'].lower() == 'Input'.lower():
+            return await self.read_input(request)
+        else:
+            return await self.read_hold(request)
+
+    async def read_input(self, request):
+        """
+        Send read Input register request to slave device, parse response and return register values
+        :param request: Request dictionary, such as {'Address': 50, 'Count': 5, 'Type': "INPUT", 'Slave': 1}
+        :return: Array of read register values on success
+        :return: None on read error
+        """
+        self.rr = await self._transact(self.client.protocol.read_input_registers, request['Address'],
+                                       request['Count'], request)
+        if self.rr.isError():
+            self.log.error(str(self.rr) + str(request))
+            return None
+        else:
+            self.log.info('Read input registers from slave {} at address {}, count {}.'
+                          .format(request['Slave'], request['Address'], request['Count']))
+            return self.rr.registers
+
+    async def read_hold(self, request):
+        """
+        Send read Holding register request to slave device, parse response and return register values
+        :param request: Request dictionary, such as {'Address': 50, 'Count': 5, 'Type': "INPUT", 'Slave': 1}
+        :return: Array of read register values on success
+        :return: None on read error
+        """
+        self.rr = await self._transact(self.client.protocol.read_holding_registers, request['Address'],
+                                       request['Count'], request)
+        if self.rr.isError():
+            self.log.error(str(self.rr) + str(request))
+            return None
+        else:
+            self.log.info('Read holding registers from slave {} at address {}, count {}.'
+                          .format(request['Slave'], request['Address'], request['Count']))
+            return self.rr.registers
+
+    async def write_hold(self, request):
+        """
+        Send write holding register request to slave device and verify response
+        :param request: Request dictionary, such as 'Address': 50, 'Values': [10, 11, 12], 'Type': "HOLD", 'Slave': 1
+        :return: 0 on success
+        :return: None on fail
+        """
+        if not self.is_open():
+            self.log.warning('Port {} is not opened. Try to open the port first'.format(self.comport))
+            if self.s is None:
+                return None
+            if await self.reconnect() is False:
+                return None
+        if not self._allow(request):
+            return None
+        self.rr = await self._transact(self.client.protocol.write_registers, request['Address'],
+                                       request['Values'], request)
+        if self.rr.isError():
+            self.log.error(str(self.rr) + str(request))
+            return None
+        else:
+            self.log.info('Write holding registers to slave {} at address {}, count {}.'
+                          .format(request['Slave'], request['Address'], request['Count']))
+            return 0
+
+    def last_exception(self):
+        """
+        Return modbus exception code of the last response
+        :return: Exception code, such as MbClient.ILLEGAL_ADDRESS
+        :return: None if the last response was not a modbus exception
+        """
+        return getattr(self.rr, 'exception_code', None)
+
+    def retryable(self, slave):
+        """
+        Is it worth to retry the last failed transaction with slave. Modbus exception would be returned again and
+        slave with open circuit breaker is not accessed at all.
+        :param slave: Slave address
+        :return: True if the transaction may be retried
+        """
+        return self.last_exception() is None and not self.breakers.is_open(slave)
+
+    def get_breaker_stats(self):
+        """
+        Return state of circuit breakers per slave
+        :return: Dictionary {slave: {'State', 'Failures', 'Trips'}}
+        """
+        return self.breakers.get_stats()
+
+    def get_timeout_stats(self):
+        """
+        Return response time statistics and current adaptive timeouts per slave
+        :return: Dictionary {slave: {'Samples', 'Timeouts', 'SRTT', 'RTTVAR', 'MinRtt', 'MaxRtt', 'Timeout'}}
+        """
+        return self.timeouts.get_stats()
+
+    def _allow(self, request):
+        """
+        Check circuit breaker of slave before transaction
+        :param request: Request dictionary
+        :return: True if the transaction may be sent
+        :return: False if the slave is skipped
+        """
+        if self.breakers.allow(request['Slave']):
+            return True
+        self.rr = None
+        self.log.debug('Slave {} skipped, circuit breaker is open'.format(request['Slave']))
+        return False
+
+    async def _transact(self, function, address, data, request):
+        """
+        Run one transaction exclusively on the bus with adaptive timeout of the slave
+        :param function: Protocol function (read_input_registers, read_holding_registers, write_registers)
+        :param address: Register address
+        :param data: Count of registers or list of values
+        :param request: Request dictionary
+        :return: Response or exception
+        """
+        slave = request['Slave']
+        async with self.lock:
+            self.transactions += 1
+            try:
+                start = perf_counter()
+                rr = await asyncio.wait_for(function(address, data, unit=slave),
+                                            self.timeouts.timeout(slave, request['Count']))
+                self.timeouts.update(slave, perf_counter() - start, request['Count'])
+                self.breakers.success(slave)
+                return rr
+            except Exception as e:
+                self.timeouts.expired(slave)
+                if self.breakers.failure(slave):
+                    self.log.warning('Slave {} does not respond, skipped for {} s'.format(slave,
+                                                                                        self.breakers.reset_timeout))
+                # Forget partially received frame, its rest would be joined with the next response
+                if self.client.protocol is not None and self.pipeline == 1:
+                    self.client.protocol.framer.resetFrame()
+                return _ErrorResponse(e)
+            finally:
+                if self.silent_interval:
+                    await asyncio.sleep(self.silent_interval)
+
+
+class _AsyncConnection:
+    """
+    Pooled asynchronous TCP connection
+    """
+
+    def __init__(self, settings, method):
+        """
+        Create TCP client, the connection is opened later
+        :param settings: Dictionary of communication settings
+        :param method: TCP or RTU_OVER_TCP
+        """
+        # RTU frames have no transaction ID, so they cannot be pipelined
+        self.pipeline = max(1, settings.get('pipeline', 1)) if method == TCP else 1
+        self.client = _AsyncClient(settings, method)
+        self.lock = asyncio.Lock() if self.pipeline == 1 else asyncio.Semaphore(self.pipeline)
+        self.open_lock = asyncio.Lock()
+
+
+class _AsyncClient:
+    """
+    Asynchronous connection to COM port (RTU) or TCP host (Modbus TCP, RTU over TCP)
+    """
+
+    def __init__(self, settings, method):
+        """
+        Create client, the connection is opened later
+        :param settings: Dictionary of communication settings
+        :param method: RTU, TCP or RTU_OVER_TCP
+        """
+        self.s = settings
+        self.method = method
+        self.framer = ModbusSocketFramer(ClientDecoder()) if method == TCP else ModbusRtuFramer(ClientDecoder())
+        self.protocol = None
+        self.log = logging.getLogger()
+
+    async def connect(self):
+        """
+        Open the connection, protocol stays None on error
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if self.method == RTU:
+                # Imported on demand, it is needed by serial lines only
+                import serial_asyncio
+                transport, protocol = await serial_asyncio.create_serial_connection(
+                    loop, lambda: _ClientProtocol(self), self.s['comport'], baudrate=self.s['baud_rate'],
+                    parity=self.s['parity'], stopbits=self.s['stop_bits'])
+            else:
+                transport, protocol = await asyncio.wait_for(
+                    loop.create_connection(lambda: _ClientProtocol(self), self.s['host'], self.s.get('port', 502)),
+                    self.s.get('max_timeout', self.s['timeout']))
+        except Exception as e:
+            self.log.error('Connection failed: {!r}'.format(e))
+            return
+        # Serial transport reports connection_made on the next loop iteration
+        protocol.transport = transport
+        self.protocol = protocol
+
+    def stop(self):
+        """
+        Close the connection
+        :return: None
+        """
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
+
+
+class _ClientProtocol(asyncio.Protocol):
+    """
+    Modbus client protocol, responses are matched to requests by transaction ID (unit ID of RTU frames), so more
+    transactions may be outstanding on Modbus TCP connection
+    """
+
+    def __init__(self, client):
+        """
+        Initialize protocol of client
+        :param client: _AsyncClient
+        """
+        self.client = client
+        self.framer = client.framer
+        self.transport = None
+        self.futures = {}
+        self.tid = 0
+
+    def connection_made(self, transport):
+        """
+        Connection opened
+        :param transport: asyncio transport
+        :return: None
+        """
+        self.transport = transport
+        self.framer.resetFrame()
+        self.client.protocol = self
+
+    def connection_lost(self, exc):
+        """
+        Connection closed, pending transactions fail
+        :param exc: Exception or None
+        :return: None
+        """
+        if self.client.protocol is self:
+            self.client.protocol = None
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection lost'))
+        self.futures.clear()
+
+    def data_received(self, data):
+        """
+        Process all received frames
+        :param data: Received data
+        :return: None
+        """
+        self.framer.processIncomingPacket(data, self._handle_response, unit=0, single=True)
+
+    def _handle_response(self, reply, **kwargs):
+        """
+        Resolve transaction of received response
+        :param reply: Decoded response
+        :return: None
+        """
+        future = self.futures.pop(reply.transaction_id, None)
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    def execute(self, request):
+        """
+        Send request
+        :param request: pymodbus request
+        :return: Future of response
+        """
+        self.tid = self.tid % 0xFFFF + 1
+        request.transaction_id = self.tid
+        packet = self.framer.buildPacket(request)
+        tid = request.transaction_id
+        future = asyncio.get_running_loop().create_future()
+        # Transactions cancelled by timeout are forgotten, late response is then dropped
+        future.add_done_callback(lambda f: self.futures.pop(tid) if self.futures.get(tid) is f else None)
+        self.futures[tid] = future
+        self.transport.write(packet)
+        return future
+
+    def read_input_registers(self, address, count, unit):
+        """
+        Read input registers
+        :param address: Register address
+        :param count: Number of registers
+        :param unit: Slave address
+        :return: Future of response
+        """
+        return self.execute(ReadInputRegistersRequest(address, count, unit=unit))
+
+    def read_holding_registers(self, address, count, unit):
+        """
+        Read holding registers
+        :param address: Register address
+        :param count: Number of registers
+        :param unit: Slave address
+        :return: Future of response
+        """
+        return self.execute(ReadHoldingRegistersRequest(address, count, unit=unit))
+
+    def write_registers(self, address, values, unit):
+        """
+        Write holding registers
+        :param address: Register address
+        :param values: List of register values
+        :param unit: Slave address
+        :return: Future of response
+        """
+        return self.execute(WriteMultipleRegistersRequest(address, values, unit=unit))
+
+
+class _ErrorResponse:
+    """
+    Response substitute of transaction that raised exception (timeout, lost connection)
+    """
+
+    def __init__(self, error):
+        """
+        Keep the raised exception
+        :param error: Exception
+        """
+        self.error = error
+
+    def isError(self):
+        """
+        Response is always error
+        :return: True
+        """
+        return True
+
+    def __str__(self):
+        return 'Transaction failed: {!r} '.format(self.error)
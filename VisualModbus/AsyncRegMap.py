@@ -0,0 +1,147 @@
+import asyncio
+
+from VisualModbus.RegMap import RegMap, READ, SLEEP, _writable
+
+
+class AsyncRegMap(RegMap):
+    """
+    Modbus register map class with awaitable communication methods for AsyncMbClient.
+
+    Register map loading, planning, decoding and the communication core are shared with RegMap, only operations
+    yielded by the core are awaited. Requests are kept in local variables of the core, so more coroutines may use
+    the same map concurrently.
+    """
+
+    async def from_visual(self, values, suffix):
+        """
+        Write registers whose value changed in visual interface
+        :param values: Dictionary of values in visual
+        :param suffix: Suffix for HEX values
+        :return: 0 on write success
+        :return: None on write error
+        """
+        return await self._run_async(self._send_write_io(self._write_requests(self._visual_changes(values, suffix))))
+
+    async def read_in(self):
+        """
+        Read all input registers and keep result in internal collection of registers
+        :return: 0 on read success
+        :return: None on read error
+        """
+        return await self._run_async(self._send_read_io(self._range_requests('Input', self.input_a)))
+
+    async def read_hold(self):
+        """
+        Read all holding registers and keep result in internal collection of registers
+        :return: 0 on read success
+        :return: None on read error
+        """
+        return await self._run_async(self._send_read_io(self._range_requests('Holding', self.hold_a)))
+
+    async def read_regs(self, regs):
+        """
+        Read given registers using the minimal number of requests
+        :param regs: List of registers
+        :return: 0 on read success
+        :return: None on read error
+        """
+        return await self._run_async(self._send_read_io(self._regs_requests(regs)))
+
+    async def write_hold(self):
+        """
+        Write all writable holding registers using their current values
+        :return: 0 on write success
+        :return: None on write error
+        """
+        return await self._run_async(self._send_write_io(self._write_requests([reg for reg in self.hold
+                                                                               if _writable(reg)])))
+
+    async def read_by_name(self, name, max_age=None):
+        """
+        Read register identified by name, see RegMap.read_by_name
+        :param name: Register name
+        :param max_age: Maximal age of cached value in seconds, None to read always
+        :return: Register value on read success
+        :return: None on read error
+        """
+        return await self._run_async(self._read_by_name_io(name, max_age))
+
+    async def write_by_name(self, name, value):
+        """
+        Write register identified by name
+        :param name: Register name
+        :param value: Register value
+        :return: 0 on write success
+        :return: None on write error
+        """
+        return await self._run_async(self._write_by_name_io(name, value))
+
+    async def write_multi_name(self, name, values):
+        """
+        Write multiple registers in a row, see RegMap.write_multi_name
+        :param name: Name of the first register (should end with _1)
+        :param values: List of values to write to consecutive registers
+        :return: List of results per register (0 on write success, None on write error)
+        """
+        return await self._run_async(self._write_multi_name_io(name, values))
+
+    async def read_multi_name(self, name, count):
+        """
+        Read multiple registers in a row, see RegMap.read_multi_name
+        :param name: Name of the first register (should end with _1)
+        :param count: Number of registers to read
+        :return: List of read values (None on read error of the register)
+        """
+        return await self._run_async(self._read_multi_name_io(name, count))
+
+    async def read_many(self, names, max_age=None):
+        """
+        Read registers given by names using the minimal number of requests, see RegMap.read_many
+        :param names: List of register names
+        :param max_age: Maximal age of cached value in seconds, None to read always
+        :return: Dictionary {name: value}, value is None on read error of the register
+        """
+        return await self._run_async(self._read_many_io(names, max_age))
+
+    async def write_many(self, values):
+        """
+        Write registers given by names using the minimal number of requests, see RegMap.write_many
+        :param values: Dictionary {name: value}
+        :return: Dictionary {name: result}, result is 0 on write success, None on write error
+        """
+        return await self._run_async(self._write_many_io(values))
+
+    async def prefetch(self):
+        """
+        Read all constant registers not cached yet, should be called after connect
+        :return: 0 on read success
+        :return: None on read error
+        """
+        return await self._run_async(self._prefetch_io())
+
+    async def reopen(self):
+        """
+        Reopen client port if closed
+        :return: None
+        """
+        if not self.mb.is_open():
+            await self.mb.reconnect()
+
+    async def _run_async(self, io):
+        """
+        Await operations of communication core on asynchronous client
+        :param io: Generator of operations
+        :return: Result of the generator
+        """
+        try:
+            op, arg = next(io)
+            while True:
+                if op == SLEEP:
+                    await asyncio.sleep(arg)
+                    ret = None
+                else:
+                    ret = await (self.mb.read(arg) if op == READ else self.mb.write_hold(arg))
+                    ret = (ret, None if ret is not None else self.mb.last_exception())
+                op, arg = io.send(ret)
+        except StopIteration as stop:
+            return stop.value
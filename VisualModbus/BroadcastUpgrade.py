@@ -0,0 +1,170 @@
+import logging
+from time import monotonic, sleep
+
+from VisualModbus.MbUpgrade import MbUpgrade, UpgradeImage
+
+"""
+Results of slave upgrade in report
+"""
+UPDATED = 'Updated'
+SKIPPED = 'Skipped'
+FAILED = 'Failed'
+
+
+class BroadcastUpgrade:
+    """
+    Firmware upgrade of identical devices on one bus by broadcast.
+
+    Header and pages are written to all devices at once by broadcast (slave address 0), then the status of every
+    device is read individually. Pages not committed by a device are sent again to the device only, by unicast.
+    Devices that keep written registers readable confirm every page by read back ("confirm_readback"), otherwise a
+    missed page is found only by verification of the whole application.
+    Devices that have missed the header or fail verification of application CRC are upgraded again by unicast.
+    Broadcast header makes all devices on the bus start the upgrade, so all of them must be given and run the same
+    application. They are all flashed if at least two of them differ from the image, otherwise the differing
+    device is upgraded by unicast. Every device must have register map with application CRC and verification
+    enabled, devices are upgraded by unicast otherwise.
+    """
+
+    def __init__(self, settings, mb, slaves, regs=None):
+        """
+        Initialize upgrade of slaves
+        :param settings: Json upgrade settings file, common for all slaves
+        :param mb: MbClient object
+        :param slaves: List of slave addresses
+        :param regs: Dictionary {slave: RegMap} with application CRC and size, None to flash always without verification
+        """
+        regs = {} if regs is None else regs
+        self.all = MbUpgrade(settings, mb, 0)
+        self.upgrades = {slave: MbUpgrade(settings, mb, slave, regs.get(slave)) for slave in slaves}
+        self.report = {}
+        self.mb = mb
+        self.log = logging.getLogger()
+
+    def load_file(self, file_name):
+        """
+        Open firmware binary file, the image is shared by all slaves
+        :param file_name: Firmware filename
+        :return: None
+        """
+        self.close()
+        image = UpgradeImage(file_name, self.all.align, self.all.LEN_UPG_PAGE)
+        for upg in [self.all] + list(self.upgrades.values()):
+            upg.set_image(image)
+        self.log.info('Bin file {0} opened. Size {1} bytes, {2} pages'.format(file_name, image.length, image.size))
+
+    def run_upgrade(self, progress_clb=None):
+        """
+        Run upgrade procedure of all slaves. Progress callback is called after every broadcast page.
+        :param progress_clb: Progress callback
+        :return: 0 on success
+        :return: Number of failed slaves on error
+        """
+        self.report = {slave: {'Result': SKIPPED, 'Resent': 0, 'Unicast': False} for slave in self.upgrades}
+        # Broadcast is not acknowledged, only verification proves that a device has the whole image
+        if not all(upg.can_verify() for upg in self.upgrades.values()):
+            self.log.error('Broadcast refused, every device needs register map with application CRC and verify')
+            return self._unicast(list(self.upgrades.values()), [])
+        targets = [upg for upg in self.upgrades.values() if not (upg.skip_identical and upg.check_image())]
+        if len(targets) < 2:
+            return self._unicast(targets, [])
+        # Devices already running the image would be erased by broadcast header as well
+        targets = list(self.upgrades.values())
+        # Flash erase and programming delays responses, use configured timeout instead of adaptive one
+        adaptive = self.mb.timeouts.enabled
+        self.mb.timeouts.enabled = False
+        receivers, unicast = self._broadcast_pages(targets, progress_clb)
+        # Pages missed by a device are sent again to the device, it is upgraded by unicast if that fails
+        for upg, missed in receivers.items():
+            self.report[upg.slave]['Resent'] = len(missed)
+            if not all(self._resend(upg, page) for page in missed):
+                unicast.append(upg)
+        applied = [upg for upg in receivers if upg not in unicast]
+        for upg in applied:
+            # Device restarts with new firmware and values read before are not valid anymore
+            self.mb.write_hold(upg.request_apply())
+            self.report[upg.slave]['Result'] = UPDATED
+        self.mb.invalidate()
+        self.mb.timeouts.enabled = adaptive
+        verify = [upg for upg in applied if upg.verify and upg.regs is not None]
+        if len(verify):
+            sleep(self.all.verify_delay)
+        for upg in verify:
+            if not upg.verify_retry.call(lambda: upg.check_image() or None):
+                self.log.error('Verification of slave {} failed, CRC of application does not match'.format(upg.slave))
+                unicast.append(upg)
+        return self._unicast(unicast, verify)
+
+    def close(self):
+        """
+        Close firmware image shared by all slaves
+        :return: None
+        """
+        if self.all.image is not None:
+            self.all.image.close()
+
+    def get_report(self):
+        """
+        Return result of the last upgrade per slave
+        :return: Dictionary {slave: {'Result', 'Resent', 'Unicast'}}
+        """
+        return self.report
+
+    def _unicast(self, targets, failed):
+        """
+        Upgrade devices one by one by unicast
+        :param targets: List of MbUpgrade of devices to upgrade
+        :param failed: List of MbUpgrade of devices whose previous upgrade has failed, they are not compared with image
+        :return: Number of failed slaves
+        """
+        for upg in targets:
+            self.log.warning('Slave {} is upgraded by unicast'.format(upg.slave))
+            skip_identical = upg.skip_identical
+            upg.skip_identical = upg.skip_identical and upg not in failed
+            errors = upg.run_upgrade()
+            upg.skip_identical = skip_identical
+            self.report[upg.slave].update({'Result': FAILED if errors else SKIPPED if upg.skipped else UPDATED,
+                                           'Unicast': True})
+        return sum(1 for report in self.report.values() if report['Result'] == FAILED)
+
+    def _broadcast_pages(self, targets, progress_clb):
+        """
+        Broadcast header and pages, read status of every device after every page and confirm that the device
+        has received the page
+        :param targets: List of MbUpgrade of devices to upgrade
+        :param progress_clb: Progress callback
+        :return: Tuple of dictionary {MbUpgrade: [indexes of missed pages]} of devices receiving pages and list of
+        devices that have missed the header
+        """
+        receivers = {}
+        unicast = []
+        if self.mb.broadcast(self.all.header) is not None:
+            sleep(self.all.init_delay)
+        sent = monotonic()
+        for upg in targets:
+            upg.sent = sent
+            if upg.wait_ready(False) is None or not upg.confirm(upg.header):
+                unicast.append(upg)
+            else:
+                receivers[upg] = []
+        for page, request in enumerate(self.all.page_requests()):
+            ret = self.mb.broadcast(request)
+            sent = monotonic()
+            for upg, missed in receivers.items():
+                upg.sent = sent
+                if ret is None or upg.wait_ready() is None or not upg.confirm(request):
+                    missed.append(page)
+            if progress_clb is not None:
+                progress_clb(page + 1, self.all.size)
+        return receivers, unicast
+
+    def _resend(self, upg, page):
+        """
+        Send page to one device by unicast
+        :param upg: MbUpgrade of the device
+        :param page: Index of page
+        :return: True if the device has committed the page
+        """
+        upg.request = next(upg.page_requests(page))
+        upg.send()
+        return upg.response is not None and upg.wait_ready() is not None and upg.confirm(upg.request)
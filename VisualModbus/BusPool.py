@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+
+from VisualModbus.AsyncMbClient import AsyncMbClient
+from VisualModbus.AsyncRegMap import AsyncRegMap
+
+
+class BusPool:
+    """
+    Pool of modbus buses polled in parallel.
+
+    Every bus (COM port or TCP gateway) has its own AsyncMbClient and one worker that polls the slaves assigned to
+    the bus one after another. Workers of all buses run concurrently on one event loop, which is owned by the pool,
+    so connections opened by one poll are reused by the next one.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty pool
+        """
+        self.buses = {}
+        self.slaves = {}
+        self.stats = {}
+        self.loop = None
+        self.log = logging.getLogger()
+
+    def add_bus(self, settings):
+        """
+        Add bus described by communication settings file, ValueError is raised if the bus has been added already
+        :param settings: Json settings file (ComSettings.json)
+        :return: Name of the bus (COM port name or host:port)
+        """
+        mb = AsyncMbClient()
+        mb.load_settings(settings)
+        name = mb.comport
+        # Replaced client would keep its connection open and its slaves would be lost
+        if name in self.buses:
+            raise ValueError('Bus {} has been added already'.format(name))
+        self.buses[name] = mb
+        self.slaves[name] = []
+        self.stats[name] = _new_stats()
+        return name
+
+    def add_slave(self, bus, slave, reg_map, attempts=2, delay=0.5):
+        """
+        Assign slave device to the bus
+        :param bus: Name of the bus returned by add_bus
+        :param slave: Slave address
+        :param reg_map: Json register map file
+        :param attempts: Number of communication attempts
+        :param delay: Delay between communication retries in seconds
+        :return: AsyncRegMap of the slave
+        """
+        regs = AsyncRegMap(self.buses[bus], slave, attempts, delay)
+        regs.load(reg_map)
+        # Subscribers are notified once per poll cycle
+        regs.auto_notify = False
+        self.slaves[bus].append(regs)
+        return regs
+
+    def poll(self, cycles=1, period=0.0, hold=True):
+        """
+        Poll all slaves on all buses, blocks until finished
+        :param cycles: Number of poll cycles
+        :param period: Minimal period of poll cycle in seconds
+        :param hold: Read holding registers as well
+        :return: Tuple of merged results {(bus, slave): {name: value}} and statistics of this call {bus: {...}}
+        """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(self.poll_async(cycles, period, hold))
+
+    async def poll_async(self, cycles=1, period=0.0, hold=True):
+        """
+        Poll all slaves on all buses, one worker per bus
+        :param cycles: Number of poll cycles
+        :param period: Minimal period of poll cycle in seconds
+        :param hold: Read holding registers as well
+        :return: Tuple of merged results {(bus, slave): {name: value}} and statistics of this call {bus: {...}}
+        """
+        stats = {bus: _new_stats() for bus in self.buses}
+        await asyncio.gather(*(self._worker(bus, cycles, period, hold, stats[bus]) for bus in self.buses))
+        results = {}
+        for bus in self.slaves:
+            for regs in self.slaves[bus]:
+                results[(bus, regs.slave)] = {reg['Name']: reg['Value'] for reg in regs.input + regs.hold}
+            total = self.stats[bus]
+            for name, value in stats[bus].items():
+                total[name] = max(total[name], value) if name == 'max_cycle' else total[name] + value
+        return results, stats
+
+    def get_stats(self):
+        """
+        Return statistics accumulated by all polls since creation or the last reset
+        :return: Dictionary {bus: {'cycles', 'transactions', 'errors', 'time', 'max_cycle'}}
+        """
+        return self.stats
+
+    def reset_stats(self):
+        """
+        Clear accumulated statistics of all buses
+        :return: None
+        """
+        for bus in self.stats:
+            self.stats[bus] = _new_stats()
+
+    def close(self):
+        """
+        Close all buses and the event loop of the pool
+        :return: None
+        """
+        for mb in self.buses.values():
+            mb.close()
+        if self.loop is not None:
+            # Let transports finish closing
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+            self.loop = None
+
+    async def _worker(self, bus, cycles, period, hold, stats):
+        """
+        Poll all slaves of one bus
+        :param bus: Name of the bus
+        :param cycles: Number of poll cycles
+        :param period: Minimal period of poll cycle in seconds
+        :param hold: Read holding registers as well
+        :param stats: Statistics of the bus to update
+        :return: None
+        """
+        mb = self.buses[bus]
+        if not mb.is_open() and await mb.open() is False:
+            stats['errors'] += cycles * len(self.slaves[bus])
+            return
+        for cycle in range(cycles):
+            start = time.perf_counter()
+            transactions = mb.transactions
+            for regs in self.slaves[bus]:
+                ret = await regs.read_in()
+                if ret is not None and hold:
+                    ret = await regs.read_hold()
+                if ret is None:
+                    stats['errors'] += 1
+                regs.notify()
+            elapsed = time.perf_counter() - start
+            stats['cycles'] += 1
+            stats['transactions'] += mb.transactions - transactions
+            stats['time'] += elapsed
+            stats['max_cycle'] = max(stats['max_cycle'], elapsed)
+            if elapsed < period and cycle + 1 < cycles:
+                await asyncio.sleep(period - elapsed)
+
+
+def _new_stats():
+    """
+    Create empty statistics of one bus
+    :return: Dictionary of statistics
+    """
+    return {'cycles': 0, 'transactions': 0, 'errors': 0, 'time': 0.0, 'max_cycle': 0.0}
@@ -1,9 +1,20 @@
+import sys
+from array import array
+try:
+    import zlib
+except ImportError:
+    zlib = None
 
 """
 Standard Ethernet CRC 32 polynom
 """
 polynom = 0x04C11DB7
 
+"""
+Array type code of 32-bit word
+"""
+_WORD = next(code for code in 'IL' if array(code).itemsize == 4)
+
 
 def reflect(value_input, bits):
     """
@@ -21,6 +32,77 @@ def reflect(value_input, bits):
     return value
 
 
+def _make_table():
+    """
+    Create table of reflected CRC for every byte value
+    :return: List of 256 integers
+    """
+    table = [0] * 256
+    for i in range(256):
+        table[i] = reflect(i, 8) << 24
+        for j in range(8):
+            table[i] = ((table[i] << 1) ^ (polynom if (table[i] & (1 << 31)) != 0 else 0)) & 0xFFFFFFFF
+        table[i] = reflect(table[i], 32)
+    return table
+
+
+"""
+Reflected CRC table and bit reflection of bytes, computed once
+"""
+TABLE = _make_table()
+REFLECTED_BYTES = bytes(reflect(i, 8) for i in range(256))
+
+
+class Crc32:
+    """
+    Incremental CRC32 of 32-bit little endian words, as computed by STM32 CRC unit.
+
+    Words are bit-reflected and processed by the reflected algorithm. The reflection is done for whole buffers
+    (byte translation and word byte swap), CRC itself is computed by zlib if available or by the table otherwise.
+    Bytes of incomplete word are kept until the next update and ignored by digest.
+    """
+
+    def __init__(self, crc_val=0xFFFFFFFF):
+        """
+        Initialize CRC
+        :param crc_val: Initial value of crc
+        """
+        self.crc_val = crc_val
+        self.pending = b''
+
+    def update(self, data):
+        """
+        Add data to CRC
+        :param data: Bytes-like object (bytes, bytearray, memoryview, mmap)
+        :return: self
+        """
+        if len(self.pending):
+            data = self.pending + bytes(data)
+        words = len(data) - len(data) % 4
+        self.pending = bytes(data[words:])
+        if words == 0:
+            return self
+        # Reflect all bits of every word: reflect bits of bytes and reverse bytes of words
+        buf = array(_WORD, bytes(data[:words]).translate(REFLECTED_BYTES))
+        buf.byteswap()
+        if zlib is not None:
+            # zlib inverts CRC value at start and end
+            self.crc_val = zlib.crc32(buf, self.crc_val ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+        else:
+            crc_val = self.crc_val
+            for byte in buf.tobytes():
+                crc_val = (crc_val >> 8) ^ TABLE[(crc_val & 0xff) ^ byte]
+            self.crc_val = crc_val
+        return self
+
+    def digest(self):
+        """
+        Get CRC of data added so far
+        :return: Crc
+        """
+        return reflect(self.crc_val, 32)
+
+
 def calc_from_byte(data_buf, crc_val=0xFFFFFFFF):
     """
     Calculate CRC32 from bytearray
@@ -28,10 +110,7 @@ def calc_from_byte(data_buf, crc_val=0xFFFFFFFF):
     :param crc_val: Initial value of crc
     :return: Crc
     """
-    crc_data = [0] * (len(data_buf) // 4)
-    for i in range(len(data_buf) // 4):
-        crc_data[i] = int.from_bytes(data_buf[i * 4:i * 4 + 4], byteorder='little', signed=False)
-    return calculate(crc_data, crc_val=crc_val)
+    return Crc32(crc_val).update(data_buf).digest()
 
 
 def calculate(data, crc_val=0xFFFFFFFF):
@@ -41,18 +120,7 @@ def calculate(data, crc_val=0xFFFFFFFF):
     :param crc_val: Initial value of crc
     :return: Crc
     """
-    table = [0] * 256
-
-    for i in range(256):
-        table[i] = reflect(i, 8) << 24
-        for j in range(8):
-            table[i] = ((table[i] << 1) ^ (polynom if (table[i] & (1 << 31)) != 0 else 0)) & 0xFFFFFFFF
-        table[i] = reflect(table[i], 32)
-    data_byte = b''
-
-    for i in data:
-        data_byte += reflect(i, 32).to_bytes(4, byteorder='little')
-    for i in range(len(data_byte)):
-        crc_val = (crc_val >> 8) ^ table[((crc_val & 0xff) ^ data_byte[i])] & 0xFFFFFFFF
-
-    return reflect(crc_val, 32)
+    words = array(_WORD, data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return calc_from_byte(words.tobytes(), crc_val=crc_val)
@@ -0,0 +1,200 @@
+import io
+import json
+import logging
+import threading
+from time import perf_counter
+
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbTransport import get_name
+from VisualModbus.MbUpgrade import MbUpgrade, UpgradeImage
+from VisualModbus.RegMap import RegMap
+
+"""
+Results of target upgrade in report
+"""
+PENDING = 'Pending'
+UPDATED = 'Updated'
+SKIPPED = 'Skipped'
+FAILED = 'Failed'
+
+
+class FleetUpgrade:
+    """
+    Firmware upgrade of many slaves on many buses.
+
+    Every bus (COM port or TCP gateway) has its own MbClient and one thread that flashes the targets of the bus,
+    threads of all buses run in parallel. Targets of one bus are flashed one after another, or interleaved page by
+    page, so the page commit time of one slave is used to send page to the others. Every image is opened once,
+    its page frames and CRC are shared by all targets flashed by the image.
+    """
+
+    def __init__(self, settings, interleave=False):
+        """
+        Initialize empty fleet
+        :param settings: Json upgrade settings file (UpgradeSettings.json), common for all targets
+        :param interleave: True to interleave targets of one bus page by page
+        """
+        self.settings = settings
+        self.interleave = interleave
+        self.buses = {}
+        self.targets = {}
+        self.images = {}
+        self.progress_clb = None
+        self.lock = threading.Lock()
+        self.log = logging.getLogger()
+
+    def add_bus(self, settings):
+        """
+        Add bus described by communication settings file, it is opened by run. ValueError is raised if the bus has been
+        added already.
+        :param settings: Json settings file (ComSettings.json)
+        :return: Name of the bus (COM port name or host:port)
+        """
+        mb = MbClient()
+        with io.open(settings, 'r', encoding='utf-8-sig') as f:
+            mb.s = json.load(f)
+        name = get_name(mb.s)
+        # Targets of the replaced client would be flashed by another thread over the same port
+        if name in self.buses:
+            raise ValueError('Bus {} has been added already'.format(name))
+        self.buses[name] = mb
+        return name
+
+    def add_target(self, bus, slave, file_name, reg_map=None):
+        """
+        Add slave to upgrade
+        :param bus: Name of the bus returned by add_bus
+        :param slave: Slave address
+        :param file_name: Firmware filename
+        :param reg_map: Json register map file with application CRC and size, None to flash always without verification
+        :return: MbUpgrade of the target
+        """
+        mb = self.buses[bus]
+        regs = None
+        if reg_map is not None:
+            regs = RegMap(mb, slave)
+            regs.load(reg_map)
+        upg = MbUpgrade(self.settings, mb, slave, regs)
+        if file_name not in self.images:
+            self.images[file_name] = UpgradeImage(file_name, upg.align, upg.LEN_UPG_PAGE, cache=True)
+        upg.set_image(self.images[file_name])
+        self.targets[(bus, slave)] = {'Upgrade': upg, 'Image': file_name, 'Result': PENDING, 'Errors': 0,
+                                      'Time': 0.0}
+        return upg
+
+    def run(self, progress_clb=None, resume=False):
+        """
+        Upgrade all targets, blocks until finished
+        :param progress_clb: Progress callback called with (bus, slave, progress, size) after every page
+        :param resume: True to upgrade only failed targets, from their checkpoints
+        :return: Report {(bus, slave): {'Image', 'Result', 'Errors', 'Progress', 'Size', 'Checkpoint', 'Time'}}
+        """
+        self.progress_clb = progress_clb
+        threads = [threading.Thread(target=self._worker, args=(bus, resume)) for bus in self.buses]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.get_report()
+
+    def get_report(self):
+        """
+        Return state of all targets
+        :return: Report {(bus, slave): {'Image', 'Result', 'Errors', 'Progress', 'Size', 'Checkpoint', 'Time'}}
+        """
+        ret = {}
+        for key, target in self.targets.items():
+            upg = target['Upgrade']
+            ret[key] = {'Image': target['Image'], 'Result': target['Result'], 'Errors': target['Errors'],
+                        'Progress': upg.progress, 'Size': upg.size, 'Checkpoint': upg.checkpoint,
+                        'Time': target['Time']}
+        return ret
+
+    def close(self):
+        """
+        Close all buses and images
+        :return: None
+        """
+        for mb in self.buses.values():
+            mb.close()
+        for image in self.images.values():
+            image.close()
+        self.images.clear()
+
+    def _worker(self, bus, resume):
+        """
+        Upgrade all targets of one bus
+        :param bus: Name of the bus
+        :param resume: True to upgrade only failed targets, from their checkpoints
+        :return: None
+        """
+        mb = self.buses[bus]
+        targets = [(key, target) for key, target in self.targets.items() if key[0] == bus and
+                   (target['Result'] == FAILED if resume else target['Result'] == PENDING)]
+        if len(targets) == 0:
+            return
+        # Connection of previous run is reused, serial port would be opened twice
+        if not mb.client.is_socket_open() and mb.open() is False:
+            for key, target in targets:
+                self._done(key, target, 1)
+            return
+        # Targets share the client, adaptive timeouts are restored when all of them are finished
+        adaptive = mb.timeouts.enabled
+        mb.timeouts.enabled = False
+        start = perf_counter()
+        if self.interleave:
+            active = []
+            for key, target in targets:
+                if target['Upgrade'].start(resume):
+                    active.append((key, target))
+                else:
+                    self._done(key, target, target['Upgrade'].errors, start)
+            while len(active):
+                for key, target in active:
+                    target['Upgrade'].send()
+                for key, target in active:
+                    target['Upgrade'].complete(self._progress(key))
+                for key, target in [(key, target) for key, target in active if target['Upgrade'].request is None]:
+                    active.remove((key, target))
+                    self._done(key, target, target['Upgrade'].finish(), start)
+        else:
+            for key, target in targets:
+                start = perf_counter()
+                self._done(key, target, target['Upgrade'].run_upgrade(self._progress(key), resume), start)
+        mb.timeouts.enabled = adaptive
+
+    def _progress(self, key):
+        """
+        Create progress callback of target
+        :param key: Tuple (bus, slave)
+        :return: Progress callback of MbUpgrade
+        """
+        if self.progress_clb is None:
+            return None
+        return lambda progress, size: self._call_progress(key, progress, size)
+
+    def _call_progress(self, key, progress, size):
+        """
+        Call progress callback of fleet, callbacks of bus threads are serialized
+        :param key: Tuple (bus, slave)
+        :param progress: Number of acknowledged pages
+        :param size: Number of pages
+        :return: None
+        """
+        with self.lock:
+            self.progress_clb(key[0], key[1], progress, size)
+
+    def _done(self, key, target, errors, start=None):
+        """
+        Record result of target
+        :param key: Tuple (bus, slave)
+        :param target: Target dictionary
+        :param errors: Number of errors
+        :param start: Start time of upgrade (perf_counter), None if it has not started
+        :return: None
+        """
+        target['Errors'] = errors
+        target['Result'] = FAILED if errors != 0 else SKIPPED if target['Upgrade'].skipped else UPDATED
+        if start is not None:
+            target['Time'] = perf_counter() - start
+        self.log.warning('Upgrade of slave {0} on {1}: {2}'.format(key[1], key[0], target['Result']))
@@ -5,10 +5,20 @@ VERSION_MAJOR = 0
 
 VERSION_MINOR = 1
 
-VERSION_BUILD = 8
+VERSION_BUILD = 9
 
 VERSION = "{}.{}.{}".format(VERSION_MAJOR, VERSION_MINOR, VERSION_BUILD)
 
+RELEASE_NOTE_10 = "2026/10/18 - 0.1.9 - \n"\
+                  " - Zápis změněných registrů sloučen do co nejmenšího počtu zpráv \n" \
+                  " - Write bez změny hodnot už neopakuje poslední zápis \n" \
+                  " - Po čtení se překreslují jen registry, jejichž hodnota se změnila \n" \
+                  " - Komunikace běží na pozadí, okno nezamrzá a registry se čtou periodicky po readout_period \n" \
+                  " - Status a okno logu se obnovují i bez událostí okna, vyžaduje PySimpleGUI 4.34 nebo novější \n" \
+                  " - Tabulka registrů je stránkovaná po skupinách, okno se otevírá rychle i s velkou mapou registrů \n" \
+                  " - Periodicky se čtou jen zobrazené a připnuté registry, ostatní po background_period \n" \
+                  " - Upgrade přeskočí zařízení se stejným firmware a po nahrání ověří CRC aplikace"
+
 RELEASE_NOTE_9 = "2020/01/31 - 0.1.8 - \n"\
                  " - Fix podpory čtení a zápisu stringů \n" \
                  " - Přidáno tlačítko Write All, které zapíše všechny holding registry"\
@@ -54,7 +64,7 @@ RELEASE_NOTE_1 = "2019/09/14 - 0.0.0 - \n" \
                  " - Prvni nedokonala verze"
 
 NOTES = [RELEASE_NOTE_1, RELEASE_NOTE_2, RELEASE_NOTE_3, RELEASE_NOTE_4, RELEASE_NOTE_5, RELEASE_NOTE_6,
-         RELEASE_NOTE_7, RELEASE_NOTE_8, RELEASE_NOTE_9]
+         RELEASE_NOTE_7, RELEASE_NOTE_8, RELEASE_NOTE_9, RELEASE_NOTE_10]
 
 
 def show_help():
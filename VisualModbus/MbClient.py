@@ -1,14 +1,30 @@
 import io
 import json
 import logging
+import threading
+from time import perf_counter, sleep
 
 from pymodbus.client.sync import ModbusSerialClient as ModbusClient
+from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.transaction import ModbusRtuFramer, ModbusSocketFramer
+
+from VisualModbus.MbPlanner import FrameModel
+from VisualModbus.MbRetry import BreakerTable
+from VisualModbus.MbTimeout import TimeoutTable
+from VisualModbus.MbTransport import ConnectionPool, enable_keepalive, get_method, get_name, RTU, RTU_OVER_TCP
+
+# Persistent TCP connections shared by all clients
+_pool = ConnectionPool()
 
 
 class MbClient:
     """
     Class for communication with modbus client
     """
+    # Modbus exception codes
+    ILLEGAL_FUNCTION = 1
+    ILLEGAL_ADDRESS = 2
+    ILLEGAL_VALUE = 3
 
     def __init__(self):
         """
@@ -18,12 +34,17 @@ class MbClient:
         self.rr = None
         self.comport = None
         self.s = None
+        self.key = None
+        self.generation = 0
+        self.timeouts = TimeoutTable()
+        self.breakers = BreakerTable()
         self.client = ModbusClient()
+        self.lock = threading.RLock()
         self.log = logging.getLogger()
 
     def open(self, settings=None):
         """
-        Open com port with parameters given in JSON
+        Open com port or TCP connection with parameters given in JSON
         :param settings: Json settings file
         :return: True if connected, False on error
         """
@@ -31,11 +52,17 @@ class MbClient:
         if settings is not None:
             with io.open(settings, 'r', encoding='utf-8-sig') as f:
                 self.s = json.load(f)
-        self.comport = self.s['comport']
+        self.comport = get_name(self.s)
+        self.timeouts.load_settings(FrameModel.from_settings(self.s), self.s)
+        self.breakers.load_settings(self.s)
+        if get_method(self.s) != RTU:
+            return self._open_tcp()
+        self._release()
         # Open port
+        # Port is not closed by pymodbus after missing response, receive buffer is cleared before every request
         self.client = ModbusClient(method='rtu', port=self.s['comport'], timeout=self.s['timeout'],
                                    baudrate=self.s['baud_rate'], parity=self.s['parity'],
-                                   stopbits=self.s['stop_bits'])
+                                   stopbits=self.s['stop_bits'], reset_socket=False)
         # Set additional timeout parameters
         self.client.inter_char_timeout *= self.s['inter_char_timeout']  # default 0.000859375
         if 'minimal_inter_char_timeout' in self.s:
@@ -47,17 +74,85 @@ class MbClient:
         # Connect to port
         ret = self.client.connect()
         if ret is True:
+            self.invalidate()
             self.log.warning('Port {0} opened at baud rate {1}, parity {2}, stop bits {3}'.format(
                 self.s['comport'], self.s['baud_rate'], self.s['parity'], self.s['stop_bits']))
         return ret
 
+    def _open_tcp(self):
+        """
+        Open pooled TCP connection (Modbus TCP or RTU over TCP), connection is shared with other clients of the same
+        host and port and kept alive.
+        :return: True if connected, False on error
+        """
+        method = get_method(self.s)
+        host = self.s['host']
+        port = self.s.get('port', 502)
+        key = (method, host, port)
+        if key != self.key:
+            self._release()
+            framer = ModbusRtuFramer if method == RTU_OVER_TCP else ModbusSocketFramer
+            # Shared connection is closed by its clients (_check_connection), not by pymodbus after each failure
+            self.client = _pool.acquire(key, lambda: ModbusTcpClient(host, port=port, framer=framer,
+                                                                    timeout=self.s['timeout'], reset_socket=False))
+            self.lock = _pool.get_lock(key)
+            self.key = key
+        # Connect or reconnect, the connection may be shared with other threads
+        with self.lock:
+            ret = self.client.connect()
+            if ret is True:
+                enable_keepalive(self.client.socket, self.s.get('keep_alive', 30))
+        if ret is True:
+            self.invalidate()
+            self.log.warning('Connection {0} ({1}) opened'.format(self.comport, method))
+        return ret
+
+    def reconnect(self):
+        """
+        Connect again with the current settings after the port or connection was lost. Unlike open, values cached
+        by register maps stay valid, the devices are the same.
+        :return: True if connected, False on error
+        """
+        with self.lock:
+            ret = self.client.connect()
+            if ret is True and self.key is not None:
+                enable_keepalive(self.client.socket, self.s.get('keep_alive', 30))
+        if ret is True:
+            self.log.warning('Port {} reconnected'.format(self.comport))
+        return ret
+
+    def invalidate(self):
+        """
+        Invalidate values cached by register maps of this client, e.g., after devices have restarted. Constant
+        registers are read again by prefetch.
+        :return: None
+        """
+        self.generation += 1
+
+    def _release(self):
+        """
+        Release pooled TCP connection, close it if it is not used by other client
+        :return: None
+        """
+        if self.key is not None:
+            client = _pool.release(self.key)
+            if client is not None:
+                client.close()
+            self.key = None
+            self.client = ModbusClient()
+            self.lock = threading.RLock()
+
     def close(self):
         """
         Close communication port
         :return: None
         """
         self.log.warning('Port {} is closed now.'.format(self.comport))
-        self.client.close()
+        if self.key is not None:
+            self._release()
+        else:
+            self.client.close()
+        self.invalidate()
 
     def read(self, request):
         """
@@ -70,8 +165,10 @@ class MbClient:
             self.log.warning('Port {} is not opened. Try to open the port first'.format(self.comport))
             if self.comport is None:
                 return None
-            if self.open() is False:
+            if self.reconnect() is False:
                 return None
+        if not self._allow(request):
+            return None
         if request['Type'].lower() == 'Input'.lower():
             return self.read_input(request)
         else:
@@ -84,9 +181,10 @@ class MbClient:
         :return: Array of read register values on success
         :return: None on read error
         """
-        self.rr = self.client.read_input_registers(request['Address'], request['Count'], unit=request['Slave'])
+        self.rr = self._execute(self.client.read_input_registers, request['Address'], request['Count'], request)
         if self.rr.isError():
             self.log.error(str(self.rr) + str(request))
+            self._check_connection()
             return None
         else:
             self.log.info('Read input registers from slave {} at address {}, count {}.'
@@ -100,9 +198,10 @@ class MbClient:
         :return: Array of read register values on success
         :return: None on read error
         """
-        self.rr = self.client.read_holding_registers(request['Address'], request['Count'], unit=request['Slave'])
+        self.rr = self._execute(self.client.read_holding_registers, request['Address'], request['Count'], request)
         if self.rr.isError():
             self.log.error(str(self.rr) + str(request))
+            self._check_connection()
             return None
         else:
             self.log.info('Read holding registers from slave {} at address {}, count {}.'
@@ -120,13 +219,143 @@ class MbClient:
             self.log.warning('Port {} is not opened. Try to open the port first'.format(self.comport))
             if self.comport is None:
                 return None
-            if self.open() is False:
+            if self.reconnect() is False:
                 return None
-        self.rr = self.client.write_registers(request['Address'], request['Values'], unit=request['Slave'])
+        if not self._allow(request):
+            return None
+        self.rr = self._execute(self.client.write_registers, request['Address'], request['Values'], request)
         if self.rr.isError():
             self.log.error(str(self.rr) + str(request))
+            self._check_connection()
             return None
         else:
             self.log.info('Write holding registers to slave {} at address {}, count {}.'
                           .format(request['Slave'], request['Address'], request['Count']))
             return 0
+
+    def broadcast(self, request):
+        """
+        Send write holding register request to all slave devices (address 0), no response is expected. Returns after
+        turnaround delay, slaves do not accept next request while processing broadcast.
+        :param request: Request dictionary, such as 'Address': 50, 'Values': [10, 11, 12], 'Slave' is ignored
+        :return: 0 on success
+        :return: None on fail
+        """
+        if not self.client.is_socket_open():
+            self.log.warning('Port {} is not opened. Try to open the port first'.format(self.comport))
+            if self.comport is None:
+                return None
+            if self.reconnect() is False:
+                return None
+        with self.lock:
+            self.client.broadcast_enable = True
+            try:
+                self.rr = self.client.write_registers(request['Address'], request['Values'], unit=0)
+            finally:
+                self.client.broadcast_enable = False
+        # Client returns only a message if broadcast has been sent
+        if not isinstance(self.rr, bytes) and self.rr.isError():
+            self.log.error(str(self.rr) + str(request))
+            self._check_connection()
+            return None
+        self.log.info('Broadcast write holding registers at address {}, count {}.'.format(request['Address'],
+                                                                                        request['Count']))
+        sleep(self.s.get('turnaround_delay', 0.1))
+        return 0
+
+    def retryable(self, slave):
+        """
+        Is it worth to retry the last failed transaction with slave. Modbus exception would be returned again and
+        slave with open circuit breaker is not accessed at all.
+        :param slave: Slave address
+        :return: True if the transaction may be retried
+        """
+        return self.last_exception() is None and not self.breakers.is_open(slave)
+
+    def get_breaker_stats(self):
+        """
+        Return state of circuit breakers per slave
+        :return: Dictionary {slave: {'State', 'Failures', 'Trips'}}
+        """
+        return self.breakers.get_stats()
+
+    def get_timeout_stats(self):
+        """
+        Return response time statistics and current adaptive timeouts per slave
+        :return: Dictionary {slave: {'Samples', 'Timeouts', 'SRTT', 'RTTVAR', 'MinRtt', 'MaxRtt', 'Timeout'}}
+        """
+        return self.timeouts.get_stats()
+
+    def _execute(self, function, address, data, request):
+        """
+        Run one transaction with adaptive timeout of the slave and measure its response time
+        :param function: Client function (read_input_registers, read_holding_registers, write_registers)
+        :param address: Register address
+        :param data: Count of registers or list of values
+        :param request: Request dictionary
+        :return: Response
+        """
+        slave = request['Slave']
+        timeout = self.timeouts.timeout(slave, request['Count'])
+        # Pooled connection is shared, its timeout is set to the timeout of this client during the transaction
+        with self.lock:
+            self.client.timeout = timeout
+            # Serial port read timeout is set at connect
+            if self.key is None and self.client.socket is not None:
+                self.client.socket.timeout = timeout
+            start = perf_counter()
+            try:
+                rr = function(address, data, unit=slave)
+            except Exception:
+                # Probe of half-open circuit must not stay pending when the transaction raises
+                self._failed(slave)
+                raise
+            elapsed = perf_counter() - start
+        # Modbus exception is a valid response as well
+        if not rr.isError() or getattr(rr, 'exception_code', None) is not None:
+            self.timeouts.update(slave, elapsed, request['Count'])
+            self.breakers.success(slave)
+        else:
+            self._failed(slave)
+        return rr
+
+    def _failed(self, slave):
+        """
+        Count missing response of slave in its timeout and circuit breaker
+        :param slave: Slave address
+        :return: None
+        """
+        self.timeouts.expired(slave)
+        if self.breakers.failure(slave):
+            self.log.warning('Slave {} does not respond, skipped for {} s'.format(slave, self.breakers.reset_timeout))
+
+    def _allow(self, request):
+        """
+        Check circuit breaker of slave before transaction
+        :param request: Request dictionary
+        :return: True if the transaction may be sent
+        :return: False if the slave is skipped
+        """
+        if self.breakers.allow(request['Slave']):
+            return True
+        self.rr = None
+        self.log.debug('Slave {} skipped, circuit breaker is open'.format(request['Slave']))
+        return False
+
+    def _check_connection(self):
+        """
+        Close TCP connection after communication failure other than modbus exception, it is reconnected on the
+        next request. Connection shared with other clients is left open, it is closed with its last user.
+        :return: None
+        """
+        if self.key is not None and self.last_exception() is None and _pool.users(self.key) == 1:
+            with self.lock:
+                self.client.close()
+
+    def last_exception(self):
+        """
+        Return modbus exception code of the last response
+        :return: Exception code, such as ILLEGAL_ADDRESS
+        :return: None if the last response was not a modbus exception
+        """
+        return getattr(self.rr, 'exception_code', None)
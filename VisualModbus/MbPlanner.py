@@ -0,0 +1,144 @@
+from VisualModbus.MbTransport import get_method, TCP
+
+"""
+Maximal number of registers read by one FC03/FC04 request and written by one FC16 request
+"""
+MAX_READ = 125
+MAX_WRITE = 123
+
+
+def plan_writes(regs, max_count=MAX_WRITE):
+    """
+    Merge registers with consecutive addresses into groups written by one request. Gaps are never written.
+    :param regs: List of registers to write
+    :param max_count: Maximal number of registers in one request
+    :return: List of register groups
+    """
+    groups = []
+    count = 0
+    for reg in sorted(regs, key=lambda x: x['Address'][0]):
+        if len(groups) != 0 and reg['Address'][0] == groups[-1][-1]['Address'][-1] + 1 and \
+                count + len(reg['Address']) <= max_count:
+            groups[-1].append(reg)
+            count += len(reg['Address'])
+        else:
+            groups.append([reg])
+            count = len(reg['Address'])
+    return groups
+
+
+class FrameModel:
+    """
+    Timing model of modbus RTU frames on serial line
+    """
+    READ_REQUEST = 8
+    READ_RESPONSE = 5
+
+    def __init__(self, baud_rate=19200, parity='E', stop_bits=1, latency=0.005):
+        """
+        Initialize frame model from serial line parameters
+        :param baud_rate: Communication baud rate, None for Modbus TCP (transfer time is negligible)
+        :param parity: Parity ('N', 'E', or 'O')
+        :param stop_bits: Number of stop bits
+        :param latency: Response latency of slave and adapter (or network round trip) in seconds
+        """
+        self.latency = latency
+        if baud_rate is None:
+            self.char_time = 0.0
+            self.silent_interval = 0.0
+            return
+        bits = 1 + 8 + (0 if parity == 'N' else 1) + stop_bits
+        self.char_time = bits / baud_rate
+        # Modbus specifies fixed 1.75 ms silent interval above 19200 Bd
+        self.silent_interval = 3.5 * self.char_time if baud_rate <= 19200 else 0.00175
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Create frame model from communication settings
+        :param settings: Dictionary of communication settings (ComSettings.json), None for defaults
+        :return: FrameModel
+        """
+        if settings is None:
+            return cls()
+        latency = settings.get('response_latency', 0.005)
+        # Modbus TCP or gateway with unknown serial line
+        if 'baud_rate' not in settings or get_method(settings) == TCP:
+            return cls(None, latency=latency)
+        return cls(settings['baud_rate'], settings['parity'], settings['stop_bits'], latency)
+
+    def word_time(self):
+        """
+        Time to transfer one 16-bit register
+        :return: Time in seconds
+        """
+        return 2 * self.char_time
+
+    def read_time(self, count):
+        """
+        Time of complete read transaction including silent intervals and response latency
+        :param count: Number of registers to read
+        :return: Time in seconds
+        """
+        chars = self.READ_REQUEST + self.READ_RESPONSE + 2 * count
+        return chars * self.char_time + 2 * self.silent_interval + self.latency
+
+
+class ReadPlanner:
+    """
+    Planner of read transactions that merges registers into address ranges.
+
+    Gap between two registers is read as well, if it is cheaper than sending another request. Address holes refused
+    by the device (IllegalAddress) are remembered and never bridged again.
+    """
+
+    def __init__(self, model=None, max_count=MAX_READ):
+        """
+        Initialize read planner
+        :param model: FrameModel of communication line
+        :param max_count: Maximal number of registers in one request
+        """
+        self.model = model if model is not None else FrameModel()
+        self.max_count = max_count
+        self.holes = {'Input': set(), 'Holding': set()}
+
+    def add_holes(self, space, addresses):
+        """
+        Remember addresses that must not be read
+        :param space: Register space ('Input' or 'Holding')
+        :param addresses: Iterable of addresses
+        :return: None
+        """
+        self.holes[space].update(addresses)
+
+    def plan(self, space, regs):
+        """
+        Merge registers into address ranges
+        :param space: Register space ('Input' or 'Holding')
+        :param regs: List of registers
+        :return: List of address ranges [first, last]
+        """
+        ranges = []
+        for first, last in sorted((reg['Address'][0], reg['Address'][-1]) for reg in regs):
+            if len(ranges) != 0:
+                rng = ranges[-1]
+                if last - rng[0] < self.max_count and self._bridge(space, rng[1] + 1, first):
+                    rng[1] = max(rng[1], last)
+                    continue
+            ranges.append([first, last])
+        return ranges
+
+    def _bridge(self, space, start, stop):
+        """
+        Decide whether gap between two registers is read within one request
+        :param space: Register space ('Input' or 'Holding')
+        :param start: First address of the gap
+        :param stop: First address after the gap
+        :return: True to read the gap
+        """
+        if stop <= start:
+            return True
+        holes = self.holes[space]
+        if any(addr in holes for addr in range(start, stop)):
+            return False
+        return (stop - start) * self.model.word_time() < self.model.read_time(0)
@@ -0,0 +1,243 @@
+import random
+from time import monotonic, sleep
+
+"""
+Maximal number of retries saved in retry budget
+"""
+BUDGET_BURST = 10
+
+"""
+States of circuit breaker
+"""
+CLOSED = 'Closed'
+OPEN = 'Open'
+HALF_OPEN = 'HalfOpen'
+
+
+class RetryPolicy:
+    """
+    Retry policy of modbus transactions.
+
+    Failed transaction is retried after exponentially growing delay with random jitter, until the number of attempts
+    is reached. Modbus exception responses and slaves skipped by circuit breaker are not retried, the same result
+    would be returned again. Optional retry budget limits retries to a ratio of all calls, so a dead slave cannot
+    multiply the load of the bus.
+    """
+
+    def __init__(self, attempts=2, delay=0.5, max_delay=5.0, factor=2.0, jitter=0.5, budget=None):
+        """
+        Initialize retry policy
+        :param attempts: Maximal number of attempts, including the first one
+        :param delay: Delay before the first retry in seconds
+        :param max_delay: Maximal delay between retries in seconds
+        :param factor: Multiplier of delay after every retry
+        :param jitter: Fraction of delay that is randomized (0 - fixed delay, 1 - from 0 to full delay)
+        :param budget: Ratio of retries to calls (e.g., 0.2), None for unlimited retries
+        """
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.budget = budget
+        self.tokens = BUDGET_BURST
+        self.retries = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Create retry policy from visual settings
+        :param settings: Dictionary of settings
+        :return: RetryPolicy
+        """
+        return cls(settings.get('attempts', 2), settings.get('retry_delay', 0.5), settings.get('retry_max_delay', 5.0),
+                   jitter=settings.get('retry_jitter', 0.5), budget=settings.get('retry_budget'))
+
+    def begin(self):
+        """
+        Start new call, saves part of retry into budget
+        :return: None
+        """
+        if self.budget is not None:
+            self.tokens = min(BUDGET_BURST, self.tokens + self.budget)
+
+    def next_delay(self, attempt, retryable=True):
+        """
+        Decide whether failed call is retried
+        :param attempt: Number of attempts already made
+        :param retryable: False if the failure is not worth to retry (modbus exception)
+        :return: Delay before next attempt in seconds
+        :return: None if the call must not be retried
+        """
+        if not retryable or attempt >= self.attempts:
+            return None
+        if self.budget is not None:
+            if self.tokens < 1:
+                return None
+            self.tokens -= 1
+        self.retries += 1
+        return self.backoff(attempt)
+
+    def backoff(self, attempt):
+        """
+        Get randomized delay after given number of attempts
+        :param attempt: Number of attempts already made
+        :return: Delay in seconds
+        """
+        delay = min(self.max_delay, self.delay * self.factor ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, func, retryable=None):
+        """
+        Call function until it succeeds or the policy stops retries, blocks during delays
+        :param func: Function returning None on failure
+        :param retryable: Function returning False if the last failure is not worth to retry, None to retry always
+        :return: Result of the last call
+        """
+        self.begin()
+        attempt = 0
+        while True:
+            ret = func()
+            attempt += 1
+            if ret is not None:
+                return ret
+            delay = self.next_delay(attempt, retryable is None or retryable())
+            if delay is None:
+                return ret
+            sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one slave. After given number of consecutive missing responses the circuit is opened and the
+    slave is skipped. After reset timeout one probe transaction is allowed, its success closes the circuit again.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=5.0):
+        """
+        Initialize closed circuit breaker
+        :param threshold: Number of consecutive failures that open the circuit
+        :param reset_timeout: Time before the probe of open circuit in seconds
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened = 0.0
+
+    def allow(self, now=None):
+        """
+        Is the transaction allowed
+        :param now: Current time (monotonic), None for actual time
+        :return: True if the transaction may be sent
+        """
+        if self.state == CLOSED:
+            return True
+        now = monotonic() if now is None else now
+        # Only one probe at a time
+        if self.state == OPEN and now - self.opened >= self.reset_timeout:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def success(self):
+        """
+        Slave responded, close the circuit
+        :return: None
+        """
+        self.failures = 0
+        self.state = CLOSED
+
+    def failure(self, now=None):
+        """
+        Slave did not respond
+        :param now: Current time (monotonic), None for actual time
+        :return: True if the circuit has been opened now
+        """
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            self.state = OPEN
+            self.opened = monotonic() if now is None else now
+            self.trips += 1
+            return True
+        return False
+
+
+class BreakerTable:
+    """
+    Circuit breakers of slaves on one bus
+    """
+
+    def __init__(self, threshold=3, reset_timeout=5.0):
+        """
+        Initialize table
+        :param threshold: Number of consecutive failures that open the circuit, 0 disables circuit breakers
+        :param reset_timeout: Time before the probe of open circuit in seconds
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.slaves = {}
+
+    def load_settings(self, settings):
+        """
+        Set parameters from communication settings, applied to existing breakers as well
+        :param settings: Dictionary of communication settings
+        :return: None
+        """
+        self.threshold = settings.get('breaker_threshold', 3)
+        self.reset_timeout = settings.get('breaker_reset', 5.0)
+        for breaker in self.slaves.values():
+            breaker.threshold = self.threshold
+            breaker.reset_timeout = self.reset_timeout
+
+    def allow(self, slave):
+        """
+        Is the transaction with slave allowed
+        :param slave: Slave address
+        :return: True if the transaction may be sent
+        """
+        return self.threshold == 0 or self._get(slave).allow()
+
+    def is_open(self, slave):
+        """
+        Is the slave skipped
+        :param slave: Slave address
+        :return: True if the circuit of slave is open
+        """
+        return self.threshold != 0 and self._get(slave).state == OPEN
+
+    def success(self, slave):
+        """
+        Slave responded
+        :param slave: Slave address
+        :return: None
+        """
+        self._get(slave).success()
+
+    def failure(self, slave):
+        """
+        Slave did not respond
+        :param slave: Slave address
+        :return: True if the circuit has been opened now
+        """
+        return self.threshold != 0 and self._get(slave).failure()
+
+    def get_stats(self):
+        """
+        Return state of circuit breakers per slave
+        :return: Dictionary {slave: {'State', 'Failures', 'Trips'}}
+        """
+        return {slave: {'State': b.state, 'Failures': b.failures, 'Trips': b.trips} for slave, b in self.slaves.items()}
+
+    def _get(self, slave):
+        """
+        Get circuit breaker of slave, create it on first use
+        :param slave: Slave address
+        :return: CircuitBreaker
+        """
+        breaker = self.slaves.get(slave)
+        if breaker is None:
+            breaker = CircuitBreaker(self.threshold, self.reset_timeout)
+            self.slaves[slave] = breaker
+        return breaker
@@ -0,0 +1,560 @@
+import io
+import json
+import logging
+import os
+import random
+import select
+import socketserver
+import struct
+import sys
+import threading
+from time import monotonic, sleep
+
+from pymodbus.utilities import computeCRC
+
+import VisualModbus.Crc32 as Crc32
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbPlanner import FrameModel, MAX_READ, MAX_WRITE
+from VisualModbus.MbUpgrade import MbUpgrade, APP_CHECKSUM, APP_SIZE
+from VisualModbus.RegCodec import RegCodec
+
+"""
+Supported function codes, any other function is answered by Illegal function exception
+"""
+READ_HOLD = 3
+READ_INPUT = 4
+WRITE_MULTI = 16
+
+"""
+Modbus exception returned by injected error
+"""
+SLAVE_BUSY = 6
+
+"""
+Device status in upgrade status register
+"""
+STATUS_BUSY = 0
+STATUS_READY = 1
+
+"""
+Period of checking the stop request by serving threads in seconds
+"""
+POLL_PERIOD = 0.2
+
+
+class SimSlave:
+    """
+    Virtual slave device given by register map.
+
+    Registers hold values of the register map json, addresses above the highest register are illegal. With upgrade
+    settings, the device accepts firmware upgrade header, pages and apply request, and updates CRC and size of its
+    application after apply.
+    """
+
+    def __init__(self, reg_map, upgrade=None, settings=None):
+        """
+        Create device from register map
+        :param reg_map: Json register map file
+        :param upgrade: Json upgrade settings file (UpgradeSettings.json), None if upgrade is not supported
+        :param settings: Dictionary of simulator settings
+        """
+        settings = {} if settings is None else settings
+        with io.open(reg_map, 'r', encoding='utf-8-sig') as f:
+            regs = json.load(f)
+        self.names = {}
+        self.codecs = {}
+        self.mem = {'Input': {}, 'Holding': {}}
+        self.read_only = set()
+        for reg in regs:
+            space = 'Holding' if reg['Type'] == 'HOLD' else 'Input'
+            codec = RegCodec(reg)
+            self.names[reg['Name']] = (space, reg)
+            self.codecs[reg['Name']] = codec
+            self.mem[space].update(zip(reg['Address'], codec.encode(codec.coerce(reg['Value']))))
+            if space == 'Holding' and reg.get('Access', 'RW').startswith('RO'):
+                self.read_only.update(reg['Address'])
+        self.last = {space: max(mem, default=-1) for space, mem in self.mem.items()}
+        self.strict_holes = settings.get('strict_holes', False)
+        self.commit_time = settings.get('commit_time', 0.0)
+        self.restart_time = settings.get('restart_time', 0.0)
+        self.down_until = 0.0
+        self.upgrade = None
+        if upgrade is not None:
+            with io.open(upgrade, 'r', encoding='utf-8-sig') as f:
+                s = json.load(f)
+            address = s['address']
+            self.upgrade = {'Address': address, 'Page': address + MbUpgrade.HEADER_LEN,
+                            'Status': address + MbUpgrade.HEADER_LEN + MbUpgrade.OFFSET_LEN + s['page_bytes'] // 2,
+                            'Last': address + MbUpgrade.HEADER_LEN + MbUpgrade.OFFSET_LEN + s['page_bytes'] // 2 +
+                            MbUpgrade.FOOTER_LEN - 1}
+        self.length = 0
+        self.flash = {}
+        self.busy_until = 0.0
+        self.pages = 0
+
+    def get_value(self, name):
+        """
+        Get value of register
+        :param name: Register name
+        :return: Float, integer or string value
+        """
+        space, reg = self.names[name]
+        return self.codecs[name].decode([self.mem[space][addr] for addr in reg['Address']])
+
+    def set_value(self, name, value):
+        """
+        Set value of register, as if it has been changed by the device
+        :param name: Register name
+        :param value: Value
+        :return: None
+        """
+        space, reg = self.names[name]
+        codec = self.codecs[name]
+        self.mem[space].update(zip(reg['Address'], codec.encode(codec.coerce(value))))
+
+    def is_down(self):
+        """
+        Is the device restarting after firmware upgrade
+        :return: True if the device does not respond
+        """
+        return monotonic() < self.down_until
+
+    def read(self, space, address, count):
+        """
+        Read registers
+        :param space: 'Input' or 'Holding'
+        :param address: Address of the first register
+        :param count: Number of registers
+        :return: Tuple of exception code (0 on success) and list of values
+        """
+        mem = self.mem[space]
+        last = address + count - 1
+        if space == 'Holding' and self._in_upgrade(address, last):
+            if address <= self.upgrade['Status'] <= last:
+                mem[self.upgrade['Status']] = STATUS_BUSY if monotonic() < self.busy_until else STATUS_READY
+        elif last > self.last[space] or \
+                (self.strict_holes and any(addr not in mem for addr in range(address, last + 1))):
+            return MbClient.ILLEGAL_ADDRESS, []
+        return 0, [mem.get(addr, 0) for addr in range(address, last + 1)]
+
+    def write(self, address, values):
+        """
+        Write holding registers, writes to upgrade registers are processed by upgrade
+        :param address: Address of the first register
+        :param values: List of values
+        :return: Exception code, 0 on success
+        """
+        last = address + len(values) - 1
+        if self._in_upgrade(address, last):
+            self._write_upgrade(address, values)
+        elif last > self.last['Holding'] or any(addr in self.read_only for addr in range(address, last + 1)) or \
+                (self.strict_holes and any(addr not in self.mem['Holding'] for addr in range(address, last + 1))):
+            return MbClient.ILLEGAL_ADDRESS
+        self.mem['Holding'].update(zip(range(address, last + 1), values))
+        return 0
+
+    def get_image(self):
+        """
+        Get firmware image received by upgrade
+        :return: Bytes of the image
+        """
+        return b''.join(self.flash[off] for off in sorted(self.flash))[:self.length]
+
+    def _in_upgrade(self, address, last):
+        """
+        Do registers overlap upgrade registers
+        :param address: Address of the first register
+        :param last: Address of the last register
+        :return: True if upgrade is supported and registers overlap
+        """
+        return self.upgrade is not None and address <= self.upgrade['Last'] and last >= self.upgrade['Address']
+
+    def _write_upgrade(self, address, values):
+        """
+        Process write of upgrade header, page or apply request
+        :param address: Address of the first register
+        :param values: List of values
+        :return: None
+        """
+        if address == self.upgrade['Address'] and len(values) == MbUpgrade.HEADER_LEN:
+            # New upgrade erases the received image
+            self.length = values[2] + (values[3] << 16)
+            self.flash.clear()
+            self.busy_until = monotonic() + self.commit_time
+        elif address == self.upgrade['Page'] and len(values) > MbUpgrade.OFFSET_LEN + MbUpgrade.FOOTER_LEN:
+            size, off = values[0], values[1] + (values[2] << 16)
+            self.flash[off] = struct.pack('<{}H'.format(size // 2), *values[3:3 + size // 2])
+            self.busy_until = monotonic() + self.commit_time
+            self.pages += 1
+        elif address == self.upgrade['Address'] + 1 and list(values) == [2]:
+            self._apply()
+
+    def _apply(self):
+        """
+        Run received application, its CRC and size are shown by the registers of application
+        :return: None
+        """
+        image = self.get_image()
+        if APP_CHECKSUM in self.names:
+            self.set_value(APP_CHECKSUM, Crc32.calc_from_byte(image))
+        if APP_SIZE in self.names:
+            self.set_value(APP_SIZE, len(image))
+        self.down_until = monotonic() + self.restart_time
+
+
+class MbSimulator:
+    """
+    Local modbus slave simulator for testing without hardware.
+
+    Virtual slaves given by register maps are served by modbus RTU over pseudo terminal (POSIX only), by Modbus TCP
+    or by RTU over TCP. Function codes 3, 4 and 16 are supported, the others are answered by Illegal function
+    exception, register count out of range by Illegal value and addresses out of register map by Illegal address
+    exception. Write requests to slave 0 are broadcast to all slaves without response. Response latency, transfer
+    time at given baud rate and communication errors are simulated according to settings.
+    """
+
+    def __init__(self, settings=None):
+        """
+        Initialize simulator without slaves
+        :param settings: Json simulator settings file (SimSettings.json), None for defaults
+        """
+        self.s = {}
+        if settings is not None:
+            with io.open(settings, 'r', encoding='utf-8-sig') as f:
+                self.s = json.load(f)
+        self.latency = self.s.get('latency', 0.0)
+        if 'baud_rate' in self.s:
+            self.model = FrameModel(self.s['baud_rate'], self.s.get('parity', 'N'), self.s.get('stop_bits', 1))
+        else:
+            self.model = FrameModel(None)
+        self.drop_rate = self.s.get('drop_rate', 0.0)
+        self.corrupt_rate = self.s.get('corrupt_rate', 0.0)
+        self.busy_rate = self.s.get('busy_rate', 0.0)
+        self.broadcast_drop_rate = self.s.get('broadcast_drop_rate', 0.0)
+        self.random = random.Random(self.s.get('seed'))
+        self.slaves = {}
+        # Slaves and statistics are shared by serving threads
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+        self.running = True
+        self.threads = []
+        self.servers = []
+        self.fds = []
+        self.log = logging.getLogger()
+
+    def add_slave(self, reg_map, slave=1, upgrade=None):
+        """
+        Add virtual slave device
+        :param reg_map: Json register map file
+        :param slave: Slave address
+        :param upgrade: Json upgrade settings file (UpgradeSettings.json), None if upgrade is not supported
+        :return: SimSlave
+        """
+        self.slaves[slave] = SimSlave(reg_map, upgrade, self.s)
+        return self.slaves[slave]
+
+    def serve_pty(self):
+        """
+        Serve slaves by modbus RTU on new pseudo terminal, the client opens it as its COM port
+        :return: Name of the port, such as /dev/pts/3
+        """
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        self.fds += [master, slave]
+        self._start(self._serve_rtu, master, lambda: os.read(master, 4096), lambda data: os.write(master, data))
+        name = os.ttyname(slave)
+        self.log.warning('Simulator serves {} slaves on {}'.format(len(self.slaves), name))
+        return name
+
+    def serve_tcp(self, port=5020, host='127.0.0.1', method='tcp'):
+        """
+        Serve slaves by Modbus TCP or by RTU over TCP, every connection is served by its own thread
+        :param port: TCP port, 0 to select free port
+        :param host: Address to listen on
+        :param method: 'tcp' or 'rtu-over-tcp'
+        :return: TCP port
+        """
+        sim = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sock = self.request
+                sock.settimeout(None)
+                if method == 'tcp':
+                    sim._serve_tcp(sock)
+                else:
+                    sim._serve_rtu(sock, lambda: sock.recv(4096), sock.sendall)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        self.servers.append(server)
+        self._start(server.serve_forever, POLL_PERIOD)
+        port = server.server_address[1]
+        self.log.warning('Simulator serves {} slaves on {}:{} ({})'.format(len(self.slaves), host, port, method))
+        return port
+
+    def stop(self):
+        """
+        Stop serving and close all ports
+        :return: None
+        """
+        self.running = False
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self.threads:
+            thread.join()
+        for fd in self.fds:
+            os.close(fd)
+        self.servers.clear()
+        self.threads.clear()
+        self.fds.clear()
+
+    def get_stats(self):
+        """
+        Return traffic statistics of all ports
+        :return: Dictionary {'Requests', 'Responses', 'Exceptions', 'Dropped', 'Corrupted', 'BytesIn', 'BytesOut'}
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    def reset_stats(self):
+        """
+        Clear traffic statistics
+        :return: None
+        """
+        with self.lock:
+            self.stats = dict.fromkeys(('Requests', 'Responses', 'Exceptions', 'Dropped', 'Corrupted', 'BytesIn',
+                                        'BytesOut'), 0)
+
+    def execute(self, slave, pdu):
+        """
+        Execute request of slave
+        :param slave: Slave address, 0 for broadcast
+        :param pdu: Request PDU (function code and data)
+        :return: Response PDU
+        :return: None if there is no response
+        """
+        with self.lock:
+            self.stats['Requests'] += 1
+            if slave == 0:
+                # Every slave may miss broadcast, nothing tells the master
+                for device in self.slaves.values():
+                    if device.is_down() or self.random.random() < self.broadcast_drop_rate:
+                        self.stats['Dropped'] += 1
+                    else:
+                        self._execute(device, pdu)
+                return None
+            device = self.slaves.get(slave)
+            if device is None or device.is_down() or self.random.random() < self.drop_rate:
+                self.stats['Dropped'] += 1
+                return None
+            if self.random.random() < self.busy_rate:
+                response = bytes([pdu[0] | 0x80, SLAVE_BUSY])
+            else:
+                response = self._execute(device, pdu)
+            if response[0] & 0x80:
+                self.stats['Exceptions'] += 1
+            self.stats['Responses'] += 1
+            return response
+
+    def _execute(self, device, pdu):
+        """
+        Execute request PDU by device
+        :param device: SimSlave
+        :param pdu: Request PDU
+        :return: Response PDU
+        """
+        fc = pdu[0]
+        code = MbClient.ILLEGAL_FUNCTION
+        response = b''
+        if fc in (READ_HOLD, READ_INPUT) and len(pdu) == 5:
+            address, count = struct.unpack('>HH', pdu[1:5])
+            if not 1 <= count <= MAX_READ:
+                code = MbClient.ILLEGAL_VALUE
+            else:
+                code, values = device.read('Holding' if fc == READ_HOLD else 'Input', address, count)
+                if code == 0:
+                    response = struct.pack('>BB{}H'.format(count), fc, 2 * count, *values)
+        elif fc == WRITE_MULTI and len(pdu) >= 6:
+            address, count, size = struct.unpack('>HHB', pdu[1:6])
+            if not 1 <= count <= MAX_WRITE or size != 2 * count or len(pdu) != 6 + size:
+                code = MbClient.ILLEGAL_VALUE
+            else:
+                code = device.write(address, struct.unpack('>{}H'.format(count), pdu[6:]))
+                response = pdu[:5]
+        if code != 0:
+            return bytes([fc | 0x80, code])
+        return response
+
+    def _count(self, name, value=1):
+        """
+        Add value to statistics, ports are served by more threads
+        :param name: Name of statistics item
+        :param value: Value to add
+        :return: None
+        """
+        with self.lock:
+            self.stats[name] += value
+
+    def _corrupt(self):
+        """
+        Decide whether response frame is corrupted and count it
+        :return: True to corrupt the frame
+        """
+        with self.lock:
+            if self.random.random() < self.corrupt_rate:
+                self.stats['Corrupted'] += 1
+                return True
+            return False
+
+    def _start(self, target, *args):
+        """
+        Start serving thread
+        :param target: Thread function
+        :param args: Arguments of the function
+        :return: None
+        """
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def _transfer(self, size):
+        """
+        Wait for the time of transfer of frame on serial line
+        :param size: Length of frame in bytes
+        :return: None
+        """
+        if self.model.char_time > 0:
+            sleep(size * self.model.char_time)
+
+    def _respond(self, slave, pdu, size):
+        """
+        Execute request received by a port and simulate its timing and errors
+        :param slave: Slave address
+        :param pdu: Request PDU
+        :param size: Length of request frame in bytes
+        :return: Response PDU
+        :return: None if there is no response
+        """
+        self._count('BytesIn', size)
+        self._transfer(size)
+        response = self.execute(slave, pdu)
+        if response is not None:
+            sleep(self.latency)
+        return response
+
+    def _serve_rtu(self, port, recv, send):
+        """
+        Serve modbus RTU frames of the port. Frame length is given by its function code, or by silent interval for
+        unknown functions. Frames with wrong CRC are ignored.
+        :param port: File descriptor or socket to wait for
+        :param recv: Function receiving available bytes
+        :param send: Function sending bytes
+        :return: None
+        """
+        buf = b''
+        # Silent interval of fast virtual port
+        gap = max(self.model.silent_interval, 0.005)
+        while self.running:
+            ready, _, _ = select.select([port], [], [], gap if len(buf) else POLL_PERIOD)
+            if len(ready):
+                try:
+                    data = recv()
+                except OSError:
+                    return
+                if len(data) == 0:
+                    return
+                buf += data
+            size = _rtu_length(buf)
+            if size is None and len(ready) == 0 and len(buf):
+                size = len(buf)
+            while size is not None and len(buf) >= size:
+                frame, buf = buf[:size], buf[size:]
+                response = None
+                if size >= 4 and computeCRC(frame[:-2]) == struct.unpack('>H', frame[-2:])[0]:
+                    response = self._respond(frame[0], frame[1:-2], size)
+                if response is not None:
+                    frame = bytes([frame[0]]) + response
+                    frame += struct.pack('>H', computeCRC(frame))
+                    if self._corrupt():
+                        frame = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+                    self._transfer(len(frame))
+                    self._count('BytesOut', len(frame))
+                    send(frame)
+                size = _rtu_length(buf)
+
+    def _serve_tcp(self, sock):
+        """
+        Serve Modbus TCP frames (MBAP header and PDU) of one connection
+        :param sock: Socket of the connection
+        :return: None
+        """
+        while self.running:
+            header = _recv_all(sock, 7)
+            if header is None:
+                return
+            tid, pid, length, slave = struct.unpack('>HHHB', header)
+            pdu = _recv_all(sock, length - 1)
+            if pdu is None:
+                return
+            response = self._respond(slave, pdu, len(header) + len(pdu))
+            if response is None:
+                continue
+            frame = struct.pack('>HHHB', tid, pid, len(response) + 1, slave) + response
+            self._count('BytesOut', len(frame))
+            sock.sendall(frame)
+
+
+def _rtu_length(buf):
+    """
+    Get length of modbus RTU request frame at the beginning of buffer
+    :param buf: Received bytes
+    :return: Length of frame in bytes
+    :return: None if it is not known yet or the function is not supported
+    """
+    if len(buf) < 2:
+        return None
+    if buf[1] <= 6:
+        return 8
+    if buf[1] in (15, WRITE_MULTI):
+        return 9 + buf[6] if len(buf) >= 7 else None
+    return None
+
+
+def _recv_all(sock, size):
+    """
+    Receive given number of bytes from socket
+    :param sock: Socket
+    :param size: Number of bytes
+    :return: Received bytes
+    :return: None if the connection has been closed
+    """
+    data = b''
+    while len(data) < size:
+        try:
+            chunk = sock.recv(size - len(data))
+        except OSError:
+            return None
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
+
+
+if __name__ == "__main__":
+    # Serve register map given as argument (example map by default) on pseudo terminal and TCP port 5020
+    folder = os.path.dirname(os.path.abspath(__file__))
+    sim = MbSimulator(os.path.join(folder, 'SimSettings.json'))
+    sim.add_slave(sys.argv[1] if len(sys.argv) > 1 else os.path.join(folder, 'Example-FW_Modbus.json'), 1,
+                  os.path.join(folder, 'UpgradeSettings.json'))
+    print('RTU on {}, Modbus TCP on port {}'.format(sim.serve_pty(), sim.serve_tcp(5020)))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
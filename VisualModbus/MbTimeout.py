@@ -0,0 +1,148 @@
+from VisualModbus.MbPlanner import FrameModel
+
+"""
+Gains of smoothed round trip time and its variation (RFC 6298)
+"""
+ALPHA = 0.125
+BETA = 0.25
+K = 4
+
+
+class RttEstimator:
+    """
+    Smoothed round trip time estimator of one slave, computes response timeout like TCP retransmission timeout
+    """
+
+    def __init__(self):
+        """
+        Initialize estimator without samples
+        """
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.samples = 0
+        self.timeouts = 0
+        self.min_rtt = None
+        self.max_rtt = None
+
+    def update(self, rtt):
+        """
+        Add measured response time
+        :param rtt: Response time without frame transfer time in seconds
+        :return: None
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += ALPHA * (rtt - self.srtt)
+        self.backoff = 1
+        self.samples += 1
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+
+    def expired(self):
+        """
+        Response has not been received, double the timeout (response time is not sampled, Karn's algorithm)
+        :return: None
+        """
+        self.timeouts += 1
+        self.backoff *= 2
+
+    def rto(self):
+        """
+        Get estimated response timeout without backoff
+        :return: Timeout in seconds, None without samples
+        """
+        if self.srtt is None:
+            return None
+        return self.srtt + K * self.rttvar
+
+
+class TimeoutTable:
+    """
+    Adaptive response timeouts of slaves on one bus.
+
+    Response time of every slave (without frame transfer time given by frame model) is tracked separately. Timeout is
+    the transfer time of the request plus estimated retransmission timeout, kept within minimal and maximal timeout.
+    Slaves without samples use the maximal (configured) timeout, response time of other slaves on the bus says
+    nothing about a slave that has not responded yet.
+    """
+
+    def __init__(self, model=None, min_timeout=0.05, max_timeout=1.5, enabled=True):
+        """
+        Initialize table
+        :param model: FrameModel of the bus, None for default serial line
+        :param min_timeout: Minimal timeout in seconds
+        :param max_timeout: Maximal timeout in seconds, used until response time is known
+        :param enabled: False to use always the maximal timeout, statistics are collected anyway
+        """
+        self.model = FrameModel() if model is None else model
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.enabled = enabled
+        self.slaves = {}
+
+    def load_settings(self, model, settings):
+        """
+        Set frame model and timeout bounds from communication settings, learned response times are kept
+        :param model: FrameModel of the bus
+        :param settings: Dictionary of communication settings
+        :return: None
+        """
+        self.model = model
+        self.min_timeout = settings.get('min_timeout', 0.05)
+        self.max_timeout = settings.get('max_timeout', settings['timeout'])
+        self.enabled = settings.get('adaptive_timeout', True)
+
+    def timeout(self, slave, count=0):
+        """
+        Get response timeout of slave
+        :param slave: Slave address
+        :param count: Number of transferred registers
+        :return: Timeout in seconds
+        """
+        est = self.slaves.get(slave)
+        if not self.enabled or est is None or est.srtt is None:
+            return self.max_timeout
+        timeout = (self._transfer_time(count) + est.rto()) * est.backoff
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def update(self, slave, elapsed, count=0):
+        """
+        Add response time of slave
+        :param slave: Slave address
+        :param elapsed: Time from the start of request to the end of response in seconds
+        :param count: Number of transferred registers
+        :return: None
+        """
+        rtt = max(0.0, elapsed - self._transfer_time(count))
+        self.slaves.setdefault(slave, RttEstimator()).update(rtt)
+
+    def expired(self, slave):
+        """
+        Slave has not responded within timeout
+        :param slave: Slave address
+        :return: None
+        """
+        self.slaves.setdefault(slave, RttEstimator()).expired()
+
+    def get_stats(self):
+        """
+        Return response time statistics per slave
+        :return: Dictionary {slave: {'Samples', 'Timeouts', 'SRTT', 'RTTVAR', 'MinRtt', 'MaxRtt', 'Timeout'}}
+        """
+        ret = {}
+        for slave, est in self.slaves.items():
+            ret[slave] = {'Samples': est.samples, 'Timeouts': est.timeouts, 'SRTT': est.srtt, 'RTTVAR': est.rttvar,
+                          'MinRtt': est.min_rtt, 'MaxRtt': est.max_rtt, 'Timeout': self.timeout(slave)}
+        return ret
+
+    def _transfer_time(self, count):
+        """
+        Get transfer time of request and response frames
+        :param count: Number of transferred registers
+        :return: Time in seconds
+        """
+        return self.model.read_time(count) - self.model.latency
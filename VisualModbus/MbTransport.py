@@ -0,0 +1,116 @@
+import socket
+import threading
+
+"""
+Transport methods selectable by "method" in ComSettings.json
+"""
+RTU = 'rtu'
+TCP = 'tcp'
+RTU_OVER_TCP = 'rtu-over-tcp'
+
+
+def get_method(settings):
+    """
+    Get transport method of communication settings. Settings without "method" use TCP if they contain "host",
+    RTU on COM port otherwise.
+    :param settings: Dictionary of communication settings
+    :return: RTU, TCP or RTU_OVER_TCP
+    """
+    if 'method' in settings:
+        return settings['method'].lower()
+    return TCP if 'host' in settings else RTU
+
+
+def get_name(settings):
+    """
+    Get name of port or connection
+    :param settings: Dictionary of communication settings
+    :return: COM port name or host:port
+    """
+    if get_method(settings) == RTU:
+        return settings['comport']
+    return '{}:{}'.format(settings['host'], settings.get('port', 502))
+
+
+def enable_keepalive(sock, idle=30):
+    """
+    Enable TCP keep-alive on socket, so dead connections are detected and reconnected
+    :param sock: Socket
+    :param idle: Idle time before keep-alive probes in seconds
+    :return: None
+    """
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Fine tuning is not available on all platforms
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(idle) // 3))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+class ConnectionPool:
+    """
+    Pool of persistent connections shared by clients with the same transport method, host and port.
+
+    The pool may be used from more threads. Every connection has its own lock, clients must hold it during
+    transaction, so requests and responses of different clients do not interleave.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty pool
+        """
+        self.conns = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key, factory):
+        """
+        Get connection of given key, create it if it does not exist
+        :param key: Tuple (method, host, port)
+        :param factory: Function creating new connection
+        :return: Connection
+        """
+        with self.lock:
+            entry = self.conns.get(key)
+            if entry is None:
+                entry = [factory(), 0, threading.RLock()]
+                self.conns[key] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def get_lock(self, key):
+        """
+        Get lock of connection of given key
+        :param key: Tuple (method, host, port)
+        :return: Lock held during transaction on the connection
+        """
+        with self.lock:
+            return self.conns[key][2]
+
+    def users(self, key):
+        """
+        Get number of clients using connection of given key
+        :param key: Tuple (method, host, port)
+        :return: Number of clients
+        """
+        with self.lock:
+            entry = self.conns.get(key)
+            return 0 if entry is None else entry[1]
+
+    def release(self, key):
+        """
+        Release connection of given key
+        :param key: Tuple (method, host, port)
+        :return: Connection to close if it is not used anymore
+        :return: None if connection is still used
+        """
+        with self.lock:
+            entry = self.conns.get(key)
+            if entry is None:
+                return None
+            entry[1] -= 1
+            if entry[1] > 0:
+                return None
+            del self.conns[key]
+            return entry[0]
@@ -1,12 +1,50 @@
 import json
 import io
 import logging
-from time import sleep
+import mmap
+import sys
+from array import array
+from time import monotonic, sleep
+
+from VisualModbus.MbRetry import RetryPolicy
+import VisualModbus.Crc32 as Crc32
+
+"""
+Part of estimated page commit time slept before the first status read, and the period of next status reads
+"""
+COMMIT_SLEEP = 0.75
+STATUS_POLL = 0.125
+
+"""
+Minimal period of status reads relative to the time of status read transaction
+"""
+MIN_STATUS_POLL = 1.0
+
+"""
+Gain of smoothed page commit time
+"""
+COMMIT_GAIN = 0.25
+
+"""
+Registers describing application running in the device
+"""
+APP_CHECKSUM = 'FIRM_APP_CHECKSUM'
+APP_SIZE = 'FIRM_APP_SIZE'
+
+"""
+Size of image chunk processed by one CRC update in bytes
+"""
+CRC_CHUNK = 1 << 16
 
 
 class MbUpgrade:
     """
-    Class for upgrading firmware through modbus RTU protocol
+    Class for upgrading firmware through modbus RTU protocol.
+
+    Every acknowledged page is checkpointed, after a communication failure the upgrade is resumed from the first
+    page not acknowledged instead of starting again. Status of the device is polled according to measured page
+    commit time. If the register map of the device is given, image identical to the application in the device is
+    not flashed and flashed application is verified by its CRC.
     """
     HEADER_LEN = 4
     OFFSET_LEN = 3
@@ -15,16 +53,22 @@ class MbUpgrade:
     progress = 0
     size = 1
 
-    def __init__(self, settings, mb, slave=1):
+    def __init__(self, settings, mb, slave=1, regs=None):
         """
         Initialize upgrade module from given json
         :param settings: Json upgrade settings file
         :param mb: MbClient object
         :param slave: Slave address
+        :param regs: RegMap of the device with application CRC and size, None to flash always without verification
         """
         with io.open(settings, 'r', encoding='utf-8-sig') as f:
             s = json.load(f)
-        self.reqs = []
+        self.header = None
+        self.pages = iter(())
+        self.image = None
+        # Image opened by load_file is closed by this upgrade, shared image by its owner
+        self.own_image = False
+        self.length = 0
         self.align = s['align']
         self.LEN_UPG_PAGE = s['page_bytes']
         self.offset = s['address']
@@ -34,88 +78,215 @@ class MbUpgrade:
         if 'block_delay' not in s:
             s['block_delay'] = 0.0
         self.block_delay = s['block_delay']
+        # Page writes and status reads are retried immediately by default
+        self.write_retry = RetryPolicy(s.get('write_attempts', 2), s.get('retry_delay', 0.0))
+        self.status_retry = RetryPolicy(s.get('status_attempts', 3), s.get('retry_delay', 0.0))
+        self.resume_retry = RetryPolicy(s.get('resume_attempts', 3) + 1, s.get('resume_delay', 1.0))
+        self.status_timeout = s.get('status_timeout', 2.0)
+        # Smoothed page commit time, initial estimate is given by settings (block delay of older settings files),
+        # otherwise by the time of status read at the first page
+        self.commit_time = s.get('commit_time', self.block_delay or None)
+        # Index of the first page not acknowledged, None until the header is acknowledged
+        self.checkpoint = None
+        self.skip_identical = s.get('skip_identical', True)
+        self.verify = s.get('verify', True)
+        self.verify_delay = s.get('verify_delay', 1.0)
+        self.verify_retry = RetryPolicy(s.get('verify_attempts', 5), s.get('verify_delay', 1.0))
+        # Only devices that keep written header and page readable can confirm them by read back
+        self.confirm_readback = s.get('confirm_readback', False)
+        self.regs = regs
+        self.skipped = False
+        # State of running upgrade
+        self.request = None
+        self.response = None
+        self.sent = 0.0
+        self.failures = 0
+        self.adaptive = True
         self.mb = mb
         self.errors = 0
         self.slave = slave
 
     def load_file(self, file_name):
         """
-        Load firmware binary file and divide it into pages to send.
+        Open firmware binary file, pages to send are created lazily from memory mapped file.
         Binary file is appended by 0 if its length does not match align parameter.
         :param file_name: Firmware filename
         :return: None
         """
-        with io.open(file_name, 'rb') as f:
-            content = f.read()
-        if len(content) % self.align != 0:
-            content += ((0).to_bytes(self.align - (len(content) % self.align), byteorder='little'))
-
-        # Create and write header
-        header = [self.type, self.mode, len(content) % (1 << 16), len(content) // (1 << 16)]
-        self.reqs.append({'Address': self.offset, 'Count': len(header), 'Values': header, 'Slave': self.slave})
-
-        self.size = int((len(content) + self.LEN_UPG_PAGE - 1)/self.LEN_UPG_PAGE)
-        # iterate for each page
-        for page in range(self.size):
-            data_length = min(len(content) - page * self.LEN_UPG_PAGE, self.LEN_UPG_PAGE)
-            page_data = [0] * (self.LEN_UPG_PAGE//2 + self.OFFSET_LEN + self.FOOTER_LEN)
-            # swap data from bytes to 16-bit registers
-            off = page * self.LEN_UPG_PAGE
-            for i in range(data_length//2):
-                page_data[i + self.OFFSET_LEN] = int.from_bytes(content[off + i * 2:off + i * 2 + 2], byteorder='little'
-                                                                , signed=False)
-            # Set offset and create request
-            page_data[0] = self.LEN_UPG_PAGE
-            page_data[1] = off & ((1 << 16)-1)
-            page_data[2] = off >> 16
-            page_data[-1] = 1
-            self.reqs.append({'Address': self.offset + self.HEADER_LEN, 'Count': len(page_data),
-                              'Values': page_data, 'Type': 'Holding', 'Slave': self.slave})
-
-        self.log.info('Bin file {0} opened. Size {1} bytes, {2} pages'.format(file_name, len(content), self.size))
-
-    def run_upgrade(self, progress_clb=None):
+        self.close()
+        self.set_image(UpgradeImage(file_name, self.align, self.LEN_UPG_PAGE))
+        self.own_image = True
+        self.log.info('Bin file {0} opened. Size {1} bytes, {2} pages'.format(file_name, self.length, self.size))
+
+    def set_image(self, image):
+        """
+        Set firmware image to upgrade, the image may be shared by upgrades of more devices
+        :param image: UpgradeImage created with align and page size of this upgrade
+        :return: None
+        """
+        self.image = image
+        self.own_image = False
+        self.length = image.length
+        self.size = image.size
+
+        # Create header
+        header = [self.type, self.mode, self.length % (1 << 16), self.length // (1 << 16)]
+        self.header = {'Address': self.offset, 'Count': len(header), 'Values': header, 'Slave': self.slave}
+        self.pages = self.page_requests()
+
+    def page_requests(self, start=0):
+        """
+        Generate write requests of pages, values are frames of the image
+        :param start: Index of the first page
+        :return: Generator of write requests
+        """
+        for page in range(start, self.size):
+            frame = self.image.frame(page)
+            yield {'Address': self.offset + self.HEADER_LEN, 'Count': len(frame), 'Values': frame, 'Type': 'Holding',
+                   'Slave': self.slave}
+
+    def run_upgrade(self, progress_clb=None, resume=False):
         """
         Run upgrade procedure.
 
         This function will iterate upgrade firmware handshake, until the whole file is flashed into device.
-        Progress callback is called after every page.
+        Progress callback is called after every page. Failed page is resumed from the checkpoint until resume
+        attempts are exhausted, the new firmware is applied only if all pages were acknowledged.
         :param progress_clb: Progress callback
+        :param resume: True to continue terminated upgrade from the checkpoint (e.g., after reconnect)
         :return: 0 on success
         :return: non-zero on error
         """
+        if self.start(resume):
+            # For each packet in queue
+            while self.request is not None:
+                self.send()
+                self.complete(progress_clb)
+            self.finish()
+        else:
+            # Device already runs the image, it is not needed anymore
+            self.close()
+        return self.errors
+
+    def start(self, resume=False):
+        """
+        Start upgrade procedure, nothing is sent if the device already runs the image.
+        Upgrade is then driven by send and complete of every request until there is no request, and by finish.
+        :param resume: True to continue terminated upgrade from the checkpoint
+        :return: True if the upgrade has started, False if it is skipped
+        """
         self.errors = 0
-        request = self.hand_shake(None, None)
-        # For each packet in queue
-        while request is not None:
-            # Write packet into device with 2 tries
-            response = None
-            retries = 2
-            while response is None and retries:
-                response = self.mb.write_hold(request)
-                retries -= 1
-            # If this was start packet, wait some time
-            if request['Address'] == self.offset and request['Count'] == 4 and response is not None:
-                sleep(self.init_delay)
-            #  Upgrade hand shake that returns next packet or terminates
-            request = self.hand_shake(request, response)
-            # Read the device status if its ready with 3 tries
-            status_resp = None
-            retries = 3
-            if self.block_delay != 0:
-                sleep(self.block_delay)
-            while not self.check_status(status_resp) and retries:
-                status_req = self.request_status()
-                status_resp = self.mb.read(status_req)
-                retries -= 1
-            if not retries and not self.check_status(status_resp):
+        self.skipped = not resume and self.skip_identical and self.check_image()
+        if self.skipped:
+            self.log.warning('Device already runs the image, upgrade skipped')
+            return False
+        # Flash erase and programming delays responses, use configured timeout instead of adaptive one
+        self.adaptive = self.mb.timeouts.enabled
+        self.mb.timeouts.enabled = False
+        if resume and self.checkpoint is not None:
+            self.request = self._resume()
+        else:
+            self.checkpoint = None
+            self.progress = 0
+            self.pages = self.page_requests()
+            self.request = self.hand_shake(None, None)
+        self.failures = 0
+        self.resume_retry.begin()
+        return True
+
+    def send(self):
+        """
+        Write the current request into device with retries given by write retry policy
+        :return: None
+        """
+        request = self.request
+        self.response = self.write_retry.call(lambda: self.mb.write_hold(request), self._retryable)
+        # If this was start packet, wait some time
+        if request is self.header and self.response is not None:
+            sleep(self.init_delay)
+        self.sent = monotonic()
+
+    def complete(self, progress_clb=None):
+        """
+        Wait until the device is ready after the current request and choose the next request. Failed request is
+        resumed from the checkpoint, the upgrade is terminated when resume attempts are exhausted.
+        :param progress_clb: Progress callback
+        :return: None
+        """
+        request = self.request
+        # Read the device status if it is ready
+        if self.response is None or self.wait_ready(request is not self.header) is None:
+            self.failures += 1
+            delay = self.resume_retry.next_delay(self.failures)
+            if delay is None:
                 self.terminate()
-            if progress_clb is not None:
-                progress_clb(self.progress, self.size)
-        # Send apply request
-        self.mb.write_hold(self.request_apply())
+                self.request = None
+                return
+            # Open circuit breaker would skip the resumed page
+            if self.mb.breakers.is_open(self.slave):
+                delay = max(delay, self.mb.breakers.reset_timeout)
+            sleep(delay)
+            self.request = self._resume()
+            return
+        self.failures = 0
+        self._set_checkpoint(request)
+        #  Upgrade hand shake that returns next packet
+        self.request = self.hand_shake(request, self.response)
+        if progress_clb is not None:
+            progress_clb(self.progress, self.size)
+
+    def finish(self):
+        """
+        Apply new firmware if all pages were acknowledged and verify it
+        :return: 0 on success
+        :return: non-zero on error
+        """
+        if self.errors == 0:
+            # Send apply request, device restarts with new firmware and values read before are not valid anymore
+            self.mb.write_hold(self.request_apply())
+            self.mb.invalidate()
+            self.checkpoint = None
+        self.mb.timeouts.enabled = self.adaptive
+        if self.errors == 0 and self.verify and self.regs is not None:
+            # Device restarts with new application
+            sleep(self.verify_delay)
+            if not self.verify_retry.call(lambda: self.check_image() or None):
+                self.log.error('Upgrade verification failed, CRC of application does not match the image')
+                self.errors += 1
+        # Failed upgrade may be resumed, the image is kept open
+        if self.errors == 0:
+            self.close()
         return self.errors
 
+    def close(self):
+        """
+        Close firmware image opened by load_file
+        :return: None
+        """
+        if self.own_image:
+            self.image.close()
+            self.own_image = False
+
+    def image_crc(self):
+        """
+        Calculate CRC of the image padded by align
+        :return: CRC32 as computed by the device
+        """
+        return self.image.crc()
+
+    def check_image(self):
+        """
+        Compare CRC and size of the image with application in the device
+        :return: True if the device runs the image
+        :return: False if it differs or it cannot be read or the register map does not describe application
+        """
+        if self.regs is None or APP_CHECKSUM not in self.regs.names or APP_SIZE not in self.regs.names:
+            return False
+        values = self.regs.read_many([APP_CHECKSUM, APP_SIZE])
+        if None in values.values():
+            return False
+        return values[APP_SIZE] == self.length and values[APP_CHECKSUM] & 0xFFFFFFFF == self.image_crc()
+
     def hand_shake(self, request, response):
         """
         Upgrade firmware handshake procedure
@@ -126,7 +297,7 @@ class MbUpgrade:
         """
         # Obtained None as request means start
         if request is None:
-            return self.reqs.pop(0)
+            return self.header
         else:
             # Response None means writing error, terminate
             if response is None:
@@ -137,10 +308,7 @@ class MbUpgrade:
                 if request['Address'] == self.offset + self.HEADER_LEN:
                     self.progress += 1
                 # Return next request if not the last
-                if len(self.reqs) != 0:
-                    return self.reqs.pop(0)
-                else:
-                    return None
+                return next(self.pages, None)
 
     def request_status(self):
         """
@@ -157,6 +325,37 @@ class MbUpgrade:
         """
         return {'Address': self.offset + 1, 'Count': 1, 'Values': [2], 'Slave': self.slave}
 
+    def request_readback(self, request):
+        """
+        Create request to read back the beginning of written header or page
+        :param request: Header or page write request
+        :return: Read request of header, or of size and offset of page
+        """
+        count = self.HEADER_LEN if request['Address'] == self.offset else self.OFFSET_LEN
+        return {'Address': request['Address'], 'Count': count, 'Type': 'Holding', 'Slave': self.slave}
+
+    def confirm(self, request):
+        """
+        Check that the device has received header or page. Status of device that has missed broadcast is still
+        ready from the previous page, so the header or the size and offset of the page are read back if enabled.
+        Otherwise the ready status is the only check, missed page is found by verification of application CRC.
+        :param request: Header or page write request
+        :return: True if the device holds the request or read back is disabled
+        """
+        if not self.confirm_readback:
+            return True
+        readback = self.request_readback(request)
+        response = self.status_retry.call(lambda: self.mb.read(readback), self._retryable)
+        return response is not None and list(response) == list(request['Values'][:readback['Count']])
+
+    def can_verify(self):
+        """
+        Can the device be verified after upgrade by CRC and size of its application
+        :return: True if verification is enabled and the register map describes application
+        """
+        return self.verify and self.regs is not None and APP_CHECKSUM in self.regs.names and \
+            APP_SIZE in self.regs.names
+
     def check_status(self, response):
         """
         Check the received status register
@@ -168,14 +367,158 @@ class MbUpgrade:
                 return True
         return False
 
+    def wait_ready(self, learn=True):
+        """
+        Wait until the device has committed the page. Status is read after most of the estimated commit time and
+        then polled until the device is ready or status timeout elapses.
+        :param learn: True to update estimated commit time by this page
+        :return: Response of read status if the device is ready
+        :return: None on read error or if the device is still busy
+        """
+        if self.commit_time is None:
+            self.commit_time = self.frame_time()
+        # Commit time is measured from the end of page write, other devices may have been served meanwhile
+        start = self.sent
+        sleep(max(0.0, start + self.commit_time * COMMIT_SLEEP - monotonic()))
+        while True:
+            response = self.status_retry.call(lambda: self.mb.read(self.request_status()), self._retryable)
+            elapsed = monotonic() - start
+            if self.check_status(response):
+                if learn:
+                    self.commit_time += COMMIT_GAIN * (elapsed - self.commit_time)
+                return response
+            if response is None or elapsed >= self.status_timeout:
+                return None
+            sleep(max(self.commit_time * STATUS_POLL, self.frame_time() * MIN_STATUS_POLL))
+
+    def frame_time(self):
+        """
+        Time of status read transaction given by frame model of the bus
+        :return: Time in seconds
+        """
+        return self.mb.timeouts.model.read_time(1)
+
+    def _set_checkpoint(self, request):
+        """
+        Checkpoint acknowledged request, page index is given by the offset in page frame
+        :param request: Acknowledged write request
+        :return: None
+        """
+        if request is self.header:
+            self.checkpoint = 0
+        else:
+            values = request['Values']
+            self.checkpoint = (values[1] + (values[2] << 16)) // self.LEN_UPG_PAGE + 1
+
+    def _resume(self):
+        """
+        Continue from the first page not acknowledged, header is sent again if it was not acknowledged
+        :return: Next request to send
+        """
+        if self.checkpoint is None:
+            self.log.warning('Upgrade restarted')
+            self.pages = self.page_requests()
+            return self.header
+        self.log.warning('Upgrade resumed from page {0} of {1}'.format(self.checkpoint, self.size))
+        self.progress = self.checkpoint
+        self.pages = self.page_requests(self.checkpoint)
+        return next(self.pages, None)
+
+    def _retryable(self):
+        """
+        Is it worth to retry the last failed transaction
+        :return: True if the transaction may be retried
+        """
+        return self.mb.retryable(self.slave)
+
     def terminate(self):
         """
-        Terminate upgrade procedure for some reason
+        Terminate upgrade procedure for some reason, checkpoint is kept for resume
         :return: None
         """
-        self.log.info('Upgrade terminated. Remaining {0} pages'.format(len(self.reqs)))
-        self.reqs.clear()
-        self.progress = 0
+        self.log.info('Upgrade terminated. Remaining {0} pages'.format(self.size - self.progress))
+        self.pages = iter(())
         self.errors += 1
 
 
+class UpgradeImage:
+    """
+    Firmware image divided into page frames of upgrade.
+
+    Image is memory mapped and frames (page size, offset, data words and footer) are created lazily. With cache,
+    every frame is created only once and shared by upgrades of all devices flashed by the image.
+    """
+
+    def __init__(self, file_name, align, page_bytes, cache=False):
+        """
+        Open firmware binary file, its length is aligned by zeros
+        :param file_name: Firmware filename
+        :param align: Byte alignment of target memory operations
+        :param page_bytes: Size of page in bytes
+        :param cache: True to keep created frames
+        """
+        self.map = None
+        with io.open(file_name, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = memoryview(self.map)
+            except ValueError:
+                # Empty file cannot be mapped
+                self.data = memoryview(f.read())
+        length = len(self.data)
+        if length % align != 0:
+            length += align - (length % align)
+        self.name = file_name
+        self.length = length
+        self.page_bytes = page_bytes
+        self.size = int((length + page_bytes - 1)/page_bytes)
+        self.frames = [None] * self.size if cache else None
+        self.crc_val = None
+
+    def frame(self, page):
+        """
+        Get register values of page frame, words are converted from the image without copying single words
+        :param page: Index of page
+        :return: array('H') of register values
+        """
+        if self.frames is not None and self.frames[page] is not None:
+            return self.frames[page]
+        off = page * self.page_bytes
+        data = self.data[off:off + self.page_bytes]
+        # Offset, data words in little endian, zero padding, footer with flag of valid page
+        page_data = array('H', [self.page_bytes, off & ((1 << 16)-1), off >> 16])
+        if len(data) % 2 != 0:
+            data = bytes(data) + b'\x00'
+        words = array('H')
+        words.frombytes(data)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        page_data.extend(words)
+        page_data.frombytes(bytes(self.page_bytes - len(data) + MbUpgrade.FOOTER_LEN * 2))
+        page_data[-1] = 1
+        if self.frames is not None:
+            self.frames[page] = page_data
+        return page_data
+
+    def crc(self):
+        """
+        Calculate CRC of the image padded by align, the image is processed in chunks and never copied as a whole
+        :return: CRC32 as computed by the device
+        """
+        if self.crc_val is None:
+            crc = Crc32.Crc32()
+            for off in range(0, len(self.data), CRC_CHUNK):
+                crc.update(self.data[off:off + CRC_CHUNK])
+            # Zero padding to align and to whole 32-bit words
+            self.crc_val = crc.update(bytes(self.length - len(self.data) + (-self.length) % 4)).digest()
+        return self.crc_val
+
+    def close(self):
+        """
+        Unmap the file, frames cannot be created anymore, only CRC calculated before is available
+        :return: None
+        """
+        self.data.release()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
@@ -0,0 +1,224 @@
+import logging
+import queue
+import threading
+from time import monotonic
+
+from VisualModbus.MbUpgrade import MbUpgrade
+
+
+class MbWorker(threading.Thread):
+    """
+    Background modbus I/O worker of the GUI.
+
+    The worker owns MbClient and RegMap, takes commands from the GUI through a queue and posts results back to the
+    window by write_event_value, so slow or missing slave never blocks the window. While the port is open, registers
+    in view of the GUI (shown or pinned) and registers subscribed by others are read periodically, all registers are
+    read with slow background period. Only changed values are posted.
+    """
+    # Events posted to the window
+    EV_CHANGES = '-MB_CHANGES-'
+    EV_DONE = '-MB_DONE-'
+    EV_PROGRESS = '-MB_PROGRESS-'
+
+    def __init__(self, window, mb, regs, period=1.0, slow_period=10.0):
+        """
+        Initialize worker, it is started by start()
+        :param window: Window receiving events (write_event_value)
+        :param mb: MbClient object
+        :param regs: RegMap object
+        :param period: Period of polling in seconds, 0 disables polling
+        :param slow_period: Period of reading all registers in seconds
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.window = window
+        self.mb = mb
+        self.regs = regs
+        self.period = period
+        self.slow_period = slow_period
+        self.polling = False
+        # Names of registers in view, None until the GUI reports its view (all registers are polled)
+        self.view = None
+        self.queue = queue.Queue()
+        self.commands = {'open': self._open, 'close': self._close, 'read': self._read, 'read_name': self._read_name,
+                         'write': self._write, 'write_all': self._write_all, 'slave': self._slave,
+                         'period': self._period, 'view': self._view, 'upgrade': self._upgrade}
+        self.log = logging.getLogger()
+        # Changes are posted once per read
+        self.regs.auto_notify = False
+        self.sub = self.regs.subscribe(list(self.regs.groups), self._post_changes)
+
+    def send(self, command, *args):
+        """
+        Send command to the worker, returns immediately. Result is posted as EV_DONE event (command, result).
+        :param command: 'open', 'close', 'read', 'read_name', 'write', 'write_all', 'slave', 'period', 'view' or
+        'upgrade'
+        :param args: Arguments of command
+        :return: None
+        """
+        self.queue.put((command, args))
+
+    def stop(self):
+        """
+        Close the port and stop the worker, blocks until the current command is finished
+        :return: None
+        """
+        self.queue.put(('stop', ()))
+        self.join()
+
+    def run(self):
+        """
+        Worker loop, executes commands and polls registers when idle
+        :return: None
+        """
+        due = slow_due = monotonic()
+        while True:
+            timeout = None
+            if self.polling and self.period > 0:
+                timeout = max(0.0, due - monotonic())
+            try:
+                command, args = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if self.view is None or monotonic() >= slow_due:
+                    self._read()
+                    slow_due = monotonic() + self.slow_period
+                else:
+                    self._read_view()
+                # Skip periods missed by slow reads
+                due = max(due + self.period, monotonic())
+                continue
+            if command == 'stop':
+                self._close()
+                break
+            ret = self.commands[command](*args)
+            self.window.write_event_value(self.EV_DONE, (command, ret))
+            if command == 'open' and ret:
+                due = slow_due = monotonic()
+
+    def _post_changes(self, changes):
+        """
+        Post changed registers formatted for visual
+        :param changes: Dictionary {name: value} of changed registers
+        :return: None
+        """
+        regs = [self.regs.get_by_name(name) for name in changes]
+        self.window.write_event_value(self.EV_CHANGES, {reg['Name']: (self.regs.val_to_str(reg),
+                                                                      self.regs.val_to_hex(reg)) for reg in regs})
+
+    def _open(self, settings):
+        """
+        Open port, prefetch constants and start polling
+        :param settings: Json settings file
+        :return: True if connected, False on error
+        """
+        ret = self.mb.open(settings)
+        if ret:
+            self.regs.replan()
+            self.regs.prefetch()
+            self.regs.notify()
+            self.polling = True
+        return ret
+
+    def _close(self):
+        """
+        Stop polling and close port
+        :return: None
+        """
+        self.polling = False
+        self.mb.close()
+
+    def _read(self):
+        """
+        Read all registers
+        :return: 0 on read success
+        :return: None on read error
+        """
+        ret = self.regs.read_in()
+        if self.regs.read_hold() is None:
+            ret = None
+        self.regs.notify()
+        return ret
+
+    def _read_view(self):
+        """
+        Read registers in view and registers subscribed by others, constants are not read again
+        :return: None
+        """
+        names = set(self.view)
+        for handle, sub in self.regs.subs.items():
+            if handle != self.sub:
+                names.update(sub['Last'])
+        names = [name for name in names if name not in self.regs.consts]
+        if len(names):
+            self.regs.read_many(sorted(names))
+            self.regs.notify()
+
+    def _read_name(self, name):
+        """
+        Read one register
+        :param name: Register name
+        :return: Register value on read success
+        :return: None on read error
+        """
+        ret = self.regs.read_by_name(name)
+        self.regs.notify()
+        return ret
+
+    def _write(self, values, suffix):
+        """
+        Write registers changed in visual
+        :param values: Dictionary of values in visual
+        :param suffix: Key suffix of hexadecimal fields
+        :return: 0 on write success
+        :return: None on write error
+        """
+        return self.regs.from_visual(values, suffix)
+
+    def _write_all(self):
+        """
+        Write all writable holding registers
+        :return: 0 on write success
+        :return: None on write error
+        """
+        return self.regs.write_hold()
+
+    def _slave(self, slave):
+        """
+        Change slave address, cached values of the previous slave are forgotten
+        :param slave: Slave address
+        :return: None
+        """
+        self.regs.slave = slave
+        self.regs.invalidate()
+
+    def _period(self, period):
+        """
+        Change period of polling
+        :param period: Period in seconds, 0 disables polling
+        :return: None
+        """
+        self.period = period
+
+    def _view(self, names):
+        """
+        Change registers in view, they are polled with the period of polling
+        :param names: List of register names shown or pinned in the GUI
+        :return: None
+        """
+        self.view = names
+
+    def _upgrade(self, settings, file_name):
+        """
+        Run firmware upgrade, progress is posted as EV_PROGRESS event (progress, size)
+        :param settings: Json upgrade settings file
+        :param file_name: Binary file to upgrade
+        :return: 0 on success
+        :return: non-zero on error
+        """
+        upg = MbUpgrade(settings, self.mb, slave=self.regs.slave, regs=self.regs)
+        try:
+            upg.load_file(file_name)
+            return upg.run_upgrade(lambda progress, size: self.window.write_event_value(self.EV_PROGRESS,
+                                                                                       (progress, size)))
+        finally:
+            # Upgrade is not resumed from the GUI, image is closed even after failure
+            upg.close()
@@ -0,0 +1,188 @@
+import asyncio
+import math
+from time import monotonic, sleep
+
+
+class PollScheduler:
+    """
+    Multi-rate poll scheduler of registers of one or more slaves on one bus.
+
+    Every register has its own period, given by 'Period' in register map json (seconds, 0 reads the register only
+    once, failed read is repeated after default period), by set_period at runtime or by default period. Registers due within the same tick are read by coalesced
+    requests. Phases of slaves are shifted to spread the load of the bus evenly. Deadline misses (register not read
+    before its next due time) and jitter (delay of the read after its due time) are tracked per slave and group.
+    """
+
+    def __init__(self, regmaps, default_period=1.0, tick=0.01):
+        """
+        Initialize scheduler
+        :param regmaps: RegMap (or AsyncRegMap) or list of them, all on the same bus
+        :param default_period: Period of registers without configured period in seconds
+        :param tick: Registers due within tick are read together, in seconds
+        """
+        self.maps = regmaps if isinstance(regmaps, list) else [regmaps]
+        self.default_period = default_period
+        self.tick = tick
+        self.items = []
+        self.stats = {}
+        for regs in self.maps:
+            items = {}
+            for reg in regs.input + regs.hold:
+                items[reg['Name']] = {'Period': reg.get('Period', default_period), 'Due': 0.0}
+            self.items.append(items)
+        self.start()
+
+    def start(self, now=None):
+        """
+        (Re)start schedule, phases of slaves are spread over the period
+        :param now: Current time (monotonic), None for actual time
+        :return: None
+        """
+        now = monotonic() if now is None else now
+        for k, items in enumerate(self.items):
+            for item in items.values():
+                item['Due'] = now + item['Period'] * k / len(self.items)
+
+    def set_period(self, targets, period, slave=None):
+        """
+        Set period of registers at runtime
+        :param targets: Name of register or group, or list of them
+        :param period: Period in seconds, 0 to read only once
+        :param slave: Slave address, None for all slaves
+        :return: None
+        """
+        targets = [targets] if isinstance(targets, str) else targets
+        now = monotonic()
+        for regs, items in zip(self.maps, self.items):
+            if slave is not None and regs.slave != slave:
+                continue
+            for target in targets:
+                regs_t = [regs.names[target]] if target in regs.names else regs.get_group(target)
+                for reg in regs_t:
+                    item = items[reg['Name']]
+                    item['Period'] = period
+                    item['Due'] = min(item['Due'], now + period)
+
+    def next_due(self):
+        """
+        Get time of the nearest due register
+        :return: Time (monotonic)
+        """
+        return min((item['Due'] for items in self.items for item in items.values()), default=math.inf)
+
+    def poll(self, now=None):
+        """
+        Read all registers that are due
+        :param now: Current time (monotonic), None for actual time
+        :return: 0 on success
+        :return: None on read error
+        """
+        now = monotonic() if now is None else now
+        ret = 0
+        for k, regs in enumerate(self.maps):
+            due = self._due(k, now)
+            if len(due) == 0:
+                continue
+            start = monotonic()
+            ok = regs.read_regs(due) is not None
+            if not ok:
+                ret = None
+            self._done(k, due, ok, start, monotonic())
+        return ret
+
+    async def poll_async(self, now=None):
+        """
+        Read all registers that are due, for AsyncRegMap
+        :param now: Current time (monotonic), None for actual time
+        :return: 0 on success
+        :return: None on read error
+        """
+        now = monotonic() if now is None else now
+        ret = 0
+        for k, regs in enumerate(self.maps):
+            due = self._due(k, now)
+            if len(due) == 0:
+                continue
+            start = monotonic()
+            ok = await regs.read_regs(due) is not None
+            if not ok:
+                ret = None
+            self._done(k, due, ok, start, monotonic())
+        return ret
+
+    def run(self, duration):
+        """
+        Run schedule for given time, blocks until finished
+        :param duration: Time to run in seconds
+        :return: None
+        """
+        end = monotonic() + duration
+        while monotonic() < end:
+            self.poll()
+            sleep(max(0.0, min(self.next_due(), end) - monotonic()))
+
+    async def run_async(self, duration):
+        """
+        Run schedule for given time, for AsyncRegMap
+        :param duration: Time to run in seconds
+        :return: None
+        """
+        end = monotonic() + duration
+        while monotonic() < end:
+            await self.poll_async()
+            await asyncio.sleep(max(0.0, min(self.next_due(), end) - monotonic()))
+
+    def get_stats(self, clear=1):
+        """
+        Return statistics of reads per slave and group
+        :param clear: Non-zero value clear the statistics
+        :return: Dictionary {(slave, group): {'Reads', 'Misses', 'Errors', 'Jitter', 'MaxJitter'}}
+        """
+        ret = {}
+        for key, st in self.stats.items():
+            ret[key] = dict(st)
+            ret[key]['Jitter'] = st['Jitter'] / st['Reads'] if st['Reads'] else 0.0
+        if clear:
+            self.stats = {}
+        return ret
+
+    def _due(self, k, now):
+        """
+        Get registers of slave that are due within the tick
+        :param k: Index of register map
+        :param now: Current time
+        :return: List of registers
+        """
+        names = self.maps[k].names
+        return [names[name] for name, item in self.items[k].items() if item['Due'] <= now + self.tick]
+
+    def _done(self, k, regs, ok, start, end):
+        """
+        Update schedule and statistics of registers after read
+        :param k: Index of register map
+        :param regs: List of read registers
+        :param ok: True if read succeeded
+        :param start: Time when read started
+        :param end: Time when read finished
+        :return: None
+        """
+        slave = self.maps[k].slave
+        for reg in regs:
+            item = self.items[k][reg['Name']]
+            st = self.stats.setdefault((slave, reg['Group']),
+                                       {'Reads': 0, 'Misses': 0, 'Errors': 0, 'Jitter': 0.0, 'MaxJitter': 0.0})
+            jitter = max(0.0, start - item['Due'])
+            st['Reads'] += 1
+            st['Errors'] += 0 if ok else 1
+            st['Jitter'] += jitter
+            st['MaxJitter'] = max(st['MaxJitter'], jitter)
+            if item['Period'] == 0:
+                # Register read only once is read again after default period until the read succeeds
+                item['Due'] = math.inf if ok else end + self.default_period
+                continue
+            # Deadline is the next due time, skip all periods that were missed
+            item['Due'] += item['Period']
+            if end > item['Due']:
+                missed = math.floor((end - item['Due']) / item['Period']) + 1
+                st['Misses'] += missed
+                item['Due'] += missed * item['Period']
@@ -101,6 +101,7 @@ def read_write_reopen(baud_rate, parity, stop_bits):
     mb.s['parity'] = parity
     mb.s['stop_bits'] = stop_bits
     mb.open()
+    regs.replan()
 
 
 def read_write_close():
@@ -0,0 +1,146 @@
+import struct
+
+"""
+Struct codes of register formats. Registers are transferred least significant word first and every 16-bit word
+is little-endian after packing, so the whole register is little-endian in the packed buffer.
+"""
+_INT_CODES = {1: 'H', 2: 'I', 4: 'Q'}
+
+
+class RegCodec:
+    """
+    Precompiled conversion of one register between its native value and modbus 16-bit words
+    """
+
+    def __init__(self, reg):
+        """
+        Compile fixed-width struct formats for given register
+        :param reg: Register
+        """
+        self.format = reg['Format']
+        self.count = len(reg['Address'])
+        size = 2 * self.count
+        if self.format == 'FLOAT':
+            code = 'h'
+        elif self.format == 'FLOAT32':
+            code = 'f'
+        elif self.format == 'STRING':
+            code = '{}s'.format(size)
+        else:
+            code = _INT_CODES.get(self.count, '{}s'.format(size))
+        # Pad formats that do not use all words of register
+        pad = size - struct.calcsize('<' + code)
+        if pad > 0:
+            code += '{}x'.format(pad)
+        self.code = code
+        self.value = struct.Struct('<' + code)
+        self.words = struct.Struct('<{}H'.format(self.count))
+        self.mask = (1 << (16 * self.count)) - 1
+
+    def convert(self, raw):
+        """
+        Convert value unpacked by struct into native value
+        :param raw: Unpacked value
+        :return: Float, integer or string value
+        """
+        if self.format == 'FLOAT':
+            return raw / 10
+        elif self.format == 'FLOAT32':
+            return round(raw, 4)
+        elif self.format == 'STRING':
+            return raw.partition(b'\0')[0].decode('utf-8')
+        elif type(raw) is bytes:
+            return int.from_bytes(raw, byteorder='little', signed=False)
+        return raw
+
+    def coerce(self, value):
+        """
+        Convert value given by user (number or string) into native value
+        :param value: Value to convert
+        :return: Float, integer or string value
+        """
+        if self.format in ('FLOAT', 'FLOAT32'):
+            return float(value)
+        elif self.format == 'STRING':
+            return str(value)
+        else:
+            return int(value)
+
+    def decode(self, values):
+        """
+        Decode register from modbus received values
+        :param values: Array of 16-bit numbers from modbus
+        :return: Float, integer or string value
+        """
+        return self.convert(self.value.unpack(self.words.pack(*values))[0])
+
+    def encode(self, value):
+        """
+        Encode native value into modbus representation
+        :param value: Float, integer or string value
+        :return: Array of 16-bit values for modbus
+        """
+        if self.format == 'FLOAT':
+            # Masked to 16 bits like unsigned register, decoded as signed
+            raw = ((int(value * 10) + 0x8000) & 0xFFFF) - 0x8000
+        elif self.format == 'FLOAT32':
+            raw = value
+        elif self.format == 'STRING':
+            raw = value.encode('utf-8')
+        else:
+            raw = value & self.mask
+            if self.code[-1] == 's':
+                raw = raw.to_bytes(2 * self.count, byteorder='little')
+        return list(self.words.unpack(self.value.pack(raw)))
+
+
+class BlockPlan:
+    """
+    Precompiled decoding of one block of consecutive 16-bit words into registers.
+
+    The whole block is packed once and unpacked by a single struct covering all registers that start and end
+    inside the block. Other words (gaps, partially covered registers) are skipped as padding.
+    """
+
+    def __init__(self, index, codecs, address, count):
+        """
+        Compile block decode plan
+        :param index: Address index of register space (address -> register, word position)
+        :param codecs: Dictionary of register name -> RegCodec
+        :param address: First address of the block
+        :param count: Number of words in the block
+        """
+        self.address = address
+        self.count = count
+        self.regs = []
+        self.codecs = []
+        fmt = ['<']
+        pad = 0
+        i = 0
+        while i < count:
+            item = index.get(address + i)
+            if item is not None and item[1] == 0 and i + len(item[0]['Address']) <= count:
+                codec = codecs[item[0]['Name']]
+                if pad:
+                    fmt.append('{}x'.format(2 * pad))
+                    pad = 0
+                fmt.append(codec.code)
+                self.regs.append(item[0])
+                self.codecs.append(codec)
+                i += codec.count
+            else:
+                pad += 1
+                i += 1
+        if pad:
+            fmt.append('{}x'.format(2 * pad))
+        self.words = struct.Struct('<{}H'.format(count))
+        self.block = struct.Struct(''.join(fmt))
+
+    def decode(self, values):
+        """
+        Decode all registers of the block
+        :param values: Array of 16-bit numbers from modbus
+        :return: List of (register, value) pairs
+        """
+        raw = self.block.unpack(self.words.pack(*values))
+        return [(reg, codec.convert(val)) for reg, codec, val in zip(self.regs, self.codecs, raw)]
@@ -1,114 +1,127 @@
 import io
 import json
-import struct
-from time import sleep
+from time import monotonic, sleep
 
+from VisualModbus.RegCodec import RegCodec, BlockPlan
+from VisualModbus.MbPlanner import FrameModel, ReadPlanner, plan_writes
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbRetry import RetryPolicy
 
-def _get_values_for_mb(reg):
+"""
+Maximal number of memoized request plans of read_many and write_many
+"""
+MAX_MANY_PLANS = 256
+
+"""
+Groups of read-only registers that do not change while the device is connected
+"""
+CONST_GROUPS = ('FACT', 'FIRM')
+
+"""
+Operations yielded by communication core of register map, they are executed by blocking or awaitable client
+"""
+READ = 'Read'
+WRITE = 'Write'
+SLEEP = 'Sleep'
+
+
+def _has_hex(reg):
     """
-    Return modbus representation of register
+    Is register of integer type
     :param reg: Register
-    :return: Array of 16-bit values for modbus
+    :return: True for integers
     """
-    short_mask = ((1 << 16) - 1)
-    if reg['Format'] == 'FLOAT':
-        values = int(float(reg['Value']) * 10)
-        values = values if values >= 0 else values + (1 << 16)
-        values = [values]
-    elif reg['Format'] == 'FLOAT32':
-        number = struct.unpack('L', struct.pack('f', float(reg['Value'])))[0]
-        values = [number & short_mask, number >> 16]
-    elif reg['Format'] == 'STRING':
-        number = bytearray(str(reg['Value']), encoding='utf-8')
-        values = [0] * len(reg['Address'])
-        for i in range(min(len(number), 2*len(reg['Address']))):
-            values[i // 2] |= int(number[i]) << (8 * (i % 2))
+    if reg['Format'] in ('FLOAT', 'FLOAT32', 'STRING'):
+        return False
     else:
-        values = []
-        for i in range(len(reg['Address'])):
-            values.append((int(reg['Value']) >> (i * 16)) & short_mask)
-    return values
+        return True
 
 
-def _set_value_from_mb(reg, values):
+def _writable(reg):
     """
-    Set register value from modbus received values
+    Is register writable
     :param reg: Register
-    :param values: Array of 16-bit numbers from modbus
-    :return: None (value is updated within register)
+    :return: False for read-only registers
     """
-    if reg['Format'] == 'FLOAT':
-        reg['Value'] = str(float(values[0] if values[0] < (1 << 15) else values[0] - (1 << 16)) / 10)
-    elif reg['Format'] == 'FLOAT32':
-        number = int(values[0]) + (int(values[1]) << 16)
-        reg['Value'] = str(round(struct.unpack('f', struct.pack('L', number))[0], 4))
-    elif reg['Format'] == 'STRING':
-        buf = bytearray(len(values) * 2)
-        for i in range(len(values)):
-            buf[2*i + 0] = values[i] & 0xFF
-            buf[2*i + 1] = values[i] >> 8
-        reg['Value'] = buf.partition(b'\0')[0].decode('utf-8')
-    else:
-        temp_value = 0
-        for i in range(len(values)):
-            temp_value |= values[i] << (i * 16)
-        reg['Value'] = str(temp_value)
+    return not reg.get('Access', 'RW').startswith('RO')
 
 
-def _get_value(reg):
+def _constant(reg):
     """
-    Return value of register in proper format
+    Is register constant while the device is connected. Given by 'Constant' in register map, otherwise registers with
+    access ROF and read-only factory and firmware registers are constant.
     :param reg: Register
-    :return: Float, integer or string value
+    :return: True if constant
     """
-    if reg['Format'] == 'FLOAT' or reg['Format'] == 'FLOAT32':
-        return float(reg['Value'])
-    elif reg['Format'] == 'STRING':
-        return reg['Value']
-    else:
-        return int(reg['Value'])
+    access = reg.get('Access', 'RW')
+    return reg.get('Constant', access == 'ROF' or (access == 'RO' and reg['Group'] in CONST_GROUPS))
 
 
-def _has_hex(reg):
+def _space(reg_type):
     """
-    Is register of integer type
-    :param reg: Register
-    :return: True for integers
+    Get register space of request or register type
+    :param reg_type: Type of registers ('Input', 'INPUT', 'Holding', 'HOLD')
+    :return: 'Input' or 'Holding'
     """
-    if reg['Format'] in ('FLOAT', 'FLOAT32', 'STRING'):
-        return False
-    else:
-        return True
+    return 'Input' if reg_type.lower() == 'input' else 'Holding'
 
 
 class RegMap:
     """
-    Modbus register map class
+    Modbus register map class.
+
+    Communication of all methods is implemented once by generators (methods ending with _io), which yield
+    operations (READ, WRITE, SLEEP) and receive their results. RegMap executes the operations by blocking MbClient,
+    AsyncRegMap awaits them on AsyncMbClient.
     """
-    def __init__(self, mb, slave=1, attempts=2, delay=0.5):
+    def __init__(self, mb, slave=1, attempts=2, delay=0.5, retry=None):
+        """
+        Initialize empty register map of slave
+        :param mb: MbClient object
+        :param slave: Slave address
+        :param attempts: Number of communication attempts of single register access
+        :param delay: Delay before the first retry in seconds
+        :param retry: RetryPolicy, overrides attempts and delay
+        """
         self.input = []
         self.hold = []
-        self.wrReq = []
-        self.rdReq = []
         self.max_len = 20
         self.hold_a = []
         self.input_a = []
+        self.input_idx = {}
+        self.hold_idx = {}
+        self.names = {}
+        self.groups = {}
+        self.codecs = {}
+        self.plans = {}
+        self.many_plans = {}
+        self.consts = {}
+        self.stamps = {}
+        self.generation = 0
+        self.subs = {}
+        self.sub_id = 0
+        self.watched = {}
+        self.changes = {}
+        self.auto_notify = True
+        self.planner = ReadPlanner()
         self.mb = mb
         self.slave = slave
         self.errors = 0
         self.bounds = 0
-        self.last_write = None
-        self.attempts = attempts
-        self.delay = delay
+        self.retry = RetryPolicy(attempts, delay) if retry is None else retry
 
     def load(self, filename):
         """
-        Load register map from json file and sort them into input and holding groups
+        Load register map from json file and sort them into input and holding groups.
+        Address indexes (address -> register, word position) and name index are built as well.
+        Register values are kept in their native type (integer, float, string). Address ranges are planned and
+        their decode plans are compiled in advance. Values of the previous map are not cached anymore.
         :param filename: Json register map file
         :return: None
         """
         with io.open(filename, 'r', encoding='utf-8-sig') as f:
             regs = json.load(f)
+        self.stamps.clear()
 
         # Parse list of registers and count maximal address
         for reg in regs:
@@ -120,50 +133,50 @@ class RegMap:
                 reg['Label'] = ""
             if 'Description' not in reg:
                 reg['Description'] = ""
+            if 'Group' not in reg:
+                reg['Group'] = reg['Name'].split('_')[0]
+            self.names[reg['Name']] = reg
+            self.groups.setdefault(reg['Group'], []).append(reg)
+            self.codecs[reg['Name']] = RegCodec(reg)
+            reg['Value'] = self.codecs[reg['Name']].coerce(reg['Value'])
+            if _constant(reg):
+                self.consts[reg['Name']] = reg
+            idx = self.hold_idx if reg['Type'] == 'HOLD' else self.input_idx
+            for pos, addr in enumerate(reg['Address']):
+                idx[addr] = (reg, pos)
             if reg['Type'] == 'HOLD':
                 self.hold.append(reg)
-                if len(self.hold_a) != 0 and reg['Address'][0] == self.hold_a[-1][-1] + 1 and \
-                        reg['Address'][-1] - self.hold_a[-1][0] < 123:
-                    self.hold_a[-1][-1] = reg['Address'][-1]
-                else:
-                    self.hold_a.append([reg['Address'][0], reg['Address'][-1]])
             else:
                 self.input.append(reg)
-                if len(self.input_a) != 0 and reg['Address'][0] == self.input_a[-1][-1] + 1 and \
-                        reg['Address'][-1] - self.input_a[-1][0] < 123:
-                    self.input_a[-1][-1] = reg['Address'][-1]
-                else:
-                    self.input_a.append([reg['Address'][0], reg['Address'][-1]])
+        self.replan()
+
+    def replan(self):
+        """
+        Plan address ranges read by read_in and read_hold and compile their decode plans.
+        Should be called again when communication settings change.
+        :return: None
+        """
+        self.planner.model = FrameModel.from_settings(self.mb.s)
+        self.input_a = self.planner.plan('Input', self.input)
+        self.hold_a = self.planner.plan('Holding', self.hold)
+        self.plans.clear()
+        self.many_plans.clear()
+        for rng in self.input_a:
+            self._get_plan('Input', rng[0], rng[1] - rng[0] + 1)
+        for rng in self.hold_a:
+            self._get_plan('Holding', rng[0], rng[1] - rng[0] + 1)
 
     def from_visual(self, values, suffix):
         """
-        Create write request of values that changed its value in visual interface
-        :param values: List of all values
+        Create write request of values that changed its value in visual interface.
+        Changed registers with consecutive addresses are written by one request, nothing is sent without change.
+        Registers missing in values (not shown in visual) are not compared.
+        :param values: Dictionary of values in visual
         :param suffix: Suffix for HEX values
         :return: 0 on write success
         :return: None on write error
         """
-        for reg in self.hold:
-            write = 0
-            new_val = values[reg['Name']]
-            if reg['Value'] != new_val:
-                write = 1
-            elif _has_hex(reg):
-                new_val = values[reg['Name'] + suffix]
-                if new_val != self.val_to_hex(reg):
-                    new_val = str(int(new_val.replace("0x", ""), 16))
-                    write = 1
-            if write != 0:
-                reg['Value'] = new_val
-                self._check_limits(reg)
-                values_reg = _get_values_for_mb(reg)
-                self.last_write = {'Address': reg['Address'][0], 'Count': len(values_reg), 'Values': values_reg,
-                                   'Slave': self.slave}
-                self.wrReq.append(self.last_write)
-
-        if not self.wrReq and self.last_write is not None:
-            self.wrReq.append(self.last_write)
-        return self._send_write()
+        return self._run(self._send_write_io(self._write_requests(self._visual_changes(values, suffix))))
 
     def read_in(self):
         """
@@ -171,9 +184,7 @@ class RegMap:
         :return: 0 on read success
         :return: None on read error
         """
-        for rng in self.input_a:
-            self.rdReq.append({'Address': rng[0], 'Count': rng[1] - rng[0] + 1, 'Type': 'Input', 'Slave': self.slave})
-        return self._send_read()
+        return self._run(self._send_read_io(self._range_requests('Input', self.input_a)))
 
     def read_hold(self):
         """
@@ -181,66 +192,79 @@ class RegMap:
         :return: 0 on read success
         :return: None on read error
         """
-        for rng in self.hold_a:
-            self.rdReq.append({'Address': rng[0], 'Count': rng[1] - rng[0] + 1, 'Type': 'Holding', 'Slave': self.slave})
-        return self._send_read()
+        return self._run(self._send_read_io(self._range_requests('Holding', self.hold_a)))
+
+    def read_regs(self, regs):
+        """
+        Read given registers using the minimal number of requests
+        :param regs: List of registers
+        :return: 0 on read success
+        :return: None on read error
+        """
+        return self._run(self._send_read_io(self._regs_requests(regs)))
 
     def write_hold(self):
         """
-        Write all holding registers one-by-one using their current values
+        Write all writable holding registers using their current values
         :return: 0 on write success
         :return: None on write error
         """
+        return self._run(self._send_write_io(self._write_requests([reg for reg in self.hold if _writable(reg)])))
+
+    def _visual_changes(self, values, suffix):
+        """
+        Get registers whose value changed in visual interface, new values are set into registers
+        :param values: Dictionary of values in visual
+        :param suffix: Suffix for HEX values
+        :return: List of changed registers
+        """
+        dirty = []
         for reg in self.hold:
-            values_reg = _get_values_for_mb(reg)
-            self.wrReq.append({'Address': reg['Address'][0], 'Count': len(values_reg), 'Values': values_reg,
-                               'Slave': self.slave})
-        return self._send_write()
+            if not _writable(reg) or reg['Name'] not in values:
+                continue
+            write = 0
+            new_val = values[reg['Name']]
+            if self.val_to_str(reg) != new_val:
+                write = 1
+            elif _has_hex(reg):
+                new_val = values[reg['Name'] + suffix]
+                if new_val != self.val_to_hex(reg):
+                    new_val = int(new_val.replace("0x", ""), 16)
+                    write = 1
+            if write != 0:
+                reg['Value'] = self.codecs[reg['Name']].coerce(new_val)
+                self._check_limits(reg)
+                dirty.append(reg)
+        return dirty
 
     def from_modbus(self, request, values):
         """
-        Store new values received from modbus in internal collection of registers
+        Store new values received from modbus in internal collection of registers, values are cached with the time
+        of reception
         :param request: Sent read request
         :param values: received list of values
         :return: None
         """
-        address = request['Address']
-        regs = self.input if request['Type'].lower() == 'Input'.lower() else self.hold
-        for i in range(len(values)):
-            reg = next(x for x in regs if (address + i) in x['Address'])
-            pos = reg['Address'].index(address + i)
-            regs_for_value = len(reg['Address'])
-            if pos == 0:
-                _set_value_from_mb(reg, values[i:i+regs_for_value])
-                self._check_limits(reg)
-                i += regs_for_value - 1
+        self._sync_generation()
+        now = monotonic()
+        plan = self._get_plan(request['Type'], request['Address'], len(values))
+        for reg, value in plan.decode(values):
+            reg['Value'] = value
+            self.stamps[reg['Name']] = now
+            if reg['Name'] in self.watched:
+                self.changes[reg['Name']] = value
+            self._check_limits(reg)
 
-    def read_by_name(self, name):
+    def read_by_name(self, name, max_age=None):
         """
-        Read register identified by name
+        Read register identified by name. Constant registers are read only once per connection (together with all
+        other constants), other registers are read if their cached value is older than max_age.
         :param name: Register name
+        :param max_age: Maximal age of cached value in seconds, None to read always
         :return: Register value on read success
         :return: None on read error
         """
-        # Get register from list
-        reg = self.get_by_name(name)
-        ret = None
-        attempt = 0
-        # Read register with maximal number of attempts
-        while ret is None and attempt < self.attempts:
-            attempt += 1
-            # Create read request and send it
-            self.rdReq.append({'Address': reg['Address'][0], 'Count': len(reg['Address']), 'Type': reg['Type'],
-                               'Slave': self.slave})
-            ret = self._send_read()
-            # Wait on error
-            if ret is None:
-                sleep(self.delay)
-        if ret is None:
-            return None
-        else:
-            self._check_limits(reg)
-            return _get_value(reg)
+        return self._run(self._read_by_name_io(name, max_age))
 
     def write_by_name(self, name, value):
         """
@@ -250,48 +274,132 @@ class RegMap:
         :return: 0 on write success
         :return: None on write error
         """
-        reg = self.get_by_name(name)
-        # Set new value into register
-        reg['Value'] = value
-        self._check_limits(reg)
-        values_reg = _get_values_for_mb(reg)
-        ret = None
-        attempt = 0
-        # Write register with maximal number of attempts
-        while ret is None and attempt < self.attempts:
-            attempt += 1
-            self.wrReq.append({'Address': reg['Address'][0], 'Count': len(values_reg), 'Values': values_reg,
-                               'Slave': self.slave})
-            ret = self._send_write()
-            # Wait on error
-            if ret is None:
-                sleep(self.delay)
-        return ret
+        return self._run(self._write_by_name_io(name, value))
 
     def write_multi_name(self, name, values):
         """
-        Write multiple registers in a row if their names are indexed by number at the end
+        Write multiple registers in a row if their names are indexed by number at the end.
+        Registers are written by the minimal number of requests, only failed requests are retried.
         :param name: Name of the first register (should end with _1)
         :param values: List of values to write to consecutive registers
-        :return: None on fail
+        :return: List of results per register (0 on write success, None on write error)
         """
-        ret = 0
-        for i in range(len(values)):
-            if self.write_by_name(name[:-1] + str(i + 1), values[i]) is None:
-                ret = None
-        return ret
+        return self._run(self._write_multi_name_io(name, values))
 
     def read_multi_name(self, name, count):
         """
-        Read multiple registers in a row if their names are indexed by number at the end
+        Read multiple registers in a row if their names are indexed by number at the end.
+        Registers are read by the minimal number of requests, only failed requests are retried.
         :param name: Name of the first register (should end with _1)
         :param count: Number of registers to read
-        :return: List of read values
+        :return: List of read values (None on read error of the register)
+        """
+        return self._run(self._read_multi_name_io(name, count))
+
+    def read_many(self, names, max_age=None):
+        """
+        Read registers given by names using the minimal number of requests. Request plan is memoized per set of
+        names, only failed requests are retried. Cached values are used like in read_by_name.
+        :param names: List of register names
+        :param max_age: Maximal age of cached value in seconds, None to read always
+        :return: Dictionary {name: value}, value is None on read error of the register
+        """
+        return self._run(self._read_many_io(names, max_age))
+
+    def write_many(self, values):
+        """
+        Write registers given by names using the minimal number of requests. Request plan is memoized per set of
+        names, only failed requests are retried.
+        :param values: Dictionary {name: value}
+        :return: Dictionary {name: result}, result is 0 on write success, None on write error
+        """
+        return self._run(self._write_many_io(values))
+
+    def prefetch(self):
+        """
+        Read all constant registers not cached yet, should be called after connect
+        :return: 0 on read success
+        :return: None on read error
+        """
+        return self._run(self._prefetch_io())
+
+    def invalidate(self, regs=None):
+        """
+        Forget cached values of registers
+        :param regs: List of registers, None for all registers
+        :return: None
+        """
+        if regs is None:
+            self.stamps.clear()
+            return
+        for reg in regs:
+            self.stamps.pop(reg['Name'], None)
+
+    def subscribe(self, targets, callback, deadband=0.0):
+        """
+        Subscribe to changes of register values. Callback gets dictionary {name: value} of registers whose read value
+        has changed since the last notification, once per notification batch (one read operation, or the cycle
+        between calls of notify if auto_notify is False).
+        :param targets: Name of register or group, or list of them
+        :param callback: Function called with dictionary of changed values
+        :param deadband: Minimal change of FLOAT and FLOAT32 register that is notified
+        :return: Subscription handle
+        """
+        targets = [targets] if isinstance(targets, str) else targets
+        regs = {}
+        for target in targets:
+            for reg in [self.names[target]] if target in self.names else self.get_group(target):
+                regs[reg['Name']] = reg
+        self.sub_id += 1
+        handle = self.sub_id
+        self.subs[handle] = {'Callback': callback, 'Deadband': deadband,
+                             'Last': {name: reg['Value'] for name, reg in regs.items()}}
+        for name in regs:
+            self.watched[name] = self.watched.get(name, 0) + 1
+        return handle
+
+    def unsubscribe(self, handle):
+        """
+        Cancel subscription
+        :param handle: Subscription handle returned by subscribe
+        :return: None
         """
-        vals = []
-        for i in range(count):
-            vals.append(self.read_by_name(name[:-1] + str(i + 1)))
-        return vals
+        sub = self.subs.pop(handle)
+        for name in sub['Last']:
+            self.watched[name] -= 1
+            if self.watched[name] == 0:
+                del self.watched[name]
+                self.changes.pop(name, None)
+
+    def notify(self):
+        """
+        Call subscribers with values changed since the last notification
+        :return: None
+        """
+        if len(self.changes) == 0:
+            return
+        changes = self.changes
+        self.changes = {}
+        for sub in list(self.subs.values()):
+            last = sub['Last']
+            changed = {}
+            for name, value in changes.items():
+                if name not in last or value == last[name]:
+                    continue
+                if sub['Deadband'] and self.names[name]['Format'] in ('FLOAT', 'FLOAT32') \
+                        and abs(value - last[name]) < sub['Deadband']:
+                    continue
+                changed[name] = last[name] = value
+            if len(changed):
+                sub['Callback'](changed)
+
+    def get_group(self, group):
+        """
+        Get registers of group. Group is given by 'Group' in register map or by name prefix (e.g., SYS, FACT)
+        :param group: Name of the group
+        :return: List of registers
+        """
+        return self.groups.get(group, [])
 
     def get_by_name(self, name):
         """
@@ -299,8 +407,15 @@ class RegMap:
         :param name: Name of the register
         :return: Register
         """
-        regs = self.input + self.hold
-        return next(x for x in regs if x['Name'] == name)
+        return self.names[name]
+
+    def val_to_str(self, reg):
+        """
+        Get string representation of register value
+        :param reg: Register
+        :return: String
+        """
+        return str(reg['Value'])
 
     def val_to_hex(self, reg):
         """
@@ -311,7 +426,7 @@ class RegMap:
         if reg['Format'] in ['FLOAT', 'FLOAT32', 'STRING']:
             return ""
         else:
-            return hex(int(reg['Value']))
+            return hex(reg['Value'])
 
     def get_error_count(self, clear=1):
         """
@@ -341,7 +456,30 @@ class RegMap:
         :return: None
         """
         if not self.mb.client.is_socket_open():
-            self.mb.open()
+            self.mb.reconnect()
+
+    def _get_index(self, reg_type):
+        """
+        Get address index of register space
+        :param reg_type: Type of registers ('Input', 'INPUT', 'Holding', 'HOLD')
+        :return: Dictionary of address -> (register, word position)
+        """
+        return self.input_idx if _space(reg_type) == 'Input' else self.hold_idx
+
+    def _get_plan(self, reg_type, address, count):
+        """
+        Get decode plan of block of registers, compile it on first use
+        :param reg_type: Type of registers ('Input', 'INPUT', 'Holding', 'HOLD')
+        :param address: First address of the block
+        :param count: Number of words in the block
+        :return: BlockPlan
+        """
+        key = (_space(reg_type), address, count)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = BlockPlan(self._get_index(reg_type), self.codecs, address, count)
+            self.plans[key] = plan
+        return plan
 
     def _check_limits(self, reg):
         """
@@ -350,55 +488,383 @@ class RegMap:
         :return: None
         """
         if reg['Min'] != 0 and reg['Max'] != 0:
-            if reg['Format'] == 'FLOAT' or reg['Format'] == 'FLOAT32':
-                if float(reg['Value']) > reg['Max']:
-                    self.bounds += 1
-                    # reg['Value'] = str(reg['Max'])
-                if float(reg['Value']) < reg['Min']:
-                    self.bounds += 1
-                    # reg['Value'] = str(reg['Min'])
-            elif reg['Format'] == 'STRING':
-                if len(reg['Value']) > reg['Max']:
-                    self.bounds += 1
-                if len(reg['Value']) < reg['Min']:
-                    self.bounds += 1
-            else:
-                if int(reg['Value']) > reg['Max']:
-                    self.bounds += 1
-                    # reg['Value'] = str(reg['Max'])
-                if int(reg['Value']) < reg['Min']:
-                    self.bounds += 1
-                    # reg['Value'] = str(reg['Min'])
+            value = len(reg['Value']) if reg['Format'] == 'STRING' else reg['Value']
+            if value > reg['Max']:
+                self.bounds += 1
+            if value < reg['Min']:
+                self.bounds += 1
+
+    def _family(self, name, count):
+        """
+        Get registers of indexed family, such as EMUL_TEMPERATURE_1..4
+        :param name: Name of the first register (should end with _1)
+        :param count: Number of registers
+        :return: List of registers
+        """
+        return [self.get_by_name(name[:-1] + str(i + 1)) for i in range(count)]
+
+    def _run(self, io):
+        """
+        Execute operations of communication core by blocking client
+        :param io: Generator of operations
+        :return: Result of the generator
+        """
+        try:
+            op, arg = next(io)
+            while True:
+                if op == SLEEP:
+                    sleep(arg)
+                    ret = None
+                else:
+                    ret = self.mb.read(arg) if op == READ else self.mb.write_hold(arg)
+                    ret = (ret, None if ret is not None else self.mb.last_exception())
+                op, arg = io.send(ret)
+        except StopIteration as stop:
+            return stop.value
+
+    def _read_by_name_io(self, name, max_age):
+        """
+        Communication core of read_by_name
+        """
+        reg = self.get_by_name(name)
+        stale = self._stale([reg], max_age)
+        # Read register with retries given by retry policy
+        if len(stale) and name in (yield from self._access_each_io(stale, self._regs_requests,
+                                                                   self._read_request_io)):
+            return None
+        return reg['Value']
+
+    def _write_by_name_io(self, name, value):
+        """
+        Communication core of write_by_name, the write is retried by retry policy
+        """
+        reg = self.get_by_name(name)
+        # Set new value into register
+        reg['Value'] = self.codecs[reg['Name']].coerce(value)
+        self._check_limits(reg)
+        self.retry.begin()
+        attempt = 0
+        while True:
+            ret = yield from self._send_write_io(self._write_requests([reg]))
+            attempt += 1
+            if ret is not None:
+                return ret
+            delay = self.retry.next_delay(attempt, self._retryable())
+            if delay is None:
+                return ret
+            yield SLEEP, delay
+
+    def _write_multi_name_io(self, name, values):
+        """
+        Communication core of write_multi_name
+        """
+        regs = self._family(name, len(values))
+        for reg, value in zip(regs, values):
+            reg['Value'] = self.codecs[reg['Name']].coerce(value)
+            self._check_limits(reg)
+        failed = yield from self._access_each_io(regs, self._write_requests, self._write_request_io)
+        return [None if reg['Name'] in failed else 0 for reg in regs]
+
+    def _read_multi_name_io(self, name, count):
+        """
+        Communication core of read_multi_name
+        """
+        regs = self._family(name, count)
+        failed = yield from self._access_each_io(regs, self._regs_requests, self._read_request_io)
+        return [None if reg['Name'] in failed else reg['Value'] for reg in regs]
+
+    def _read_many_io(self, names, max_age):
+        """
+        Communication core of read_many
+        """
+        regs = [self.get_by_name(name) for name in names]
+        stale = self._stale(regs, max_age)
+        failed = set()
+        if len(stale):
+            failed = yield from self._access_each_io(stale, self._many_read_requests, self._read_request_io)
+        return {reg['Name']: None if reg['Name'] in failed else reg['Value'] for reg in regs}
+
+    def _write_many_io(self, values):
+        """
+        Communication core of write_many
+        """
+        regs = [self.get_by_name(name) for name in values]
+        for reg in regs:
+            reg['Value'] = self.codecs[reg['Name']].coerce(values[reg['Name']])
+            self._check_limits(reg)
+        failed = yield from self._access_each_io(regs, self._many_write_requests, self._write_request_io)
+        return {reg['Name']: None if reg['Name'] in failed else 0 for reg in regs}
 
-    def _send_read(self):
+    def _prefetch_io(self):
         """
-        Send read request to modbus slave and parse response
+        Communication core of prefetch
+        """
+        self._sync_generation()
+        regs = [reg for name, reg in self.consts.items() if name not in self.stamps]
+        if len(regs) and len((yield from self._access_each_io(regs, self._regs_requests, self._read_request_io))):
+            return None
+        return 0
+
+    def _access_each_io(self, regs, make, send):
+        """
+        Access registers by coalesced requests, only registers of failed requests are retried by retry policy
+        :param regs: List of registers
+        :param make: Function creating list of requests of registers (_regs_requests, _write_requests)
+        :param send: Generator function sending one request (_read_request_io, _write_request_io)
+        :return: Set of names of registers that failed
+        """
+        self.retry.begin()
+        refused = set()
+        attempt = 0
+        while True:
+            failed = []
+            reqs = make(regs)
+            for k, req in enumerate(reqs):
+                ret, exception = yield from send(req)
+                if ret is None:
+                    self.errors += 1
+                    # Modbus exception would be returned again, registers of missing response are retried
+                    if exception is not None:
+                        refused |= {reg['Name'] for reg in self._request_regs([req], regs)}
+                        continue
+                    failed = self._request_regs(reqs[k:], regs)
+                    break
+            attempt += 1
+            if len(failed) == 0:
+                self._auto_notify()
+                return refused
+            delay = self.retry.next_delay(attempt, self._retryable())
+            if delay is None:
+                self._auto_notify()
+                return refused | {reg['Name'] for reg in failed}
+            yield SLEEP, delay
+            regs = failed
+
+    def _request_regs(self, reqs, regs):
+        """
+        Get registers covered by requests
+        :param reqs: List of read or write requests
+        :param regs: List of registers
+        :return: List of registers
+        """
+        ret = []
+        for req in reqs:
+            space = _space(req.get('Type', 'Holding'))
+            last = req['Address'] + req['Count'] - 1
+            ret += [reg for reg in regs if _space(reg['Type']) == space and req['Address'] <= reg['Address'][0] <= last]
+        return ret
+
+    def _sync_generation(self):
+        """
+        Forget all cached values if the client has reconnected since the last access
+        :return: None
+        """
+        if self.generation != self.mb.generation:
+            self.generation = self.mb.generation
+            self.stamps.clear()
+
+    def _stale(self, regs, max_age):
+        """
+        Get registers that must be read, because their cached value is missing or too old. If there is uncached
+        constant, all uncached constants are read with it.
+        :param regs: List of registers
+        :param max_age: Maximal age of cached value in seconds, None to read non-constant registers always
+        :return: List of registers
+        """
+        self._sync_generation()
+        now = monotonic()
+        stale = {}
+        for reg in regs:
+            stamp = self.stamps.get(reg['Name'])
+            if stamp is not None and (reg['Name'] in self.consts or max_age is not None and now - stamp <= max_age):
+                continue
+            stale[reg['Name']] = reg
+        if any(name in self.consts for name in stale):
+            for name, reg in self.consts.items():
+                if name not in self.stamps:
+                    stale[name] = reg
+        return list(stale.values())
+
+    def _auto_notify(self):
+        """
+        Notify subscribers at the end of read operation, unless the notifications are batched by caller
+        :return: None
+        """
+        if self.auto_notify:
+            self.notify()
+
+    def _retryable(self):
+        """
+        Is it worth to retry the last failed transaction
+        :return: True if the transaction may be retried
+        """
+        return self.mb.retryable(self.slave)
+
+    def _send_read_io(self, reqs):
+        """
+        Send read requests to modbus slave and parse responses. Requests refused by modbus exception do not stop the
+        others, the rest is skipped only if the slave does not respond.
+        :param reqs: List of read requests
         :return: 0 on read success
         :return: None on read error
         """
         ret = 0
-        for req in self.rdReq:
-            registers = self.mb.read(req)
-            if registers is not None:
-                self.from_modbus(req, registers)
-            else:
+        for req in reqs:
+            registers, exception = yield from self._read_request_io(req)
+            if registers is None:
                 ret = None
                 self.errors += 1
-                break
-        self.rdReq.clear()
+                if exception is None:
+                    break
+        self._auto_notify()
         return ret
 
-    def _send_write(self):
+    def _read_request_io(self, req):
+        """
+        Send one read request and parse response. If device refuses to read gap bridged by the planner, the gap is
+        remembered as address hole and registers around it are read by separate requests.
+        :param req: Read request
+        :return: Tuple (0, None) on read success
+        :return: Tuple (None, modbus exception code or None) on read error
+        """
+        registers, exception = yield READ, req
+        if registers is not None:
+            self.from_modbus(req, registers)
+            return 0, None
+        subs = self._split_on_holes(req, exception)
+        if subs is None:
+            return None, exception
+        for sub in subs:
+            ret = yield from self._read_request_io(sub)
+            if ret[0] is None:
+                return ret
+        return 0, None
+
+    def _write_request_io(self, req):
+        """
+        Send one write request
+        :param req: Write request
+        :return: Tuple (0, None) on write success
+        :return: Tuple (None, modbus exception code or None) on write error
         """
-        Send write request to modbus slave and check response
+        return (yield WRITE, req)
+
+    def _send_write_io(self, reqs):
+        """
+        Send write requests to modbus slave and check responses
+        :param reqs: List of write requests
         :return: 0 on write success
         :return: None on write error
         """
         ret = 0
-        for req in self.wrReq:
-            ret = self.mb.write_hold(req)
-            if ret is None:
+        for req in reqs:
+            result, exception = yield from self._write_request_io(req)
+            if result is None:
+                ret = None
                 self.errors += 1
-                break
-        self.wrReq.clear()
+                if exception is None:
+                    break
         return ret
+
+    def _split_on_holes(self, req, exception):
+        """
+        Learn address holes from failed read request that bridged a gap
+        :param req: Failed read request
+        :param exception: Modbus exception code of the response
+        :return: List of read requests around the holes
+        :return: None if the failure was not caused by a gap
+        """
+        idx = self._get_index(req['Type'])
+        last = req['Address'] + req['Count'] - 1
+        gaps = [addr for addr in range(req['Address'], last + 1) if addr not in idx]
+        if len(gaps) == 0 or exception != MbClient.ILLEGAL_ADDRESS:
+            return None
+        space = _space(req['Type'])
+        self.planner.add_holes(space, gaps)
+        self.replan()
+        regs = [reg for reg in (self.input if space == 'Input' else self.hold)
+                if reg['Address'][0] >= req['Address'] and reg['Address'][-1] <= last]
+        return [{'Address': rng[0], 'Count': rng[1] - rng[0] + 1, 'Type': req['Type'], 'Slave': req['Slave']}
+                for rng in self.planner.plan(space, regs)]
+
+    def _range_requests(self, reg_type, ranges):
+        """
+        Create read requests of address ranges
+        :param reg_type: Type of registers ('Input', 'INPUT', 'Holding', 'HOLD')
+        :param ranges: List of address ranges [first, last]
+        :return: List of read requests
+        """
+        return [{'Address': rng[0], 'Count': rng[1] - rng[0] + 1, 'Type': reg_type, 'Slave': self.slave}
+                for rng in ranges]
+
+    def _regs_requests(self, regs):
+        """
+        Create read requests of registers, registers are merged into planned address ranges
+        :param regs: List of registers
+        :return: List of read requests
+        """
+        reqs = self._range_requests('Input', self.planner.plan('Input', [x for x in regs if x['Type'] != 'HOLD']))
+        reqs += self._range_requests('Holding', self.planner.plan('Holding', [x for x in regs if x['Type'] == 'HOLD']))
+        return reqs
+
+    def _many_read_requests(self, regs):
+        """
+        Get memoized read requests of set of registers, plan them on first use
+        :param regs: List of registers
+        :return: List of read requests
+        """
+        key = ('Read', frozenset(reg['Name'] for reg in regs))
+        reqs = self.many_plans.get(key)
+        if reqs is None:
+            reqs = self._regs_requests(regs)
+            self._memoize(key, reqs)
+        return reqs
+
+    def _many_write_requests(self, regs):
+        """
+        Create write requests of set of registers with current values, merging of registers is memoized
+        :param regs: List of holding registers
+        :return: List of write requests
+        """
+        key = ('Write', frozenset(reg['Name'] for reg in regs))
+        groups = self.many_plans.get(key)
+        if groups is None:
+            groups = plan_writes(regs)
+            self._memoize(key, groups)
+        return self._encode_writes(groups)
+
+    def _memoize(self, key, plan):
+        """
+        Keep request plan of read_many or write_many, forget all plans if there are too many of them
+        :param key: Tuple of operation and set of names
+        :param plan: Request plan
+        :return: None
+        """
+        if len(self.many_plans) >= MAX_MANY_PLANS:
+            self.many_plans.clear()
+        self.many_plans[key] = plan
+
+    def _write_requests(self, regs):
+        """
+        Create write requests of registers, registers with consecutive addresses are merged into one request
+        :param regs: List of holding registers
+        :return: List of write requests
+        """
+        return self._encode_writes(plan_writes(regs))
+
+    def _encode_writes(self, groups):
+        """
+        Create write requests of groups of registers with consecutive addresses using their current values.
+        Cached values of the registers are forgotten, the device may not accept them as they are.
+        :param groups: List of lists of holding registers
+        :return: List of write requests
+        """
+        reqs = []
+        for group in groups:
+            self.invalidate(group)
+            values_reg = []
+            for reg in group:
+                values_reg += self.codecs[reg['Name']].encode(reg['Value'])
+            reqs.append({'Address': group[0]['Address'][0], 'Count': len(values_reg), 'Values': values_reg,
+                         'Slave': self.slave})
+        return reqs
@@ -4,19 +4,11 @@ import PySimpleGUI as SG
 from VisualModbus.AppLogging import *
 from VisualModbus.RegMap import RegMap
 from VisualModbus.MbClient import MbClient
+from VisualModbus.MbRetry import RetryPolicy
 import VisualModbus.HelpAbout as Help
 import VisualModbus.VmSettings as Setting
 from VisualModbus.MbUpgrade import *
-
-
-def _upgrade_callback(progress, size):
-    """
-    Upgrade firmware callback called after each page is acknowledged by device.
-    :param progress: Number of bytes already written
-    :param size: Complete size of firmware
-    :return: None
-    """
-    SG.OneLineProgressMeter('Upgrade progress bar', progress, size, 'KEY_PROGRESS')
+from VisualModbus.MbWorker import MbWorker
 
 
 class VisualMbApp:
@@ -27,7 +19,14 @@ class VisualMbApp:
     HEX_SUFFIX = "_H"
     INF_SUFFIX = "_INFO_BTN"
     READ_SUFFIX = "_READ_BTN"
+    NAME_SUFFIX = "_NAME"
+    LIM_SUFFIX = "_LIM"
+    PIN_SUFFIX = "_PIN"
+    ROW = "ROW"
+    ALL_GROUPS = "All groups"
     UPG_FILE = '_UPG_FILE'
+    # Period of status and log window refresh without events [ms]
+    LOG_PERIOD = 1000
 
     def __init__(self, visual='VisualSettings.json', upgrade='UpgradeSettings.json', com='ComSettings.json'):
         """
@@ -43,104 +42,180 @@ class VisualMbApp:
         self.win_info = None
         self.window = None
         self.upgrade = upgrade
+        # Registers shown in rows of the table
+        self.view = []
+        self.page = 0
+        self.group = self.ALL_GROUPS
+        self.pinned = set()
+        self.worker = None
         # Initialize internal modules
         self.mb = MbClient()
         self.log = AppLogging()
         # Read settings and load jsons
         Setting.read_settings([visual, upgrade, com])
-        self.regs = RegMap(self.mb, Setting.s['slave_address'])
+        self.rows = Setting.s.get('page_rows', 20)
+        self.regs = RegMap(self.mb, Setting.s['slave_address'], retry=RetryPolicy.from_settings(Setting.s))
         self.regs.load(Setting.s['reg_map'])
         # Create and display window layout
         self._finalize()
+        # Modbus communication runs in background, widgets are updated by events of the worker
+        self.worker = MbWorker(self.window, self.mb, self.regs, Setting.s['readout_period'],
+                               Setting.s.get('background_period', 10.0))
+        self.worker.start()
+        self._send_view()
 
     def handle(self):
         """
         Handle of GUI features.
 
-        This function blocks until window is closed and handles all user logic of GUI.
+        This function blocks until window is closed and handles all user logic of GUI. Modbus communication is
+        delegated to the background worker, so the window never waits for the slave.
         :return: None on exit
         """
         while True:
-            to = max(min(Setting.s['readout_period'] * 1000, 1000), 1000)
-            event, values = self.window.Read(timeout=to, timeout_key='_TIMEOUT_')
+            event, values = self.window.Read(timeout=self.LOG_PERIOD, timeout_key='_TIMEOUT_')
             if event in (None, 'Close'):
-                self.mb.close()
+                self.worker.stop()
                 break
-            if 'Write' in event:
-                self._write_mb(values)
-            if 'Write All' in event:
-                self.regs.write_hold()
-            if event in 'Read':
-                self._read_mb()
-            if event in 'About':
+            if event == MbWorker.EV_CHANGES:
+                self._update_changed(values[event])
+            if event == MbWorker.EV_PROGRESS:
+                SG.OneLineProgressMeter('Upgrade progress bar', *values[event], 'KEY_PROGRESS')
+            if event == MbWorker.EV_DONE:
+                self._command_done(*values[event])
+            if event == 'Write':
+                self.worker.send('write', self._view_values(values), self.HEX_SUFFIX)
+            if event == 'Write All':
+                self.worker.send('write_all')
+            if event == 'Read':
+                self.worker.send('read')
+            if event == 'G_GROUP':
+                self.group = values['G_GROUP']
+                self._show_page(0)
+            if event == 'B_PREV':
+                self._show_page(self.page - 1)
+            if event == 'B_NEXT':
+                self._show_page(self.page + 1)
+            if event == 'About':
                 Help.show_help()
-            if event in 'B_COMPORT':
+            if event == 'B_COMPORT':
                 if self.window['B_COMPORT'].GetText() == 'COM open':
-                    if self.mb.open('ComSettings.json'):
-                        self.window['B_COMPORT'].Update('COM close')
+                    self.worker.send('open', 'ComSettings.json')
                 else:
                     self.window['B_COMPORT'].Update('COM open')
-                    self.mb.close()
-            if event in 'Edit':
+                    self.worker.send('close')
+            if event == 'Edit':
                 Setting.edit(self.window.size)
-                self.regs.slave = Setting.s['slave_address']
-            if event in 'Upgrade' and values[self.UPG_FILE] != '':
-                self._upgrade(values[self.UPG_FILE])
-            if event in 'Show Log':
+                self.worker.send('slave', Setting.s['slave_address'])
+                self.worker.send('period', Setting.s['readout_period'])
+            if event == 'Upgrade' and values[self.UPG_FILE] != '':
+                self.window['Upgrade'].Update(disabled=True)
+                self.worker.send('upgrade', self.upgrade, values[self.UPG_FILE])
+            if event == 'Show Log':
                 self.win_log = self._show_log()
             if self.INF_SUFFIX in event:
                 if self.win_info is not None:
                     self.win_info.close()
-                self.win_info = self._show_info(event.replace(self.INF_SUFFIX, ""))
+                self.win_info = self._show_info(self._row_name(event.replace(self.INF_SUFFIX, "")))
             if self.READ_SUFFIX in event:
-                self.regs.read_by_name(event.replace(self.READ_SUFFIX, ""))
-                self._update_regs()
-            if event not in (None, 'Close'):
-                self.window['T_STATUS'].Update(self.log.lrl.get_one_liner())
-                if self.win_log is not None:
-                    event_log, values = self.win_log.Read(timeout=0)
-                    if event_log in (None, 'Close'):
-                        self.win_log = None
-                    else:
-                        self.win_log['T_LOG'].Update(self.log.lrl.get_record())
-
-    def _read_mb(self):
-        """
-        Read all registers and update them in visual
+                self.worker.send('read_name', self._row_name(event.replace(self.READ_SUFFIX, "")))
+            if self.PIN_SUFFIX in event:
+                name = self._row_name(event.replace(self.PIN_SUFFIX, ""))
+                if values[event]:
+                    self.pinned.add(name)
+                else:
+                    self.pinned.discard(name)
+                self._send_view()
+            self.window['T_STATUS'].Update(self.log.lrl.get_one_liner())
+            if self.win_log is not None:
+                event_log, values = self.win_log.Read(timeout=0)
+                if event_log in (None, 'Close'):
+                    self.win_log = None
+                else:
+                    self.win_log['T_LOG'].Update(self.log.lrl.get_record())
+
+    def _command_done(self, command, result):
+        """
+        Update visual after the worker has finished command
+        :param command: Name of finished command
+        :param result: Result of command
         :return: None
         """
-        self.regs.read_in()
-        self.regs.read_hold()
-        self._update_regs()
+        if command == 'open' and result:
+            self.window['B_COMPORT'].Update('COM close')
+        if command == 'upgrade':
+            self.window['Upgrade'].Update(disabled=False)
 
-    def _write_mb(self, values):
+    def _show_page(self, page):
         """
-        Write all holding registers
-        :param values: List of all values
+        Show page of registers of selected group in rows of the table
+        :param page: Page number, it is limited to existing pages
         :return: None
         """
-        self.regs.from_visual(values, self.HEX_SUFFIX)
-        self._update_regs()
+        regs = self.regs.input + self.regs.hold if self.group == self.ALL_GROUPS else self.regs.get_group(self.group)
+        pages = max(1, (len(regs) + self.rows - 1) // self.rows)
+        self.page = min(max(page, 0), pages - 1)
+        self.view = regs[self.page * self.rows:(self.page + 1) * self.rows]
+        self.window['T_PAGE'].Update(f"{self.page + 1} / {pages}")
+        for row in range(self.rows):
+            key = self.ROW + str(row)
+            visible = row < len(self.view)
+            for suffix in (self.PIN_SUFFIX, self.INF_SUFFIX, self.READ_SUFFIX, self.NAME_SUFFIX, "", self.HEX_SUFFIX,
+                           self.LIM_SUFFIX):
+                self.window[key + suffix].Update(visible=visible)
+            if not visible:
+                continue
+            reg = self.view[row]
+            self.window[key + self.PIN_SUFFIX].Update(reg['Name'] in self.pinned)
+            self.window[key + self.NAME_SUFFIX].Update(reg['Name'])
+            self.window[key + self.NAME_SUFFIX].set_tooltip(reg['Label'])
+            limits = f"({reg['Min']}, {reg['Max']})" if reg['Min'] != 0 and reg['Max'] != 0 else ""
+            self.window[key + self.LIM_SUFFIX].Update(limits)
+            self.window[key].Update(self.regs.val_to_str(reg))
+            self.window[key + self.HEX_SUFFIX].Update(self.regs.val_to_hex(reg))
+        if self.worker is not None:
+            self._send_view()
 
-    def _update_regs(self):
+    def _send_view(self):
         """
-        Update values of registers in visual
+        Tell the worker which registers are shown or pinned, they are polled with the readout period
         :return: None
         """
-        for reg in self.regs.input + self.regs.hold:
-            self.window[reg['Name']].Update(reg['Value'])
-            self.window[reg['Name'] + self.HEX_SUFFIX].Update(self.regs.val_to_hex(reg))
+        self.worker.send('view', [reg['Name'] for reg in self.view] + sorted(self.pinned.difference(
+            reg['Name'] for reg in self.view)))
 
-    def _upgrade(self, file_name):
+    def _update_changed(self, changes):
         """
-        Initialize and run firmware upgrade procedure
-        :param file_name: Binary file to upgrade
+        Update shown registers with changed values in visual, registers out of view are shown by next page change
+        :param changes: Dictionary {name: (value, hexadecimal value)} of changed registers formatted by worker
         :return: None
         """
-        # initialize and get first packet obtaining info
-        upg = MbUpgrade(self.upgrade, self.mb, slave=Setting.s['slave_address'])
-        upg.load_file(file_name)
-        upg.run_upgrade(_upgrade_callback)
+        for row, reg in enumerate(self.view):
+            if reg['Name'] in changes:
+                value, hex_value = changes[reg['Name']]
+                self.window[self.ROW + str(row)].Update(value)
+                self.window[self.ROW + str(row) + self.HEX_SUFFIX].Update(hex_value)
+
+    def _row_name(self, key):
+        """
+        Get name of register shown in row
+        :param key: Key of the row
+        :return: Register name
+        """
+        return self.view[int(key[len(self.ROW):])]['Name']
+
+    def _view_values(self, values):
+        """
+        Translate values of rows to values of shown registers
+        :param values: Dictionary of values in visual
+        :return: Dictionary {name: value} including hexadecimal values
+        """
+        ret = {}
+        for row, reg in enumerate(self.view):
+            key = self.ROW + str(row)
+            ret[reg['Name']] = values[key]
+            ret[reg['Name'] + self.HEX_SUFFIX] = values[key + self.HEX_SUFFIX]
+        return ret
 
     def _show_log(self):
         """
@@ -168,16 +243,22 @@ class VisualMbApp:
         """
         menu_def = [['&Settings', ['&Edit']], ['&Help', '&About'], ]
         layout = [[SG.Menu(menu_def)], ]
+        # Only one page of rows is created, registers are bound to rows when the page is shown
+        layout.append([SG.Combo([self.ALL_GROUPS] + list(self.regs.groups), default_value=self.ALL_GROUPS,
+                                key='G_GROUP', enable_events=True, readonly=True),
+                       SG.Button('<', key='B_PREV'), SG.Button('>', key='B_NEXT'),
+                       SG.Text('', key='T_PAGE', size=(12, 1))])
         col1 = []
-        for reg in self.regs.input + self.regs.hold:
-            line = [SG.Button("?", size=(2, 1), key=reg['Name'] + self.INF_SUFFIX, pad=(0, 0)),
-                    SG.Button("R", size=(2, 1), key=reg['Name'] + self.READ_SUFFIX),
-                    SG.Text(reg['Name'], size=(self.regs.max_len, 1), tooltip=reg['Label']),
-                    SG.InputText('0', size=(20, 1), key=reg['Name']),
-                    SG.InputText('0', size=(12, 1), key=reg['Name'] + self.HEX_SUFFIX)]
-            if reg['Min'] != 0 and reg['Max'] != 0:
-                line.append(SG.Text(f"({reg['Min']}, {reg['Max']})"))
-            col1.append(line)
+        for row in range(self.rows):
+            key = self.ROW + str(row)
+            col1.append([SG.Checkbox('', key=key + self.PIN_SUFFIX, enable_events=True, pad=(0, 0),
+                                     tooltip='Pinned registers are read with readout period on every page'),
+                         SG.Button("?", size=(2, 1), key=key + self.INF_SUFFIX, pad=(0, 0)),
+                         SG.Button("R", size=(2, 1), key=key + self.READ_SUFFIX),
+                         SG.Text('', size=(self.regs.max_len, 1), key=key + self.NAME_SUFFIX),
+                         SG.InputText('0', size=(20, 1), key=key),
+                         SG.InputText('0', size=(12, 1), key=key + self.HEX_SUFFIX),
+                         SG.Text('', size=(24, 1), key=key + self.LIM_SUFFIX)])
 
         layout.append([SG.Column(col1, key='C_REGS', scrollable=True, vertical_scroll_only=True,
                                  size=(Setting.s['width'] - 10, Setting.s['height']))])
@@ -191,7 +272,7 @@ class VisualMbApp:
 
         self.window = SG.Window('VisualModbus. Version: ' + Help.VERSION, layout, resizable=True, finalize=True)
         Setting.init_size(self.window.size)
-        self._update_regs()
+        self._show_page(0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from VisualModbus.MbSimulator import MbSimulator
+
+"""
+Register map of virtual slaves, it contains application CRC and size
+"""
+REG_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RtdEmulator', 'RtdEmul_Modbus.json')
+
+"""
+Simulator settings of tests, pages are committed and new application is started quickly
+"""
+SIM = {'commit_time': 0.002, 'restart_time': 0.02}
+
+
+def make_reg(name, address, count=1, reg_type='INPUT', fmt='INT'):
+    """
+    Create register
+    :param name: Register name
+    :param address: First address
+    :param count: Number of words
+    :param reg_type: Register type ('INPUT' or 'HOLD')
+    :param fmt: Register format
+    :return: Register
+    """
+    return {'Name': name, 'Type': reg_type, 'Address': list(range(address, address + count)), 'Format': fmt,
+            'Value': 0, 'Access': 'RW' if reg_type == 'HOLD' else 'RO', 'Min': 0, 'Max': 0}
+
+
+class TempTestCase(unittest.TestCase):
+    """
+    Base of tests that generate files into temporary folder
+    """
+
+    def setUp(self):
+        """
+        Create temporary folder, logging is disabled
+        :return: None
+        """
+        logging.disable(logging.CRITICAL)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove generated files
+        :return: None
+        """
+        shutil.rmtree(self.folder)
+        logging.disable(logging.NOTSET)
+
+    def _json(self, name, content):
+        """
+        Write json file into temporary folder
+        :param name: File name
+        :param content: Dictionary or list
+        :return: Path of the file
+        """
+        file_name = os.path.join(self.folder, name)
+        with open(file_name, 'w') as f:
+            json.dump(content, f)
+        return file_name
+
+    def _image(self, size):
+        """
+        Write firmware image of random bytes, the same for every test
+        :param size: Size of image in bytes
+        :return: Tuple (image bytes, path of the file)
+        """
+        image = random.Random(1).getrandbits(8 * size).to_bytes(size, 'little')
+        file_name = os.path.join(self.folder, 'Image.bin')
+        with open(file_name, 'wb') as f:
+            f.write(image)
+        return image, file_name
+
+
+class SimTestCase(TempTestCase):
+    """
+    Base of tests against virtual slaves served by MbSimulator over Modbus TCP
+    """
+
+    def setUp(self):
+        """
+        Create temporary folder, simulators are created by tests
+        :return: None
+        """
+        super().setUp()
+        self.sims = []
+
+    def tearDown(self):
+        """
+        Stop simulators and remove generated files
+        :return: None
+        """
+        for sim in self.sims:
+            sim.stop()
+        super().tearDown()
+
+    def _bus(self, slaves, reg_map=REG_MAP, upgrade=None, sim=None, com=None):
+        """
+        Create simulator of one bus with given slaves
+        :param slaves: Slave addresses
+        :param reg_map: Json register map file of slaves
+        :param upgrade: Json upgrade settings file, None if upgrade is not supported
+        :param sim: Simulator settings, SIM by default
+        :param com: Communication settings added to the default ones
+        :return: Tuple (MbSimulator, json communication settings file)
+        """
+        simulator = MbSimulator(self._json('Sim{}.json'.format(len(self.sims)), SIM if sim is None else sim))
+        self.sims.append(simulator)
+        for slave in slaves:
+            simulator.add_slave(reg_map, slave, upgrade)
+        settings = {'host': '127.0.0.1', 'port': simulator.serve_tcp(0), 'timeout': 0.3, 'turnaround_delay': 0.0}
+        settings.update({} if com is None else com)
+        return simulator, self._json('Com{}.json'.format(len(self.sims)), settings)
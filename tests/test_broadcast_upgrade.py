@@ -0,0 +1,119 @@
+import unittest
+
+from VisualModbus.BroadcastUpgrade import BroadcastUpgrade, UPDATED
+from VisualModbus.MbClient import MbClient
+from VisualModbus.RegMap import RegMap
+from tests.helpers import REG_MAP, SIM, SimTestCase
+
+"""
+Slaves on the simulated bus
+"""
+SLAVES = (1, 2, 3)
+
+
+class TestBroadcastUpgrade(SimTestCase):
+    """
+    Broadcast upgrade of virtual slaves served by MbSimulator over Modbus TCP
+    """
+
+    def setUp(self):
+        """
+        Create simulator with slaves that miss some broadcast requests, and client connected to it
+        :return: None
+        """
+        super().setUp()
+        self.upgrade = self._json('Upgrade.json', {'align': 4, 'page_bytes': 64, 'type_binary': 0,
+                                                   'mode_operation': 1, 'address': 1000, 'init_delay': 0,
+                                                   'verify_delay': 0.05, 'confirm_readback': True})
+        self.sim, com = self._bus(SLAVES, upgrade=self.upgrade, sim=dict(SIM, broadcast_drop_rate=0.2, seed=3))
+        self.mb = MbClient()
+        self.mb.open(com)
+        self.image, self.file_name = self._image(64 * 20)
+
+    def tearDown(self):
+        """
+        Close client, stop simulator and remove generated files
+        :return: None
+        """
+        self.mb.close()
+        super().tearDown()
+
+    def _regs(self):
+        """
+        Create register maps of all slaves
+        :return: Dictionary {slave: RegMap}
+        """
+        regs = {}
+        for slave in SLAVES:
+            regs[slave] = RegMap(self.mb, slave)
+            regs[slave].load(REG_MAP)
+        return regs
+
+    def test_missed_pages(self):
+        """
+        Pages missed by devices are detected although their status is ready, and sent again
+        """
+        upg = BroadcastUpgrade(self.upgrade, self.mb, SLAVES, self._regs())
+        upg.load_file(self.file_name)
+        self.assertEqual(upg.run_upgrade(), 0)
+        upg.close()
+        report = upg.get_report()
+        self.assertGreater(self.sim.get_stats()['Dropped'], 0)
+        # Lost pages are detected during broadcast, not only by verification of the whole image
+        self.assertGreater(sum(item['Resent'] for item in report.values()), 0)
+        for slave in SLAVES:
+            self.assertEqual(report[slave]['Result'], UPDATED)
+            self.assertEqual(self.sim.slaves[slave].get_image(), self.image)
+
+    def test_confirm_page(self):
+        """
+        Device confirms the page it has received only
+        """
+        upg = BroadcastUpgrade(self.upgrade, self.mb, SLAVES, self._regs())
+        upg.load_file(self.file_name)
+        device = upg.upgrades[1]
+        pages = list(device.page_requests())
+        device.request = pages[0]
+        device.send()
+        self.assertIsNotNone(device.wait_ready())
+        self.assertTrue(device.confirm(pages[0]))
+        # Status is still ready from the previous page, the page itself is not there
+        self.assertIsNotNone(device.wait_ready())
+        self.assertFalse(device.confirm(pages[1]))
+        upg.close()
+
+    def test_without_readback(self):
+        """
+        Without read back, devices that have missed pages fail verification and are upgraded by unicast
+        """
+        settings = self._json('Status.json', {'align': 4, 'page_bytes': 64, 'type_binary': 0, 'mode_operation': 1,
+                                              'address': 1000, 'init_delay': 0, 'verify_delay': 0.05})
+        upg = BroadcastUpgrade(settings, self.mb, SLAVES, self._regs())
+        upg.load_file(self.file_name)
+        self.assertEqual(upg.run_upgrade(), 0)
+        upg.close()
+        report = upg.get_report()
+        self.assertGreater(self.sim.get_stats()['Dropped'], 0)
+        self.assertEqual(sum(item['Resent'] for item in report.values()), 0)
+        self.assertTrue(any(item['Unicast'] for item in report.values()))
+        for slave in SLAVES:
+            self.assertEqual(report[slave]['Result'], UPDATED)
+            self.assertEqual(self.sim.slaves[slave].get_image(), self.image)
+
+    def test_refused_without_verification(self):
+        """
+        Devices that cannot be verified are upgraded by unicast
+        """
+        upg = BroadcastUpgrade(self.upgrade, self.mb, SLAVES)
+        upg.load_file(self.file_name)
+        self.sim.broadcast_drop_rate = 0.0
+        self.assertEqual(upg.run_upgrade(), 0)
+        upg.close()
+        for slave, item in upg.get_report().items():
+            self.assertTrue(item['Unicast'])
+            self.assertEqual(self.sim.slaves[slave].get_image(), self.image)
+        self.assertEqual(self.sim.get_stats()['Dropped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
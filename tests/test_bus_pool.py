@@ -0,0 +1,42 @@
+import unittest
+
+from VisualModbus.BusPool import BusPool
+from tests.helpers import TempTestCase
+
+
+class TestBusPool(TempTestCase):
+    """
+    Buses of the pool
+    """
+
+    def setUp(self):
+        """
+        Create temporary folder and empty pool
+        :return: None
+        """
+        super().setUp()
+        self.pool = BusPool()
+
+    def tearDown(self):
+        """
+        Close the pool and remove generated files
+        :return: None
+        """
+        self.pool.close()
+        super().tearDown()
+
+    def test_duplicate_bus(self):
+        """
+        The same bus cannot be added twice, other buses can
+        """
+        bus = self.pool.add_bus(self._json('Com1.json', {'host': '127.0.0.1', 'port': 5020, 'timeout': 0.3}))
+        self.assertEqual(bus, '127.0.0.1:5020')
+        with self.assertRaises(ValueError):
+            self.pool.add_bus(self._json('Com2.json', {'host': '127.0.0.1', 'port': 5020, 'timeout': 1.0}))
+        other = self.pool.add_bus(self._json('Com3.json', {'host': '127.0.0.1', 'port': 5021, 'timeout': 0.3}))
+        self.assertEqual(other, '127.0.0.1:5021')
+        self.assertEqual(sorted(self.pool.buses), ['127.0.0.1:5020', '127.0.0.1:5021'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import random
+import unittest
+from unittest import mock
+
+import VisualModbus.Crc32 as Crc32
+
+
+def legacy_reflect(value, bits):
+    """
+    Bit-wise reflection of the original implementation
+    :param value: Value to reflect
+    :param bits: Number of bits of data type
+    :return: Reflected number
+    """
+    ret = 0
+    for i in range(bits):
+        if value & (1 << i):
+            ret |= 1 << (bits - 1 - i)
+    return ret
+
+
+def legacy_calculate(data, crc_val=0xFFFFFFFF):
+    """
+    Original bitwise CRC32 of array of integers, the reference of optimized implementation
+    :param data: Input data as array of integers
+    :param crc_val: Initial value of crc
+    :return: Crc
+    """
+    table = [0] * 256
+    for i in range(256):
+        table[i] = legacy_reflect(i, 8) << 24
+        for j in range(8):
+            table[i] = ((table[i] << 1) ^ (Crc32.polynom if (table[i] & (1 << 31)) != 0 else 0)) & 0xFFFFFFFF
+        table[i] = legacy_reflect(table[i], 32)
+    data_byte = b''
+    for i in data:
+        data_byte += legacy_reflect(i, 32).to_bytes(4, byteorder='little')
+    for byte in data_byte:
+        crc_val = (crc_val >> 8) ^ table[(crc_val & 0xff) ^ byte] & 0xFFFFFFFF
+    return legacy_reflect(crc_val, 32)
+
+
+def legacy_calc_from_byte(data_buf, crc_val=0xFFFFFFFF):
+    """
+    Original CRC32 of bytes, incomplete word at the end is ignored
+    :param data_buf: Input data in bytearray format
+    :param crc_val: Initial value of crc
+    :return: Crc
+    """
+    words = [int.from_bytes(data_buf[i:i + 4], byteorder='little') for i in range(0, len(data_buf) - 3, 4)]
+    return legacy_calculate(words, crc_val)
+
+
+class TestCrc32(unittest.TestCase):
+    """
+    Optimized CRC32 is bit-identical with the original bitwise algorithm, with zlib and with table
+    """
+
+    def setUp(self):
+        """
+        Create random inputs of various lengths
+        :return: None
+        """
+        rnd = random.Random(21)
+        self.inputs = [b'', b'\x01', b'\x01\x02\x03', b'\x12\x34\x56\x78', bytes(range(256)) * 3 + b'\xff'] + \
+                      [bytes(rnd.getrandbits(8) for i in range(size)) for size in (5, 63, 64, 1021, 4099)]
+        self.chunks = rnd
+
+    def _both(self, test):
+        """
+        Run test with zlib and with table implementation
+        :param test: Test function
+        :return: None
+        """
+        with self.subTest(path='zlib' if Crc32.zlib is not None else 'table'):
+            test()
+        with mock.patch.object(Crc32, 'zlib', None), self.subTest(path='table'):
+            test()
+
+    def test_known_value(self):
+        """
+        CRC of word 0x12345678 as computed by STM32 CRC unit
+        """
+        self._both(lambda: self.assertEqual(Crc32.calculate([0x12345678]), 0xDF8A8A2B))
+
+    def test_calculate(self):
+        """
+        CRC of arrays of 32-bit words, with default and given initial value
+        """
+        def test():
+            for data in self.inputs:
+                words = [int.from_bytes(data[i:i + 4], 'little') for i in range(0, len(data) - 3, 4)]
+                self.assertEqual(Crc32.calculate(words), legacy_calculate(words))
+                self.assertEqual(Crc32.calculate(words, 0x12345678), legacy_calculate(words, 0x12345678))
+        self._both(test)
+
+    def test_calc_from_byte(self):
+        """
+        CRC of empty, odd-length and random bytes, bytearray and memoryview
+        """
+        def test():
+            for data in self.inputs:
+                expected = legacy_calc_from_byte(data)
+                self.assertEqual(Crc32.calc_from_byte(data), expected)
+                self.assertEqual(Crc32.calc_from_byte(bytearray(data)), expected)
+                self.assertEqual(Crc32.calc_from_byte(memoryview(data)), expected)
+        self._both(test)
+
+    def test_chunked(self):
+        """
+        Incremental CRC of data split at random positions, also inside words
+        """
+        def test():
+            for data in self.inputs:
+                crc = Crc32.Crc32()
+                pos = 0
+                while pos < len(data):
+                    size = self.chunks.randint(1, 17)
+                    crc.update(memoryview(data)[pos:pos + size])
+                    pos += size
+                self.assertEqual(crc.digest(), legacy_calc_from_byte(data))
+        self._both(test)
+
+
+if __name__ == '__main__':
+    unittest.main()
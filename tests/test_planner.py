@@ -0,0 +1,123 @@
+import unittest
+
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbPlanner import FrameModel, ReadPlanner, plan_writes
+from VisualModbus.RegMap import RegMap
+from tests.helpers import SimTestCase, make_reg
+
+
+class TestReadPlanner(unittest.TestCase):
+    """
+    Merging of registers into read requests
+    """
+
+    def setUp(self):
+        """
+        Create planner of serial line 19200 Bd, gap of 14 words is cheaper than another request
+        :return: None
+        """
+        self.planner = ReadPlanner(FrameModel(19200, 'E', 1, latency=0.005))
+        self.bridged = int(self.planner.model.read_time(0) / self.planner.model.word_time())
+
+    def test_bridge_gap(self):
+        """
+        Small gaps are read within one request, large gaps split the request
+        """
+        self.assertEqual(self.bridged, 14)
+        regs = [make_reg('A', 0), make_reg('B', 1, 2), make_reg('C', 3 + self.bridged)]
+        self.assertEqual(self.planner.plan('Input', regs), [[0, 3 + self.bridged]])
+        regs = [make_reg('A', 0), make_reg('B', 1, 2), make_reg('C', 4 + self.bridged)]
+        self.assertEqual(self.planner.plan('Input', regs), [[0, 2], [4 + self.bridged, 4 + self.bridged]])
+
+    def test_unsorted_overlapping(self):
+        """
+        Registers are sorted by address, overlapping registers are merged
+        """
+        regs = [make_reg('C', 50), make_reg('A', 0, 4), make_reg('B', 2, 4)]
+        self.assertEqual(self.planner.plan('Input', regs), [[0, 5], [50, 50]])
+
+    def test_max_count(self):
+        """
+        Request never reads more than the maximal number of registers
+        """
+        regs = [make_reg('R{}'.format(i), 2 * i) for i in range(200)]
+        ranges = self.planner.plan('Input', regs)
+        self.assertEqual(ranges[0], [0, 124])
+        self.assertTrue(all(rng[1] - rng[0] < self.planner.max_count for rng in ranges))
+        self.assertEqual(sum(1 for rng in ranges for addr in range(rng[0], rng[1] + 1) if addr % 2 == 0), 200)
+
+    def test_holes(self):
+        """
+        Gap with address refused by the device is never bridged, holes of other space are independent
+        """
+        regs = [make_reg('A', 0), make_reg('B', 5)]
+        self.assertEqual(self.planner.plan('Input', regs), [[0, 5]])
+        self.planner.add_holes('Input', [3])
+        self.assertEqual(self.planner.plan('Input', regs), [[0, 0], [5, 5]])
+        self.assertEqual(self.planner.plan('Holding', regs), [[0, 5]])
+
+    def test_tcp(self):
+        """
+        Transfer of gap takes no time on Modbus TCP, every gap within maximal count is bridged
+        """
+        planner = ReadPlanner(FrameModel.from_settings({'host': '127.0.0.1', 'port': 502, 'timeout': 1.0}))
+        regs = [make_reg('A', 0), make_reg('B', 100)]
+        self.assertEqual(planner.plan('Input', regs), [[0, 100]])
+
+    def test_plan_writes(self):
+        """
+        Writes merge consecutive registers only
+        """
+        regs = [make_reg('C', 4, reg_type='HOLD'), make_reg('A', 0, 2, 'HOLD'), make_reg('B', 2, reg_type='HOLD')]
+        groups = plan_writes(regs)
+        self.assertEqual([[reg['Name'] for reg in group] for group in groups], [['A', 'B'], ['C']])
+        groups = plan_writes(regs, max_count=2)
+        self.assertEqual([[reg['Name'] for reg in group] for group in groups], [['A'], ['B'], ['C']])
+
+
+class TestHoles(SimTestCase):
+    """
+    Address holes learned from device that refuses reads of unmapped registers
+    """
+
+    def setUp(self):
+        """
+        Create simulator of device with strict holes and register map of it
+        :return: None
+        """
+        super().setUp()
+        regs = [make_reg('A', 0), make_reg('B', 1), make_reg('C', 4), make_reg('D', 10, 2)]
+        for i, reg in enumerate(regs):
+            reg['Value'] = i + 1
+        self.map = self._json('Holes_Modbus.json', regs)
+        self.sim, com = self._bus([1], self.map, sim={'strict_holes': True})
+        self.mb = MbClient()
+        self.mb.open(com)
+
+    def tearDown(self):
+        """
+        Close client, stop simulator and remove generated files
+        :return: None
+        """
+        self.mb.close()
+        super().tearDown()
+
+    def test_split_on_holes(self):
+        """
+        Bridged read refused by the device is split around the holes, the next read is not refused
+        """
+        regs = RegMap(self.mb)
+        regs.load(self.map)
+        self.assertEqual(regs.input_a, [[0, 11]])
+        self.assertEqual(regs.read_in(), 0)
+        self.assertEqual([reg['Value'] for reg in regs.input], [1, 2, 3, 4])
+        self.assertEqual(regs.input_a, [[0, 1], [4, 4], [10, 11]])
+        self.sim.reset_stats()
+        self.assertEqual(regs.read_in(), 0)
+        stats = self.sim.get_stats()
+        self.assertEqual(stats['Requests'], 3)
+        self.assertEqual(stats['Exceptions'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
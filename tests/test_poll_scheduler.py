@@ -0,0 +1,69 @@
+import math
+import unittest
+from time import monotonic
+
+from VisualModbus.PollScheduler import PollScheduler
+
+
+class FailingMap:
+    """
+    Register map of slave that does not respond to the given number of reads
+    """
+
+    def __init__(self, regs, failures):
+        """
+        Initialize map
+        :param regs: List of input registers
+        :param failures: Number of failed reads before the slave responds
+        """
+        self.slave = 1
+        self.input = regs
+        self.hold = []
+        self.names = {reg['Name']: reg for reg in regs}
+        self.failures = failures
+        self.reads = []
+
+    def read_regs(self, regs):
+        """
+        Read registers
+        :param regs: List of registers
+        :return: 0 on success
+        :return: None while the slave fails
+        """
+        self.reads.append([reg['Name'] for reg in regs])
+        if self.failures > 0:
+            self.failures -= 1
+            return None
+        return 0
+
+
+class TestPollScheduler(unittest.TestCase):
+    """
+    Scheduling of registers read only once
+    """
+
+    def test_once_failing(self):
+        """
+        Register with period 0 is read again after default period until the read succeeds
+        """
+        regs = FailingMap([{'Name': 'FIRM_VERSION', 'Group': 'FIRM', 'Period': 0},
+                           {'Name': 'PH_VALUE', 'Group': 'PH', 'Period': 0.5}], failures=2)
+        sch = PollScheduler(regs, default_period=1.0)
+        now = monotonic()
+        self.assertIsNone(sch.poll(now))
+        self.assertLess(sch.items[0]['FIRM_VERSION']['Due'], math.inf)
+        self.assertEqual(sch.poll(now), 0)
+        self.assertIsNone(sch.poll(now + 1.5))
+        self.assertEqual(sch.poll(now + 3.0), 0)
+        self.assertEqual(sch.items[0]['FIRM_VERSION']['Due'], math.inf)
+        self.assertEqual(sum(read.count('FIRM_VERSION') for read in regs.reads), 3)
+        # Read once register is not read anymore
+        sch.poll(now + 10.0)
+        self.assertEqual(sum(read.count('FIRM_VERSION') for read in regs.reads), 3)
+        stats = sch.get_stats()
+        self.assertEqual(stats[(1, 'FIRM')]['Errors'], 2)
+        self.assertEqual(stats[(1, 'FIRM')]['Misses'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+
+from VisualModbus.RegCodec import RegCodec, BlockPlan
+from tests.helpers import make_reg
+
+
+class TestRegCodec(unittest.TestCase):
+    """
+    Conversion of one register between native value and modbus words
+    """
+
+    def _round_trip(self, reg, value, expected=None):
+        """
+        Encode value, check number of words and decode it back
+        :param reg: Register
+        :param value: Native value
+        :param expected: Decoded value, None if it equals to value
+        :return: Encoded words
+        """
+        codec = RegCodec(reg)
+        words = codec.encode(value)
+        self.assertEqual(len(words), len(reg['Address']))
+        self.assertTrue(all(0 <= word <= 0xFFFF for word in words))
+        self.assertEqual(codec.decode(words), value if expected is None else expected)
+        return words
+
+    def test_int(self):
+        """
+        Integers of one, two, three and four words, least significant word first
+        """
+        self.assertEqual(self._round_trip(make_reg('A', 0, fmt='INT'), 0xBEEF), [0xBEEF])
+        self.assertEqual(self._round_trip(make_reg('B', 0, 2, fmt='INT'), 0x12345678), [0x5678, 0x1234])
+        self.assertEqual(self._round_trip(make_reg('C', 0, 3, fmt='INT'), 0x123456789ABC), [0x9ABC, 0x5678, 0x1234])
+        self._round_trip(make_reg('D', 0, 4, fmt='INT'), 0x123456789ABCDEF0)
+        self._round_trip(make_reg('E', 0, fmt='ENUM'), 7)
+        self._round_trip(make_reg('F', 0, fmt='BIN'), 0x8001)
+
+    def test_int_masked(self):
+        """
+        Values wider than register are masked, negative values are written as two's complement
+        """
+        self._round_trip(make_reg('A', 0, fmt='INT'), 0x12345, 0x2345)
+        self._round_trip(make_reg('B', 0, fmt='INT'), -1, 0xFFFF)
+        self._round_trip(make_reg('C', 0, 3, fmt='INT'), -1, (1 << 48) - 1)
+
+    def test_float(self):
+        """
+        Fixed point float with one decimal place is signed 16-bit register
+        """
+        self.assertEqual(self._round_trip(make_reg('A', 0, fmt='FLOAT'), 12.5), [125])
+        self.assertEqual(self._round_trip(make_reg('B', 0, fmt='FLOAT'), -0.5), [0xFFFB])
+        self._round_trip(make_reg('C', 0, fmt='FLOAT'), 3276.7)
+        self._round_trip(make_reg('D', 0, 2, fmt='FLOAT'), -12.3)
+
+    def test_float32(self):
+        """
+        IEEE 754 float of two words is rounded to four decimal places
+        """
+        self._round_trip(make_reg('A', 0, 2, fmt='FLOAT32'), 1.5)
+        self._round_trip(make_reg('B', 0, 2, fmt='FLOAT32'), -273.15)
+
+    def test_string(self):
+        """
+        String is zero padded to the size of register and cut at the first zero
+        """
+        self.assertEqual(self._round_trip(make_reg('A', 0, 4, fmt='STRING'), 'abc'), [0x6261, 0x0063, 0, 0])
+        self._round_trip(make_reg('B', 0, 4, fmt='STRING'), 'abcdefgh')
+        self._round_trip(make_reg('C', 0, 4, fmt='STRING'), 'abcdefghij', 'abcdefgh')
+        self._round_trip(make_reg('D', 0, 2, fmt='STRING'), '')
+
+    def test_coerce(self):
+        """
+        Values typed by user are converted to native type of register
+        """
+        self.assertEqual(RegCodec(make_reg('A', 0, fmt='INT')).coerce('12'), 12)
+        self.assertEqual(RegCodec(make_reg('B', 0, fmt='FLOAT')).coerce('1.5'), 1.5)
+        self.assertEqual(RegCodec(make_reg('C', 0, 2, fmt='FLOAT32')).coerce(2), 2.0)
+        self.assertEqual(RegCodec(make_reg('D', 0, 2, fmt='STRING')).coerce(12), '12')
+        with self.assertRaises(ValueError):
+            RegCodec(make_reg('E', 0, fmt='INT')).coerce('x')
+
+
+class TestBlockPlan(unittest.TestCase):
+    """
+    Decoding of block of consecutive words into registers
+    """
+
+    def setUp(self):
+        """
+        Create register space with gaps and registers of all formats
+        :return: None
+        """
+        self.regs = [make_reg('INT', 10, fmt='INT'), make_reg('LONG', 11, 2, fmt='INT'),
+                     make_reg('FLOAT', 15, fmt='FLOAT'), make_reg('FLOAT32', 16, 2, fmt='FLOAT32'),
+                     make_reg('TEXT', 20, 3, fmt='STRING'), make_reg('WIDE', 23, 3, fmt='INT')]
+        self.values = {'INT': 1000, 'LONG': 0x10002, 'FLOAT': -4.5, 'FLOAT32': 0.25, 'TEXT': 'hello',
+                       'WIDE': 0x0102030405}
+        self.codecs = {reg['Name']: RegCodec(reg) for reg in self.regs}
+        self.index = {}
+        self.words = {}
+        for reg in self.regs:
+            for pos, (address, word) in enumerate(zip(reg['Address'],
+                                                      self.codecs[reg['Name']].encode(self.values[reg['Name']]))):
+                self.index[address] = (reg, pos)
+                self.words[address] = word
+
+    def _decode(self, address, count):
+        """
+        Decode block read from the register space, gaps are read as 0xFFFF
+        :param address: First address of the block
+        :param count: Number of words
+        :return: Dictionary of register name -> value
+        """
+        plan = BlockPlan(self.index, self.codecs, address, count)
+        values = [self.words.get(addr, 0xFFFF) for addr in range(address, address + count)]
+        return {reg['Name']: value for reg, value in plan.decode(values)}
+
+    def test_whole_space(self):
+        """
+        All registers of the block are decoded, gaps are skipped
+        """
+        self.assertEqual(self._decode(10, 16), self.values)
+        self.assertEqual(self._decode(8, 20), self.values)
+
+    def test_partial_registers(self):
+        """
+        Registers that start before or end after the block are not decoded
+        """
+        decoded = self._decode(12, 10)
+        self.assertEqual(decoded, {'FLOAT': -4.5, 'FLOAT32': 0.25})
+        self.assertEqual(self._decode(11, 1), {})
+        self.assertEqual(self._decode(11, 2), {'LONG': 0x10002})
+
+    def test_same_as_codec(self):
+        """
+        Block decode gives the same values as decode of single registers
+        """
+        for reg in self.regs:
+            address = reg['Address'][0]
+            decoded = self._decode(address, len(reg['Address']))
+            self.assertEqual(decoded, {reg['Name']: self.codecs[reg['Name']].decode(
+                [self.words[addr] for addr in reg['Address']])})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import unittest
+from unittest import mock
+
+from pymodbus.exceptions import ConnectionException
+
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbPlanner import FrameModel
+from VisualModbus.MbRetry import RetryPolicy, CircuitBreaker, BreakerTable, BUDGET_BURST, CLOSED, OPEN, HALF_OPEN
+from VisualModbus.MbTimeout import RttEstimator, TimeoutTable
+
+
+class TestTimeoutTable(unittest.TestCase):
+    """
+    Adaptive response timeouts of slaves
+    """
+
+    def setUp(self):
+        """
+        Create table of Modbus TCP bus, transfer time is zero
+        :return: None
+        """
+        self.table = TimeoutTable(FrameModel(None), min_timeout=0.05, max_timeout=1.5)
+
+    def test_estimator(self):
+        """
+        The first sample sets smoothed time, the next samples are smoothed by RFC 6298 gains
+        """
+        est = RttEstimator()
+        self.assertIsNone(est.rto())
+        est.update(0.1)
+        self.assertAlmostEqual(est.rto(), 0.1 + 4 * 0.05)
+        est.update(0.1)
+        self.assertAlmostEqual(est.srtt, 0.1)
+        self.assertAlmostEqual(est.rttvar, 0.0375)
+        est.expired()
+        est.expired()
+        self.assertEqual(est.backoff, 4)
+        est.update(0.1)
+        self.assertEqual(est.backoff, 1)
+        self.assertEqual((est.samples, est.timeouts), (3, 2))
+
+    def test_unknown_slave(self):
+        """
+        Slave without samples uses the maximal timeout, samples of other slaves are not used
+        """
+        self.assertEqual(self.table.timeout(1), 1.5)
+        for i in range(10):
+            self.table.update(2, 0.01)
+        self.assertEqual(self.table.timeout(1), 1.5)
+        self.table.expired(3)
+        self.assertEqual(self.table.timeout(3), 1.5)
+
+    def test_adaptive(self):
+        """
+        Timeout follows response time of slave within minimal and maximal timeout
+        """
+        self.table.update(1, 0.1)
+        self.assertAlmostEqual(self.table.timeout(1), 0.3)
+        for i in range(50):
+            self.table.update(1, 0.001)
+        self.assertEqual(self.table.timeout(1), 0.05)
+        self.table.update(2, 1.0)
+        self.assertEqual(self.table.timeout(2), 1.5)
+        self.table.enabled = False
+        self.assertEqual(self.table.timeout(1), 1.5)
+
+    def test_backoff(self):
+        """
+        Missing response doubles the timeout until the next response
+        """
+        self.table.update(1, 0.1)
+        self.table.expired(1)
+        self.assertAlmostEqual(self.table.timeout(1), 0.6)
+        self.table.expired(1)
+        self.assertAlmostEqual(self.table.timeout(1), 1.2)
+        self.table.expired(1)
+        self.assertEqual(self.table.timeout(1), 1.5)
+        self.table.update(1, 0.1)
+        self.assertLess(self.table.timeout(1), 0.6)
+
+    def test_transfer_time(self):
+        """
+        Transfer time of frames is not part of response time, it is added according to number of registers
+        """
+        model = FrameModel(19200, 'E', 1, latency=0.005)
+        table = TimeoutTable(model, min_timeout=0.0, max_timeout=10.0)
+        table.update(1, model.read_time(100), 100)
+        self.assertAlmostEqual(table.get_stats()[1]['SRTT'], model.latency)
+        self.assertAlmostEqual(table.timeout(1, 100) - table.timeout(1, 0), 200 * model.char_time)
+
+    def test_load_settings(self):
+        """
+        Settings change bounds, learned response times are kept
+        """
+        self.table.update(1, 0.1)
+        self.table.load_settings(FrameModel(None), {'timeout': 0.2, 'min_timeout': 0.01})
+        self.assertEqual(self.table.timeout(1), 0.2)
+        self.assertEqual(self.table.timeout(2), 0.2)
+        self.assertEqual(self.table.get_stats()[1]['Samples'], 1)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """
+    Retries with exponential backoff and retry budget
+    """
+
+    def test_attempts(self):
+        """
+        Failed call is retried until the number of attempts, delays grow exponentially
+        """
+        policy = RetryPolicy(attempts=4, delay=0.1, max_delay=0.3, jitter=0.0)
+        self.assertEqual([policy.next_delay(attempt) for attempt in range(1, 5)], [0.1, 0.2, 0.3, None])
+        self.assertIsNone(policy.next_delay(1, retryable=False))
+        self.assertEqual(policy.retries, 3)
+
+    def test_jitter(self):
+        """
+        Delay is randomized within the jitter fraction
+        """
+        policy = RetryPolicy(delay=1.0, jitter=0.5)
+        delays = [policy.backoff(1) for i in range(100)]
+        self.assertTrue(all(0.5 <= delay <= 1.0 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_budget(self):
+        """
+        Retries are limited by budget saved by calls
+        """
+        policy = RetryPolicy(attempts=2, delay=0.0, budget=0.5)
+        retried = 0
+        for i in range(100):
+            policy.begin()
+            retried += policy.next_delay(1) is not None
+        # Budget is full at the first call, it saves nothing
+        self.assertEqual(retried, BUDGET_BURST + 99 // 2)
+
+    @mock.patch('VisualModbus.MbRetry.sleep')
+    def test_call(self, sleep):
+        """
+        Call returns the first successful result, not retryable failure is returned at once
+        """
+        policy = RetryPolicy(attempts=3, delay=0.1, jitter=0.0)
+        results = iter([None, None, 0])
+        self.assertEqual(policy.call(lambda: next(results)), 0)
+        self.assertEqual([args[0][0] for args in sleep.call_args_list], [0.1, 0.2])
+        sleep.reset_mock()
+        calls = []
+        self.assertIsNone(policy.call(lambda: calls.append(1), retryable=lambda: False))
+        self.assertEqual(len(calls), 1)
+        sleep.assert_not_called()
+        self.assertIsNone(policy.call(lambda: None))
+        self.assertEqual(sleep.call_count, 2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Circuit breakers of slaves that do not respond
+    """
+
+    def test_states(self):
+        """
+        Consecutive failures open the circuit, one probe is allowed after reset timeout
+        """
+        breaker = CircuitBreaker(threshold=2, reset_timeout=5.0)
+        self.assertFalse(breaker.failure(now=0.0))
+        breaker.success()
+        self.assertFalse(breaker.failure(now=0.0))
+        self.assertTrue(breaker.failure(now=1.0))
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow(now=5.9))
+        self.assertTrue(breaker.allow(now=6.0))
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow(now=6.0))
+        # Failed probe opens the circuit again
+        self.assertTrue(breaker.failure(now=6.5))
+        self.assertFalse(breaker.allow(now=11.0))
+        self.assertTrue(breaker.allow(now=11.5))
+        breaker.success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.trips, 2)
+
+    def test_table(self):
+        """
+        Slaves have independent breakers, threshold 0 disables them
+        """
+        table = BreakerTable(threshold=1, reset_timeout=60.0)
+        self.assertTrue(table.failure(1))
+        self.assertTrue(table.is_open(1))
+        self.assertFalse(table.allow(1))
+        self.assertTrue(table.allow(2))
+        self.assertEqual(table.get_stats()[1], {'State': OPEN, 'Failures': 1, 'Trips': 1})
+        table.load_settings({'breaker_threshold': 0})
+        self.assertFalse(table.is_open(1))
+        self.assertTrue(table.allow(1))
+        self.assertFalse(table.failure(2))
+
+    def test_probe_raises(self):
+        """
+        Probe of half-open circuit that raises instead of returning error response opens the circuit again
+        """
+        mb = MbClient()
+        mb.breakers = BreakerTable(threshold=1, reset_timeout=0.0)
+        mb.client = mock.Mock()
+        mb.client.read_input_registers.side_effect = ConnectionException('Port lost')
+        request = {'Address': 0, 'Count': 1, 'Type': 'Input', 'Slave': 1}
+        for _ in range(2):
+            with self.assertRaises(ConnectionException):
+                mb.read(request)
+            self.assertEqual(mb.breakers.get_stats()[1]['State'], OPEN)
+        self.assertEqual(mb.breakers.get_stats()[1]['Trips'], 2)
+        # Probe is allowed again after reset timeout
+        self.assertTrue(mb.breakers.allow(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+import unittest
+
+from VisualModbus.FleetUpgrade import FleetUpgrade, PENDING, UPDATED, SKIPPED, FAILED
+from VisualModbus.MbClient import MbClient
+from VisualModbus.MbUpgrade import MbUpgrade
+from VisualModbus.RegMap import RegMap
+from tests.helpers import REG_MAP, SimTestCase
+
+"""
+Upgrade settings of tests, failures are not resumed unless a test asks for it
+"""
+UPGRADE = {'align': 4, 'page_bytes': 64, 'type_binary': 0, 'mode_operation': 1, 'address': 1000, 'init_delay': 0,
+           'verify_delay': 0.05, 'resume_attempts': 0, 'resume_delay': 0.0}
+
+
+class UpgradeTestCase(SimTestCase):
+    """
+    Base of upgrade tests against virtual slaves
+    """
+
+    def setUp(self):
+        """
+        Create temporary folder, upgrade settings and firmware image
+        :return: None
+        """
+        super().setUp()
+        self.upgrade = self._json('Upgrade.json', UPGRADE)
+        self.image, self.file_name = self._image(64 * 20)
+
+    def _upgrade_bus(self, slaves):
+        """
+        Create simulator of one bus with given slaves supporting upgrade
+        :param slaves: Slave addresses
+        :return: Tuple (MbSimulator, json communication settings file)
+        """
+        # Lost slave is probed again soon
+        return self._bus(slaves, upgrade=self.upgrade, com={'breaker_reset': 0.05})
+
+
+class TestMbUpgrade(UpgradeTestCase):
+    """
+    Upgrade of one slave
+    """
+
+    def setUp(self):
+        """
+        Create simulator of one slave and client connected to it
+        :return: None
+        """
+        super().setUp()
+        self.sim, com = self._upgrade_bus([1])
+        self.mb = MbClient()
+        self.mb.open(com)
+        self.regs = RegMap(self.mb, 1)
+        self.regs.load(REG_MAP)
+
+    def tearDown(self):
+        """
+        Close client, stop simulator and remove generated files
+        :return: None
+        """
+        self.mb.close()
+        super().tearDown()
+
+    def test_upgrade(self):
+        """
+        Image is flashed and verified, the same image is not flashed again. Image is closed in both cases.
+        """
+        progress = []
+        upg = MbUpgrade(self.upgrade, self.mb, 1, self.regs)
+        upg.load_file(self.file_name)
+        self.assertEqual(upg.run_upgrade(lambda done, size: progress.append((done, size))), 0)
+        self.assertFalse(upg.skipped)
+        self.assertEqual(self.sim.slaves[1].get_image(), self.image)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        self.assertEqual(progress, sorted(progress))
+        self.assertIsNone(upg.image.map)
+        upg.load_file(self.file_name)
+        self.sim.reset_stats()
+        self.assertEqual(upg.run_upgrade(), 0)
+        self.assertTrue(upg.skipped)
+        self.assertLess(self.sim.get_stats()['Requests'], 5)
+        self.assertIsNone(upg.image.map)
+
+    def test_resume(self):
+        """
+        Upgrade terminated by lost slave is resumed from its checkpoint
+        """
+        upg = MbUpgrade(self.upgrade, self.mb, 1, self.regs)
+        upg.load_file(self.file_name)
+        size = len(list(upg.page_requests()))
+        upg.load_file(self.file_name)
+
+        def progress(done, pages):
+            """
+            Lose the slave in the middle of the upgrade
+            :param done: Number of acknowledged pages
+            :param pages: Number of pages
+            :return: None
+            """
+            if done == pages // 2:
+                self.sim.drop_rate = 1.0
+
+        self.assertNotEqual(upg.run_upgrade(progress), 0)
+        self.assertEqual(upg.checkpoint, size // 2)
+        self.sim.drop_rate = 0.0
+        self.sim.reset_stats()
+        self.assertEqual(upg.run_upgrade(resume=True), 0)
+        self.assertEqual(self.sim.slaves[1].get_image(), self.image)
+        # Acknowledged pages are not sent again
+        self.assertLess(self.sim.get_stats()['Requests'], 2 * size)
+        upg.close()
+
+    def test_commit_estimate(self):
+        """
+        Commit time is estimated by the time of status read unless it is given by settings, then it is measured
+        """
+        upg = MbUpgrade(self.upgrade, self.mb, 1)
+        self.assertIsNone(upg.commit_time)
+        self.assertEqual(upg.frame_time(), self.mb.timeouts.model.read_time(1))
+        upg.load_file(self.file_name)
+        self.assertEqual(upg.run_upgrade(), 0)
+        self.assertGreater(upg.commit_time, 0.0)
+        self.assertLess(upg.commit_time, 0.1)
+        upg = MbUpgrade(self._json('Commit.json', dict(UPGRADE, commit_time=0.05)), self.mb, 1)
+        self.assertEqual(upg.commit_time, 0.05)
+        upg = MbUpgrade(self._json('Block.json', dict(UPGRADE, block_delay=0.03)), self.mb, 1)
+        self.assertEqual(upg.commit_time, 0.03)
+
+    def test_no_device(self):
+        """
+        Upgrade of missing slave fails without acknowledged pages, image is kept open for resume
+        """
+        upg = MbUpgrade(self.upgrade, self.mb, 5)
+        upg.load_file(self.file_name)
+        self.assertNotEqual(upg.run_upgrade(), 0)
+        self.assertIsNone(upg.checkpoint)
+        self.assertIsNotNone(upg.image.map)
+        upg.close()
+        self.assertIsNone(upg.image.map)
+
+
+class TestFleetUpgrade(UpgradeTestCase):
+    """
+    Upgrade of slaves on two buses in parallel
+    """
+
+    def _fleet(self, interleave):
+        """
+        Create fleet of two buses with two slaves each
+        :param interleave: True to interleave targets of one bus page by page
+        :return: Tuple (FleetUpgrade, list of MbSimulator)
+        """
+        fleet = FleetUpgrade(self.upgrade, interleave)
+        sims = []
+        for slaves in ((1, 2), (3, 4)):
+            sim, com = self._upgrade_bus(slaves)
+            bus = fleet.add_bus(com)
+            for slave in slaves:
+                fleet.add_target(bus, slave, self.file_name, REG_MAP)
+            sims.append(sim)
+        return fleet, sims
+
+    def _check(self, report, result):
+        """
+        Check result of all targets
+        :param report: Report of fleet upgrade
+        :param result: Expected result
+        :return: None
+        """
+        self.assertEqual(len(report), 4)
+        for item in report.values():
+            self.assertEqual(item['Result'], result)
+            self.assertEqual(item['Errors'], 0)
+
+    def test_sequential(self):
+        """
+        Targets of one bus are flashed one after another, identical images are skipped by the next run
+        """
+        fleet, sims = self._fleet(False)
+        self._check(fleet.run(), UPDATED)
+        for sim in sims:
+            for device in sim.slaves.values():
+                self.assertEqual(device.get_image(), self.image)
+        for target in fleet.targets.values():
+            target['Result'] = PENDING
+        self._check(fleet.run(), SKIPPED)
+        fleet.close()
+
+    def test_duplicate_bus(self):
+        """
+        The same bus cannot be added twice
+        """
+        fleet = FleetUpgrade(self.upgrade)
+        sim, com = self._upgrade_bus([1])
+        bus = fleet.add_bus(com)
+        fleet.add_target(bus, 1, self.file_name)
+        with self.assertRaises(ValueError):
+            fleet.add_bus(com)
+        self.assertEqual(list(fleet.targets), [(bus, 1)])
+        fleet.close()
+
+    def test_interleaved(self):
+        """
+        Targets of one bus are flashed page by page, progress is reported for every target
+        """
+        fleet, sims = self._fleet(True)
+        progress = {}
+
+        def clb(bus, slave, done, size):
+            """
+            Record the last progress of target
+            :param bus: Name of the bus
+            :param slave: Slave address
+            :param done: Number of acknowledged pages
+            :param size: Number of pages
+            :return: None
+            """
+            progress[(bus, slave)] = (done, size)
+
+        self._check(fleet.run(clb), UPDATED)
+        self.assertEqual(set(progress), set(fleet.targets))
+        self.assertTrue(all(done == size for done, size in progress.values()))
+        for sim in sims:
+            for device in sim.slaves.values():
+                self.assertEqual(device.get_image(), self.image)
+        fleet.close()
+
+    def test_resume(self):
+        """
+        Targets of failed bus are resumed, the others are not flashed again
+        """
+        fleet, sims = self._fleet(False)
+        sims[1].drop_rate = 1.0
+        report = fleet.run()
+        self.assertEqual([item['Result'] for key, item in sorted(report.items(), key=lambda x: x[0][1])],
+                         [UPDATED, UPDATED, FAILED, FAILED])
+        sims[1].drop_rate = 0.0
+        sims[0].reset_stats()
+        self._check(fleet.run(resume=True), UPDATED)
+        self.assertEqual(sims[0].get_stats()['Requests'], 0)
+        for device in sims[1].slaves.values():
+            self.assertEqual(device.get_image(), self.image)
+        fleet.close()
+
+
+if __name__ == '__main__':
+    unittest.main()